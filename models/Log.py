@@ -4,18 +4,28 @@
 
 """
     单条日志对象封装
+
+    热路径上每条事件都会构建Log对象，子对象和时间等派生字段只在第一次访问时计算
 """
 
 from tools.TicketParser import TicketParser
-from tools.common.common import datetime_to_common_str, utc_to_local_datetime, md5
+from tools.common.common import datetime_to_common_str, md5, utc_to_datetime, move_n_hour
+
+# 尚未计算的惰性字段
+_UNSET = object()
+
+_ticket_parser = TicketParser()
 
 
 class Log(object):
+    __slots__ = ("doc_id", "record", "event_id", "utc_log_time", "level", "message", "record_number",
+                 "dc_computer_name", "dc_host_name", "event_data", "_utc_datetime", "_log_time",
+                 "_source_info", "_target_info", "_subject_info", "_ticket_info", "_object_info")
+
     def __init__(self, record, doc_id=None):
         self.doc_id = doc_id
         self.record = record
         self.event_id = record["event_id"]
-        self.log_time = datetime_to_common_str(utc_to_local_datetime(record["@timestamp"]))
         self.utc_log_time = record["@timestamp"]
         self.level = record["level"]
         self.message = record["message"]
@@ -23,14 +33,85 @@ class Log(object):
         self.dc_computer_name = record["computer_name"]
         self.dc_host_name = record["beat"]["hostname"]
 
+        # 不存在 event_data 时不设置，访问 event_data 及各个子对象会抛出 AttributeError
         if "event_data" in record:
             self.event_data = record["event_data"]
 
-            self.source_info = SourceInfo(record["event_data"])
-            self.target_info = TargetInfo(record["event_data"])
-            self.subject_info = SubjectInfo(record["event_data"])
-            self.ticket_info = TicketInfo(record["event_data"])
-            self.object_info = ObjectInfo(record["event_data"])
+        self._utc_datetime = None
+        self._log_time = None
+        self._source_info = None
+        self._target_info = None
+        self._subject_info = None
+        self._ticket_info = None
+        self._object_info = None
+
+    @property
+    def utc_datetime(self):
+        """
+            UTC时间的datetime对象
+        """
+        if self._utc_datetime is None:
+            self._utc_datetime = utc_to_datetime(self.utc_log_time)
+        return self._utc_datetime
+
+    @property
+    def log_time(self) -> str:
+        """
+            本地时间字符串，直接在UTC时间上加8小时
+        """
+        if self._log_time is None:
+            self._log_time = datetime_to_common_str(move_n_hour(self.utc_datetime, -8))
+        return self._log_time
+
+    @property
+    def source_info(self):
+        if self._source_info is None:
+            self._source_info = SourceInfo(self.event_data)
+        return self._source_info
+
+    @source_info.setter
+    def source_info(self, value):
+        self._source_info = value
+
+    @property
+    def target_info(self):
+        if self._target_info is None:
+            self._target_info = TargetInfo(self.event_data)
+        return self._target_info
+
+    @target_info.setter
+    def target_info(self, value):
+        self._target_info = value
+
+    @property
+    def subject_info(self):
+        if self._subject_info is None:
+            self._subject_info = SubjectInfo(self.event_data)
+        return self._subject_info
+
+    @subject_info.setter
+    def subject_info(self, value):
+        self._subject_info = value
+
+    @property
+    def ticket_info(self):
+        if self._ticket_info is None:
+            self._ticket_info = TicketInfo(self.event_data)
+        return self._ticket_info
+
+    @ticket_info.setter
+    def ticket_info(self, value):
+        self._ticket_info = value
+
+    @property
+    def object_info(self):
+        if self._object_info is None:
+            self._object_info = ObjectInfo(self.event_data)
+        return self._object_info
+
+    @object_info.setter
+    def object_info(self, value):
+        self._object_info = value
 
     @property
     def id(self):
@@ -41,27 +122,30 @@ class Log(object):
         return md5(id_str)
 
 
+def _strip_user_name(name):
+    """
+        UserName 中可能存在 @xxx.com 的后缀
+    """
+    if name and "@" in name:
+        return name.split("@")[0]
+    return name
+
+
 class SourceInfo(object):
+    __slots__ = ("work_station_name", "ip_address", "port")
+
+    _field_map = (
+        ("WorkstationName", "work_station_name"),
+        ("IpAddress", "ip_address"),
+        ("IpPort", "port")
+    )
+
     def __init__(self, event_data):
-        self.work_station_name = None
-        self.ip_address = None
-        self.port = None
-
-        self._field_map = {
-            "WorkstationName": "work_station_name",
-            "IpAddress": "ip_address",
-            "IpPort": "port"
-        }
-        for key, value in self._field_map.items():
-            if key not in event_data:
-                continue
-            elif key == "IpAddress":
-                ip = event_data[key]
-                if ip.startswith("::ffff:"):
-                    ip = ip.replace("::ffff:", "")
-                self.__dict__.update({value: ip})
-            else:
-                self.__dict__.update({value: event_data[key]})
+        for key, value in self._field_map:
+            setattr(self, value, event_data.get(key))
+        ip = self.ip_address
+        if ip and ip.startswith("::ffff:"):
+            self.ip_address = ip.replace("::ffff:", "")
 
     def get_doc(self):
         return {
@@ -72,38 +156,22 @@ class SourceInfo(object):
 
 
 class TargetInfo(object):
+    __slots__ = ("domain_name", "user_name", "user_sid", "logon_id", "info", "server_name", "sid", "full_user_name")
+
+    _field_map = (
+        ("TargetDomainName", "domain_name"),
+        ("TargetUserName", "full_user_name"),
+        ("TargetUserSid", "user_sid"),
+        ("TargetSid", "sid"),
+        ("TargetLogonId", "logon_id"),
+        ("TargetInfo", "info"),
+        ("TargetServerName", "server_name")
+    )
+
     def __init__(self, event_data):
-        self.domain_name = None
-        self.user_name = None
-        self.user_sid = None
-        self.logon_id = None
-        self.info = None
-        self.server_name = None
-        self.sid = None
-        self.full_user_name = None
-
-        self._field_map = {
-            "TargetDomainName": "domain_name",
-            "TargetUserName": "user_name",
-            "TargetUserSid": "user_sid",
-            "TargetSid": "sid",
-            "TargetLogonId": "logon_id",
-            "TargetInfo": "info",
-            "TargetServerName": "server_name"
-        }
-        for key, value in self._field_map.items():
-            if key not in event_data:
-                continue
-            # UserName 中可能存在 @xxx.com 的后缀
-            if key == "TargetUserName":
-                if "@" in event_data[key]:
-                    user_name = event_data[key].split("@")[0]
-                    self.__dict__.update({value: user_name})
-                else:
-                    self.__dict__.update({value: event_data[key]})
-                self.__dict__.update({"full_user_name": event_data[key]})
-            elif key in event_data:
-                self.__dict__.update({value: event_data[key]})
+        for key, value in self._field_map:
+            setattr(self, value, event_data.get(key))
+        self.user_name = _strip_user_name(self.full_user_name)
 
     def get_doc(self):
         return {
@@ -119,33 +187,19 @@ class TargetInfo(object):
 
 
 class SubjectInfo(object):
-    def __init__(self, event_data):
-        self.logon_id = None
-        self.user_name = None
-        self.domain_name = None
-        self.user_sid = None
-        self.full_user_name = None
-
-        self._field_map = {
-            "SubjectDomainName": "domain_name",
-            "SubjectUserName": "user_name",
-            "SubjectUserSid": "user_sid",
-            "SubjectLogonId": "logon_id",
-        }
+    __slots__ = ("logon_id", "user_name", "domain_name", "user_sid", "full_user_name")
+
+    _field_map = (
+        ("SubjectDomainName", "domain_name"),
+        ("SubjectUserName", "full_user_name"),
+        ("SubjectUserSid", "user_sid"),
+        ("SubjectLogonId", "logon_id")
+    )
 
-        for key, value in self._field_map.items():
-            if key not in event_data:
-                continue
-            # UserName 中可能存在 @xxx.com 的后缀
-            if key == "SubjectUserName":
-                if "@" in event_data[key]:
-                    user_name = event_data[key].split("@")[0]
-                    self.__dict__.update({value: user_name})
-                else:
-                    self.__dict__.update({value: event_data[key]})
-                self.__dict__.update({"full_user_name": event_data[key]})
-            elif key in event_data:
-                self.__dict__.update({value: event_data[key]})
+    def __init__(self, event_data):
+        for key, value in self._field_map:
+            setattr(self, value, event_data.get(key))
+        self.user_name = _strip_user_name(self.full_user_name)
 
     def get_doc(self):
         return {
@@ -158,32 +212,38 @@ class SubjectInfo(object):
 
 
 class TicketInfo(object):
+    __slots__ = ("encryption_type", "options", "status", "_encryption_type_detail", "_options_detail")
+
+    _field_map = (
+        ("TicketEncryptionType", "encryption_type"),
+        ("TicketOptions", "options"),
+        ("Status", "status")
+    )
+
     def __init__(self, event_data):
-        self.encryption_type = None
-        self.encryption_type_detail = None
-        self.options = None
-        self.options_detail = None
-        self.status = None
-
-        self._field_map = {
-            "TicketEncryptionType": "encryption_type",
-            "TicketOptions": "options",
-            "Status": "status"
-        }
+        for key, value in self._field_map:
+            setattr(self, value, event_data.get(key))
+        # 票据加密类型和选项只在访问时解析
+        self._encryption_type_detail = _UNSET
+        self._options_detail = _UNSET
 
-        ticket_parser = TicketParser()
-
-        for key, value in self._field_map.items():
-            if key not in event_data:
-                continue
-            elif key == "TicketEncryptionType":
-                self.__dict__.update({value: event_data[key]})
-                self.encryption_type_detail = ticket_parser.encryption_parse(event_data[key])
-            elif key == "TicketOptions":
-                self.__dict__.update({value: event_data[key]})
-                self.options_detail = ticket_parser.option_parse(event_data[key])
+    @property
+    def encryption_type_detail(self):
+        if self._encryption_type_detail is _UNSET:
+            if self.encryption_type is None:
+                self._encryption_type_detail = None
             else:
-                self.__dict__.update({value: event_data[key]})
+                self._encryption_type_detail = _ticket_parser.encryption_parse(self.encryption_type)
+        return self._encryption_type_detail
+
+    @property
+    def options_detail(self):
+        if self._options_detail is _UNSET:
+            if self.options is None:
+                self._options_detail = None
+            else:
+                self._options_detail = _ticket_parser.option_parse(self.options)
+        return self._options_detail
 
     def get_doc(self):
         return {
@@ -196,27 +256,20 @@ class TicketInfo(object):
 
 
 class ObjectInfo(object):
-    def __init__(self, event_data):
-        self.dn = None
-        self.guid = None
-        self.class_ = None
-        self.server = None
-        self.type = None
-        self.name = None
-
-        self._field_map = {
-            "ObjectDN": "dn",
-            "ObjectGUID": "guid",
-            "ObjectClass": "class_",
-            "ObjectServer": "server",
-            "ObjectType": "type",
-            "ObjectName": "name"
-        }
+    __slots__ = ("dn", "guid", "class_", "server", "type", "name")
 
-        for key, value in self._field_map.items():
-            if key not in event_data:
-                continue
-            self.__dict__.update({value: event_data[key]})
+    _field_map = (
+        ("ObjectDN", "dn"),
+        ("ObjectGUID", "guid"),
+        ("ObjectClass", "class_"),
+        ("ObjectServer", "server"),
+        ("ObjectType", "type"),
+        ("ObjectName", "name")
+    )
+
+    def __init__(self, event_data):
+        for key, value in self._field_map:
+            setattr(self, value, event_data.get(key))
 
     def get_doc(self):
         return {
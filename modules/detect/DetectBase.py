@@ -13,6 +13,8 @@ from tools.common.common import datetime_now_obj, move_n_sec, md5, utc_to_dateti
 from tools.database.MongoHelper import MongoHelper
 from tools.database.ElsaticHelper import *
 from tools.common.errors import NoDataInitEvent
+from tools.common.RecentEventStore import recent_events
+from tools.common.LogonSessionTable import logon_sessions
 from modules.record_handle.AccountHistory import AccountHistory
 
 HIGH_LEVEL = "high"
@@ -114,7 +116,7 @@ class DetectBase(object):
 
     def _get_time(self):
         if self.log:
-            return utc_to_datetime(self.log.utc_log_time)
+            return self.log.utc_datetime
         else:
             return utc_to_datetime(self.krb.utc_time)
 
@@ -169,6 +171,13 @@ class DetectBase(object):
         return account_history.get_last_ip_by_workstation(source_ip)
 
     def _get_source_ip_by_logon_id(self, logon_id: str, user_name: str) -> str:
+        """
+            根据登录会话查找来源IP，优先查询登录会话表，未命中时查询ES中的 4624 事件
+        """
+        session = logon_sessions.get(logon_id, user_name)
+        if session is not None and session["ip_address"]:
+            return session["ip_address"]
+
         id_term = get_term_statement("event_id", 4624)
         logon_id_term = get_term_statement("event_data.TargetLogonId.keyword", logon_id)
         user_term = get_term_statement("event_data.TargetUserName.keyword", user_name)
@@ -186,6 +195,27 @@ class DetectBase(object):
         else:
             return "unknown"
 
+    def _search_recent(self, since, event_id=None, terms=None, matches=None):
+        """
+            在最近事件存储中查找 since 之后满足条件的事件，参数见 RecentEventStore.last_match
+            since 为空时不限时间，存储只能确认存在
+            确认不存在之前先等待当前事件到达存储，接收落后时之前的事件可能还未到达
+
+            :return: True 存在；False 存储覆盖该时间段且不存在；None 存储无法确认，需要查询ES
+        """
+        found = recent_events.exists(since, None, event_id, terms, matches)
+        if found is None:
+            # 条件中有存储未保存的字段
+            return None
+        if found:
+            return True
+        if since is None or not recent_events.covers(since):
+            return None
+        if not recent_events.wait_for(self.log.dc_computer_name, self.log.record_number):
+            return None
+        # 等待期间到达的事件
+        return recent_events.exists(since, None, event_id, terms, matches)
+
     @abstractmethod
     def _generate_alert_doc(self, **kwargs) -> dict:
         pass
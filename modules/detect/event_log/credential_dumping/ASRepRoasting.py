@@ -20,6 +20,13 @@ from models.Log import Log
 from modules.record_handle.TicketRecords import TicketRecords
 
 EVENT_ID = [4768]
+# 构建Log对象之前对原始 event_data 的预过滤条件
+PREFILTER = {
+    "Status": "0x0",
+    "ServiceName": "krbtgt",
+    "TicketEncryptionType": "0x17",
+    "PreAuthType": "0"
+}
 
 ALERT_CODE = "202"
 TITLE = "AS-REP Roasting"
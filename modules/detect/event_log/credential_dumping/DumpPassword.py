@@ -85,46 +85,15 @@ class DumpPassword(DetectBase):
         if "_delay_info" not in log.record:
             self.delay_confirm_log()
             return
-        self.es.wait_log_in_database(log.dc_computer_name, log.record_number)
-
-        base = {
-            "index": ElasticConfig.event_log_index,
-            "doc_type": ElasticConfig.event_log_doc_type
-        }
 
         # 开始向前查找
-        msearch_body = [base]
-        body_4904 = self._get_query(log, 4904,
-                                    get_term_statement("event_data.ProcessName.keyword",
-                                                       r"C:\Windows\System32\VSSVC.exe"),
-                                    get_term_statement("event_data.AuditSourceName.keyword", "VSSAudit")
-                                    )
-        msearch_body.append(body_4904)
-
-        msearch_body.append(base)
-        body_4688_vssvc = self._get_query(log, 4688,
-                                          get_term_statement("event_data.NewProcessName.keyword",
-                                                             r"C:\Windows\System32\VSSVC.exe")
-                                          )
-        msearch_body.append(body_4688_vssvc)
-
-        msearch_body.append(base)
-        body_4688_vssadmin = self._get_query(log, 4688,
-                                             get_term_statement("event_data.NewProcessName.keyword",
-                                                                r"C:\Windows\System32\vssadmin.exe")
-                                             )
-        msearch_body.append(body_4688_vssadmin)
-
-        results = self.es.multi_search(body=msearch_body,
-                                       index=ElasticConfig.event_log_index,
-                                       doc_type=ElasticConfig.event_log_doc_type)
-
-        for each in results["responses"]:
-            if each.get("error"):
-                logger.error("dump password module - wmic_vss multi search error: " + each.get("error").get("reason"))
-                raise MsearchException()
-            elif each["hits"]["total"] == 0:
-                return
+        conditions = [
+            (4904, {"ProcessName": r"C:\Windows\System32\VSSVC.exe", "AuditSourceName": "VSSAudit"}, None),
+            (4688, {"NewProcessName": r"C:\Windows\System32\VSSVC.exe"}, None),
+            (4688, {"NewProcessName": r"C:\Windows\System32\vssadmin.exe"}, None)
+        ]
+        if not self._search_forward(log, conditions, "wmic_vss"):
+            return
 
         return {
             "method": REMOTELY_WMIC_VSS_COPY,
@@ -153,51 +122,17 @@ class DumpPassword(DetectBase):
         if "_delay_info" not in log.record:
             self.delay_confirm_log()
             return
-        self.es.wait_log_in_database(log.dc_computer_name, log.record_number)
-
-        base = {
-            "index": ElasticConfig.event_log_index,
-            "doc_type": ElasticConfig.event_log_doc_type
-        }
 
         # 开始向前查找
-        msearch_body = [base]
-        body_4688 = self._get_query(log, 4688,
-                                    get_term_statement("event_data.NewProcessName.keyword",
-                                                       r"C:\Windows\System32\wbem\WmiPrvSE.exe"
-                                                       )
-                                    )
-        msearch_body.append(body_4688)
-        msearch_body.append(base)
-        body_4674 = self._get_query(log, 4674,
-                                    get_term_statement("event_data.SubjectUserName.keyword", user_name),
-                                    get_term_statement("event_data.ProcessName.keyword",
-                                                       r"C:\Windows\System32\wsmprovhost.exe"
-                                                       ),
-                                    get_match_must_all("event_data.ObjectName",
-                                                       r"\REGISTRY\MACHINE\SYSTEM\ControlSet001\services\WinSock2\Parameters"),
-                                    )
-        msearch_body.append(body_4674)
-        msearch_body.append(base)
-        body_4656 = self._get_query(log, 4656,
-                                    get_term_statement("event_data.ProcessName.keyword",
-                                                       r"C:\Windows\System32\wsmprovhost.exe"
-                                                       ),
-                                    get_match_must_all("event_data.ObjectName",
-                                                       r"\REGISTRY\MACHINE\SOFTWARE\Microsoft\Windows\CurrentVersion\WSMAN"),
-                                    )
-        msearch_body.append(body_4656)
-
-        results = self.es.multi_search(body=msearch_body,
-                                       index=ElasticConfig.event_log_index,
-                                       doc_type=ElasticConfig.event_log_doc_type)
-
-        for each in results["responses"]:
-            if each.get("error"):
-                logger.error("dump password module - invoke_mimikatz multi search error: " + each.get("error").get("reason"))
-                raise MsearchException()
-            elif each["hits"]["total"] == 0:
-                return
+        conditions = [
+            (4688, {"NewProcessName": r"C:\Windows\System32\wbem\WmiPrvSE.exe"}, None),
+            (4674, {"SubjectUserName": user_name, "ProcessName": r"C:\Windows\System32\wsmprovhost.exe"},
+             {"ObjectName": r"\REGISTRY\MACHINE\SYSTEM\ControlSet001\services\WinSock2\Parameters"}),
+            (4656, {"ProcessName": r"C:\Windows\System32\wsmprovhost.exe"},
+             {"ObjectName": r"\REGISTRY\MACHINE\SOFTWARE\Microsoft\Windows\CurrentVersion\WSMAN"})
+        ]
+        if not self._search_forward(log, conditions, "invoke_mimikatz"):
+            return
 
         return {
             "method": REMOTELY_INVOKE_NINJACOPY_DUMP
@@ -220,29 +155,49 @@ class DumpPassword(DetectBase):
         if "_delay_info" not in log.record:
             self.delay_confirm_log()
             return
-        self.es.wait_log_in_database(log.dc_computer_name, log.record_number)
 
-        base = {
-            "index": ElasticConfig.event_log_index,
-            "doc_type": ElasticConfig.event_log_doc_type
+        # 开始向前查找
+        conditions = [
+            (4656, {"SubjectUserName": user_name, "ProcessName": r"C:\Windows\System32\wsmprovhost.exe"},
+             {"ObjectName": r"\REGISTRY\MACHINE\SOFTWARE\Microsoft\Windows\CurrentVersion\WSMAN"}),
+            (4688, {"NewProcessName": r"C:\Windows\System32\wsmprovhost.exe"}, None)
+        ]
+        if not self._search_forward(log, conditions, "invoke_NinjaCopy"):
+            return
+
+        return {
+            "method": REMOTELY_INVOKE_NINJACOPY_DUMP
         }
 
-        # 开始向前查找
-        msearch_body = [base]
-        body_4656 = self._get_query(log, 4656,
-                                    get_term_statement("event_data.SubjectUserName.keyword", user_name),
-                                    get_match_must_all("event_data.ObjectName",
-                                                       r"\REGISTRY\MACHINE\SOFTWARE\Microsoft\Windows\CurrentVersion\WSMAN"),
-                                    get_term_statement("event_data.ProcessName.keyword",
-                                                       r"C:\Windows\System32\wsmprovhost.exe")
-                                    )
-        msearch_body.append(body_4656)
-        msearch_body.append(base)
-        body_4688 = self._get_query(log, 4688,
-                                    get_term_statement("event_data.NewProcessName.keyword",
-                                                       r"C:\Windows\System32\wsmprovhost.exe")
-                                    )
-        msearch_body.append(body_4688)
+    def _search_forward(self, log: Log, conditions: list, method: str) -> bool:
+        """
+            向前5分钟查找，所有条件都存在匹配的日志时返回 True
+
+            先查询最近事件存储，存储无法确认的条件再合并为一次 msearch 查询ES
+
+            :param conditions: [(事件ID, 精确匹配的字段, 分词匹配的字段)]
+        """
+        since = move_n_min(utc_to_datetime(log.utc_log_time), 5)
+        pending = []
+        for event_id, terms, matches in conditions:
+            found = self._search_recent(since, event_id, dict(terms, computer_name=log.dc_computer_name), matches)
+            if found is False:
+                return False
+            elif found is None:
+                pending.append((event_id, terms, matches))
+        if not pending:
+            return True
+
+        # 只查询时间范围覆盖的按天索引
+        base = {
+            "index": get_time_indices(ElasticConfig.event_log_index, since),
+            "doc_type": ElasticConfig.event_log_doc_type,
+            "ignore_unavailable": True
+        }
+        msearch_body = []
+        for event_id, terms, matches in pending:
+            msearch_body.append(base)
+            msearch_body.append(self._get_query(log, since, event_id, terms, matches))
 
         results = self.es.multi_search(body=msearch_body,
                                        index=ElasticConfig.event_log_index,
@@ -250,25 +205,24 @@ class DumpPassword(DetectBase):
 
         for each in results["responses"]:
             if each.get("error"):
-                logger.error(
-                    "dump password module - invoke_NinjaCopy multi search error: " + each.get("error").get("reason"))
+                logger.error("dump password module - {method} multi search error: ".format(method=method) +
+                             each.get("error").get("reason"))
                 raise MsearchException()
             elif each["hits"]["total"] == 0:
-                return
-
-        return {
-            "method": REMOTELY_INVOKE_NINJACOPY_DUMP
-        }
-
-    def _get_query(self, log: Log, event_id, *args):
-        ago_time = move_n_min(utc_to_datetime(log.utc_log_time), 5)
-        time_str = datetime_to_utc(ago_time)
+                return False
+        return True
+
+    def _get_query(self, log: Log, since, event_id, terms: dict, matches: dict):
+        statements = [get_term_statement("event_data.{field}.keyword".format(field=field), value)
+                      for field, value in terms.items()]
+        for field, text in (matches or {}).items():
+            statements.append(get_match_must_all("event_data." + field, text))
         query = {
             "query": get_must_statement(
                 get_term_statement("computer_name", log.dc_computer_name),
-                get_time_range("gt", time_str),
+                get_time_range("gt", datetime_to_utc(since)),
                 get_term_statement("event_id", event_id),
-                *args
+                *statements
             ),
             "sort": {
                 "@timestamp": "desc"
@@ -15,9 +15,15 @@ from models.Log import Log
 from modules.detect.DetectBase import DetectBase, LOW_LEVEL
 from modules.record_handle.AccountInfo import AccountInfo
 from tools.LDAPSearch import LDAPSearch
+from tools.common.DirectorySnapshot import directory
 
 
 EVENT_ID = [4661]
+# 构建Log对象之前对原始 event_data 的预过滤条件
+PREFILTER = {
+    "ObjectServer": "Security Account Manager",
+    "ObjectType": "SAM_GROUP"
+}
 
 ALERT_CODE = "101"
 TITLE = "使用SAMR查询敏感用户组"
@@ -64,6 +70,9 @@ class EnumerateGroup(DetectBase):
             return self._generate_alert_doc(group_name=group_name)
 
     def _get_group_name(self, sid, domain):
+        entry = directory.get_by_sid(domain, sid)
+        if entry is not None:
+            return entry.cn
         ldap = LDAPSearch(domain)
         entry = ldap.search_by_sid(sid, attributes=["cn"])
         if entry:
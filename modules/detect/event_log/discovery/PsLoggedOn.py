@@ -19,6 +19,11 @@ from tools.common.errors import MsearchException
 from tools.database.ElsaticHelper import *
 
 EVENT_ID = [5145]
+# 构建Log对象之前对原始 event_data 的预过滤条件
+PREFILTER = {
+    "ShareName": r"\\*\IPC$",
+    "RelativeTargetName": "srvsvc"
+}
 
 ALERT_CODE = "103"
 TITLE = "PsLoggedOn信息收集"
@@ -50,7 +55,6 @@ class PsLoggedOn(DetectBase):
         if "_delay_info" not in log.record:
             self.delay_confirm_log()
             return
-        self.es.wait_log_in_database(log.dc_computer_name, log.record_number)
 
         is_match = self._search_forward(log)
         if is_match:
@@ -79,20 +83,35 @@ class PsLoggedOn(DetectBase):
 
     def _search_forward(self, log: Log):
         """
-
+            向前1分钟查找同一登录会话对 winreg、lsarpc 的访问，先查询最近事件存储，无法确认的再查询ES
         """
+        since = move_n_min(utc_to_datetime(log.utc_log_time), 1)
+        pending = []
+        for relative_target_name in ("winreg", "lsarpc"):
+            found = self._search_recent(since, terms={
+                "computer_name": log.dc_computer_name,
+                "SubjectLogonId": log.subject_info.logon_id,
+                "ShareName": r"\\*\IPC$",
+                "RelativeTargetName": relative_target_name
+            })
+            if found is False:
+                return False
+            elif found is None:
+                pending.append(relative_target_name)
+        if not pending:
+            return True
+
+        # 只查询时间范围覆盖的按天索引
         base = {
-            "index": ElasticConfig.event_log_index,
-            "doc_type": ElasticConfig.event_log_doc_type
+            "index": get_time_indices(ElasticConfig.event_log_index, since),
+            "doc_type": ElasticConfig.event_log_doc_type,
+            "ignore_unavailable": True
         }
         # 开始向前查找
-        msearch_body = [base]
-        body_winreg = self._get_query(log, "winreg")
-        msearch_body.append(body_winreg)
-
-        msearch_body.append(base)
-        body_lsarpc = self._get_query(log, "lsarpc")
-        msearch_body.append(body_lsarpc)
+        msearch_body = []
+        for relative_target_name in pending:
+            msearch_body.append(base)
+            msearch_body.append(self._get_query(log, relative_target_name))
 
         results = self.es.multi_search(body=msearch_body,
                                        index=ElasticConfig.event_log_index,
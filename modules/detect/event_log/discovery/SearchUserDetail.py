@@ -15,9 +15,14 @@ from models.Log import Log
 from modules.record_handle.AccountHistory import AccountHistory
 from modules.record_handle.AccountInfo import AccountInfo
 from tools.LDAPSearch import LDAPSearch
+from tools.common.DirectorySnapshot import directory
 from tools.common.common import filter_domain
 
 EVENT_ID = [4661]
+# 构建Log对象之前对原始 event_data 的预过滤条件
+PREFILTER = {
+    "ObjectType": "SAM_USER"
+}
 
 ALERT_CODE = "102"
 TITLE = "使用SAMR查询敏感用户"
@@ -65,11 +70,15 @@ class SearchUserDetail(DetectBase):
         if not self.account_info.user_is_sensitive_by_sid(sid=target_sid, domain=domain_name):
             return
 
-        ldap = LDAPSearch(domain_name)
-        target = ldap.search_by_sid(target_sid, attributes=["cn"])
-        if not target:
-            return
-        target_user_name = str(target["cn"])
+        entry = directory.get_by_sid(domain_name, target_sid)
+        if entry is not None:
+            target_user_name = entry.cn
+        else:
+            ldap = LDAPSearch(domain_name)
+            target = ldap.search_by_sid(target_sid, attributes=["cn"])
+            if not target:
+                return
+            target_user_name = str(target["cn"])
         return self._generate_alert_doc(target_user_name=target_user_name)
 
     def _generate_alert_doc(self, **kwargs) -> dict:
@@ -19,6 +19,11 @@ from tools.SDDLParser import SDDLParser
 
 
 EVENT_ID = [5136]
+# 构建Log对象之前对原始 event_data 的预过滤条件
+PREFILTER = {
+    "ObjectClass": ["container", "domainDNS", "groupPolicyContainer"],
+    "AttributeLDAPDisplayName": "nTSecurityDescriptor"
+}
 
 ALERT_CODE = "401"
 TITLE = "ACL异常修改"
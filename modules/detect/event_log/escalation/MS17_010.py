@@ -17,6 +17,13 @@ from modules.detect.DetectBase import DetectBase, HIGH_LEVEL
 from tools.database.ElsaticHelper import *
 
 EVENT_ID = [5140]
+# 构建Log对象之前对原始 event_data 的预过滤条件
+PREFILTER = {
+    "SubjectUserSid": "S-1-5-7",
+    "SubjectUserName": "ANONYMOUS LOGON",
+    "SubjectDomainName": "NT AUTHORITY",
+    "ShareName": r"\\*\IPC$"
+}
 
 ALERT_CODE = "403"
 TITLE = "MS17-010攻击"
@@ -47,7 +54,6 @@ class MS17_010(DetectBase):
         if "_delay_info" not in log.record:
             self.delay_confirm_log()
             return
-        self.es.wait_log_in_database(log.dc_computer_name, log.record_number)
 
         # 如果为 0x 后接5位随机数，则为原版相关衍生POC
         if len(log.subject_info.logon_id) == 7:
@@ -81,8 +87,15 @@ class MS17_010(DetectBase):
         """
             4624
 
-            查找匿名登录
+            查找匿名登录，最近事件存储中存在时无需查询ES
         """
+        if self._search_recent(None, 4624, terms={
+            "TargetLogonId": logon_id,
+            "TargetUserName": "ANONYMOUS LOGON",
+            "LmPackageName": "NTLM V1",
+            "WorkstationName": "NULL"
+        }):
+            return True
 
         id_term = get_term_statement("event_id", "4624")
         logon_id_term = get_term_statement("event_data.TargetLogonId.keyword", logon_id)
@@ -105,8 +118,12 @@ class MS17_010(DetectBase):
         """
             4624 4634
 
-            确认该登录IP没有任何与之相关的登录事件
+            确认该登录IP没有任何与之相关的登录事件，最近事件存储中存在时无需查询ES
         """
+        for event_id in (4624, 4634):
+            if self._search_recent(None, event_id, terms={"TargetLogonId": logon_id,
+                                                          "TargetUserName": "ANONYMOUS LOGON"}):
+                return False
         id_term = get_should_statement(
             get_term_statement("event_id", 4624),
             get_term_statement("event_id", 4634)
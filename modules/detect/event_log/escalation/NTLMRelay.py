@@ -29,6 +29,10 @@ from tools.database.ElsaticHelper import *
 
 
 EVENT_ID = [4624]
+# 构建Log对象之前对原始 event_data 的预过滤条件
+PREFILTER = {
+    "AuthenticationPackageName": "NTLM"
+}
 
 ALERT_CODE = "405"
 TITLE = "NTLM中继活动"
@@ -14,6 +14,10 @@ from models.Log import Log
 from modules.detect.DetectBase import DetectBase, LOW_LEVEL
 
 EVENT_ID = [5137]
+# 构建Log对象之前对原始 event_data 的预过滤条件
+PREFILTER = {
+    "ObjectClass": "groupPolicyContainer"
+}
 
 ALERT_CODE = "404"
 TITLE = "新增组策略"
@@ -21,6 +21,10 @@ from modules.record_handle.AccountInfo import AccountInfo
 
 
 EVENT_ID = [5136]
+# 构建Log对象之前对原始 event_data 的预过滤条件
+PREFILTER = {
+    "AttributeLDAPDisplayName": "msDS-AllowedToActOnBehalfOfOtherIdentity"
+}
 
 ALERT_CODE = "406"
 TITLE = "基于资源的约束委派权限授予"
@@ -17,6 +17,10 @@ from modules.detect.DetectBase import DetectBase, HIGH_LEVEL
 from tools.common.common import ip_filter
 
 EVENT_ID = [5145]
+# 构建Log对象之前对原始 event_data 的预过滤条件
+PREFILTER = {
+    "RelativeTargetName": "spoolss"
+}
 
 ALERT_CODE = "407"
 TITLE = "攻击打印机服务 SpoolSample"
@@ -9,14 +9,22 @@
       1. 横向，去认证多个用户
       2. 纵向，对一个用户尝试多次
 
+    每个来源IP在时间窗口内对各个目标用户的失败次数使用滑动窗口计数，每条事件常数时间判断。
+    按来源IP分片消费时计数保存在进程内存中，否则保存在Redis中由各进程共享。
+    计数开始之前的时间段仍然通过 最近事件存储 + ES聚合 统计。
 """
 
 from modules.detect.DetectBase import DetectBase, LOW_LEVEL
 from settings.config import main_config
+from settings.database_config import MqConfig
 from models.Log import Log
 from modules.record_handle.AccountHistory import AccountHistory
 from tools.common.common import move_n_min, utc_to_datetime, datetime_to_utc, ip_filter
+from tools.common.RecentEventStore import recent_events
+from tools.common.SlidingWindowCounter import SlidingWindowCounter, RedisSlidingWindowCounter
 from tools.database.ElsaticHelper import *
+from collections import Counter
+from datetime import timedelta
 
 EVENT_ID = [4625, 4771]
 
@@ -24,16 +32,36 @@ ALERT_CODE = "301"
 TITLE = "Brute force attack"
 DESC_TEMPLATE = "来自于 [source_ip]([source_workstation]) 多次认证目标身份失败，疑似暴力破解攻击。"
 
+# 统计的时间窗口，单位分钟
+WINDOW_MINUTES = 60
+# 横向爆破的账户数
+HORIZONTAL_USER_NUM = 100
+
 
 class BruteForce(DetectBase):
     def __init__(self):
         super().__init__(code=ALERT_CODE, title=TITLE, desc=DESC_TEMPLATE)
         self.es = ElasticHelper()
         self.account_history = AccountHistory()
+        window = timedelta(minutes=WINDOW_MINUTES)
+        if MqConfig.shard_mode and MqConfig.shard_key == "source_ip":
+            self.counter = SlidingWindowCounter(window)
+        else:
+            self.counter = RedisSlidingWindowCounter(window, "brute_force")
 
     def run(self, log: Log):
         self.init(log=log)
 
+        ip = log.source_info.ip_address
+        if ip_filter(ip):
+            return
+
+        # 与ES聚合一致，在其它过滤条件之前统计该IP的全部失败事件
+        _, user_num, max_count = self.counter.add(ip, log.event_data.get("TargetUserName", ""),
+                                                  "{computer}/{record}".format(computer=log.dc_computer_name,
+                                                                               record=log.record_number),
+                                                  log.utc_datetime)
+
         if log.subject_info.domain_name:
             domain = log.subject_info.domain_name
         else:
@@ -55,27 +83,28 @@ class BruteForce(DetectBase):
         if "PreAuthType" in log.event_data and log.event_data["PreAuthType"] == "0":
             return
 
-        ip = log.source_info.ip_address
-        if ip_filter(ip):
-            return
-
-        self.es.wait_log_in_database(log.dc_computer_name, log.record_number)
-        target_users = []
-        user_list = self._get_login_fail_count(ip_address=ip, utc_time=log.utc_log_time)
-        # 横向爆破超过100个账户
-        if len(user_list) > 100:
-            brute_force_type = "horizontal"
-
-        for each in user_list:
-            target_users.append({
-                "name": each["key"],
-                "count": each["doc_count"]
-            })
-            if each["doc_count"] > main_config.brute_force_max:
+        if self.counter.coverage_start() <= move_n_min(log.utc_datetime, WINDOW_MINUTES):
+            # 横向爆破超过100个账户
+            if user_num > HORIZONTAL_USER_NUM:
+                brute_force_type = "horizontal"
+            if max_count > main_config.brute_force_max:
                 brute_force_type = "vertical"
-
-        if not brute_force_type:
-            return
+            if not brute_force_type:
+                return
+            user_list = [{"key": name, "doc_count": count}
+                         for name, count in self.counter.most_common(ip, HORIZONTAL_USER_NUM + 1)]
+        else:
+            user_list = self._get_login_fail_count(log, ip_address=ip)
+            # 横向爆破超过100个账户
+            if len(user_list) > HORIZONTAL_USER_NUM:
+                brute_force_type = "horizontal"
+            for each in user_list:
+                if each["doc_count"] > main_config.brute_force_max:
+                    brute_force_type = "vertical"
+            if not brute_force_type:
+                return
+
+        target_users = [{"name": each["key"], "count": each["doc_count"]} for each in user_list]
 
         return self._generate_alert_doc(brute_force_type=brute_force_type,
                                         brute_force_target_users=target_users)
@@ -96,12 +125,37 @@ class BruteForce(DetectBase):
     def _get_level(self):
         return LOW_LEVEL
 
-    def _get_login_fail_count(self, ip_address: str, utc_time: str) -> list:
+    def _get_login_fail_count(self, log: Log, ip_address: str) -> list:
         """
-            获取发起自某个IP的一段时间内的登录失败次数
+            获取发起自某个IP的一段时间内的登录失败次数，滑动窗口计数未覆盖整个时间窗口时使用
+
+            最近事件存储覆盖的时间段在内存中统计，更早的部分查询ES聚合
 
-            :return 日志ID列表，用户名列表
+            :return 用户名及失败次数列表，按次数降序
         """
+        end = log.utc_datetime
+        start = move_n_min(end, WINDOW_MINUTES)
+        # 当前事件到达存储后，之前的事件也都已到达
+        boundary = None
+        if recent_events.wait_for(log.dc_computer_name, log.record_number):
+            boundary = recent_events.coverage_start(start, end)
+        if boundary is None:
+            boundary = end
+
+        counter = Counter()
+        if boundary > start:
+            lt_time = log.utc_log_time if boundary == end else datetime_to_utc(boundary)
+            for each in self._get_login_fail_count_from_es(ip_address, datetime_to_utc(start), lt_time):
+                counter[each["key"]] += each["doc_count"]
+        if boundary < end:
+            ip_list = (ip_address, "::ffff:" + ip_address)
+            events = recent_events.find(boundary, end, event_ids=(4625, 4771),
+                                        predicate=lambda e: e["event_data"].get("IpAddress") in ip_list)
+            for event in events:
+                counter[event["event_data"].get("TargetUserName")] += 1
+        return [{"key": name, "doc_count": count} for name, count in counter.most_common(HORIZONTAL_USER_NUM + 1)]
+
+    def _get_login_fail_count_from_es(self, ip_address: str, gt_time: str, lt_time: str) -> list:
         # 事件ID
         id_term = get_should_statement(get_term_statement("event_id", 4625),
                                        get_term_statement("event_id", 4771))
@@ -110,11 +164,9 @@ class BruteForce(DetectBase):
             get_term_statement("event_data.IpAddress.keyword", ip_address),
             get_term_statement("event_data.IpAddress.keyword", "::ffff:" + ip_address)
         )
-        # 限定筛选时间范围 60分钟内
-        ago_time = move_n_min(utc_to_datetime(utc_time), 60)
-        ago_time_str = datetime_to_utc(ago_time)
-        gt_time_range = get_time_range("gt", ago_time_str)
-        lt_time_range = get_time_range("lt", utc_time)
+        # 限定筛选时间范围
+        gt_time_range = get_time_range("gt", gt_time)
+        lt_time_range = get_time_range("lt", lt_time)
         statement = {
             "query": get_must_statement(id_term, ip_term, gt_time_range, lt_time_range),
             "size": 0,
@@ -123,7 +175,9 @@ class BruteForce(DetectBase):
         }
 
         rsp = self.es.search(body=statement,
-                             index=ElasticConfig.event_log_index,
-                             doc_type=ElasticConfig.event_log_doc_type)
+                             index=get_time_indices(ElasticConfig.event_log_index, utc_to_datetime(gt_time),
+                                                    utc_to_datetime(lt_time)),
+                             doc_type=ElasticConfig.event_log_doc_type,
+                             ignore_unavailable=True)
         user_list = rsp["aggregations"]["user_list"]["buckets"]
         return user_list
@@ -16,6 +16,10 @@ from modules.detect.DetectBase import DetectBase, HIGH_LEVEL
 from tools.common.common import ip_filter
 
 EVENT_ID = [5145, 5142]
+# 构建Log对象之前对原始 event_data 的预过滤条件
+PREFILTER = {
+    "ShareName": [r"\\*\ADMIN$", r"\\*\C$", r"\\*\WMI_SHARE"]
+}
 
 ALERT_CODE = "303"
 TITLE = "目标域控的远程代码执行"
@@ -17,6 +17,17 @@ from tools.database.RedisHelper import RedisHelper
 
 EVENT_ID = [5145]
 
+# 超过该数量的不同用户访问过的文件共享名认为是正常服务
+NORMAL_SHARE_USER_NUM = 10
+# 进程内缓存的最大数量，超过后清空
+LOCAL_CACHE_MAX_NUM = 100000
+REDIS_KEY_WHITE_FILE_SHARE_SUFFIX = "_white_file_share"
+REDIS_KEY_FILE_SHARE_USERS_SUFFIX = "_file_share_users"
+# 访问用户集合的过期时间三十天，每次有新用户访问时重新计算
+FILE_SHARE_USERS_EXPIRE_TIME = 60*60*24*30
+# 已知共享名
+KNOWN_SHARE_NAMES = ["protected_storage", "lsarpc", "samr", "ntsvcs", "NETLOGON"]
+
 ALERT_CODE = "304"
 TITLE = "未知文件共享名"
 DESC_TEMPLATE = "来自于 [source_ip]([source_workstation]) 使用身份 [source_user_name] 访问了域控 [dc_hostname] " \
@@ -27,25 +38,13 @@ class UnknownFileShare(DetectBase):
     def __init__(self):
         super().__init__(code=ALERT_CODE, title=TITLE, desc=DESC_TEMPLATE)
         self.redis = RedisHelper()
-        self.es = ElasticHelper()
+        self._normal_names = set()
+        self._seen_users = set()
 
     def run(self, log: Log):
         self.init(log=log)
 
-        # 处于数据统计时间内，不检测
-        if datetime_now_obj() < main_config.learning_end_time:
-            return
-
-        ip = log.source_info.ip_address
-        if ip_filter(ip):
-            return
-
-        # 本地系统
-        if len(log.subject_info.user_sid.split("-")) == 4:
-            return
-
-        # 检查 relative_target_name
-        relative_target_name = log.event_data["RelativeTargetName"]
+        relative_target_name = log.event_data.get("RelativeTargetName")
         if not relative_target_name:
             return
 
@@ -59,11 +58,26 @@ class UnknownFileShare(DetectBase):
                 return
 
         # 已知共享名
-        if relative_target_name in ["protected_storage", "lsarpc", "samr", "ntsvcs", "NETLOGON"]:
+        if relative_target_name in KNOWN_SHARE_NAMES:
+            return
+
+        # 可能告警的共享名都更新访问用户，包括学习期间
+        is_normal = self._record_share_user(relative_target_name, log.event_data.get("SubjectUserName"))
+
+        # 处于数据统计时间内，不检测
+        if datetime_now_obj() < main_config.learning_end_time:
+            return
+
+        ip = log.source_info.ip_address
+        if ip_filter(ip):
+            return
+
+        # 本地系统
+        if len(log.subject_info.user_sid.split("-")) == 4:
             return
 
         # 和历史数据判断， 属于正常的文件共享，则忽略
-        if self._check_detail_file_share_normal(log):
+        if is_normal:
             return
 
         return self._generate_alert_doc(relative_target_name=relative_target_name)
@@ -89,40 +103,33 @@ class UnknownFileShare(DetectBase):
     def _get_level(self) -> str:
         return MEDIUM_LEVEL
 
-    def _check_detail_file_share_normal(self, log: Log) -> bool:
+    def _record_share_user(self, relative_target_name: str, user_name: str) -> bool:
         """
-            判断详细文件共享记录是否正常
-            用redis做缓存，将正常的名字缓存起来，加速判断
-        """
-        REDIS_KEY_WHITE_FILE_SHARE_SUFFIX = "_white_file_share"
-        key = log.event_data["RelativeTargetName"] + REDIS_KEY_WHITE_FILE_SHARE_SUFFIX
+            记录访问该文件共享名的用户，返回该名称是否属于正常的文件共享
 
-        redis_record = self.redis.get_str_value(key)
-        if redis_record == "white":
+            超过 NORMAL_SHARE_USER_NUM 个不同用户访问过的名称认为是正常服务，标记后删除用户集合，
+            未达到之前在Redis集合中精确保存访问过的用户，由每条 5145 事件增量更新。
+            进程内记录已经写入过的 (名称, 用户) 和已经确认正常的名称，减少Redis访问。
+        """
+        if relative_target_name in self._normal_names:
             return True
+        white_key = relative_target_name + REDIS_KEY_WHITE_FILE_SHARE_SUFFIX
+        if (relative_target_name, user_name) in self._seen_users:
+            normal = self.redis.get_str_value(white_key) == "white"
         else:
-            if self._aggs_detail_file_share_count(log) > 10:
-                self.redis.set_str_value(key, "white")
-                return True
+            if len(self._seen_users) >= LOCAL_CACHE_MAX_NUM:
+                self._seen_users.clear()
+            self._seen_users.add((relative_target_name, user_name))
+            users_key = relative_target_name + REDIS_KEY_FILE_SHARE_USERS_SUFFIX
+            normal = self.redis.add_member_set_and_count(users_key, user_name,
+                                                         expire=FILE_SHARE_USERS_EXPIRE_TIME) > NORMAL_SHARE_USER_NUM
+            if normal:
+                self.redis.set_str_value(white_key, "white")
+                self.redis.delete(users_key)
             else:
-                return False
-
-    def _aggs_detail_file_share_count(self, log: Log) -> int:
-        """
-            检查历史日志中，对于该名称的文件共享，多少用户使用过，如果超过10个，则可以忽略，认为是正常服务
-        """
-        id_term = get_term_statement("event_id", 5145)
-        name_term = get_term_statement("event_data.RelativeTargetName.keyword", log.event_data["RelativeTargetName"])
-
-        query = {
-            "query": get_must_statement(id_term, name_term),
-            "size": 0,
-            "aggs": get_aggs_statement(name="user_count",
-                                       aggs_type="terms",
-                                       field="event_data.SubjectUserName.keyword",
-                                       size=20)
-        }
-        rsp = self.es.search(body=query,
-                             index=ElasticConfig.event_log_index,
-                             doc_type=ElasticConfig.event_log_doc_type)
-        return len(rsp["aggregations"]["user_count"]["buckets"])
+                normal = self.redis.get_str_value(white_key) == "white"
+        if normal:
+            if len(self._normal_names) >= LOCAL_CACHE_MAX_NUM:
+                self._normal_names.clear()
+            self._normal_names.add(relative_target_name)
+        return normal
@@ -15,6 +15,11 @@ from modules.detect.DetectBase import DetectBase, HIGH_LEVEL
 from tools.SDDLParser import SDDLParser
 
 EVENT_ID = [5136]
+# 构建Log对象之前对原始 event_data 的预过滤条件
+PREFILTER = {
+    "ObjectClass": "container",
+    "AttributeLDAPDisplayName": "nTSecurityDescriptor"
+}
 
 ALERT_CODE = "501"
 TITLE = "AdminSDHolder对象修改"
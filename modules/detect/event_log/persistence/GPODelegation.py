@@ -14,6 +14,10 @@ from modules.record_handle.AccountInfo import AccountInfo
 from tools.SDDLParser import SDDLParser
 
 EVENT_ID = [5136]
+# 构建Log对象之前对原始 event_data 的预过滤条件
+PREFILTER = {
+    "ObjectClass": "container"
+}
 
 ALERT_CODE = "504"
 TITLE = "组策略委派权限授予"
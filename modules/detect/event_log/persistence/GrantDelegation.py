@@ -18,6 +18,10 @@ from modules.record_handle.Delegation import Delegation, CONSTRAINED_DELEGATION
 from tools.common.common import get_netbios_domain
 
 EVENT_ID = [4738]
+# 构建Log对象之前对原始 event_data 的预过滤条件
+PREFILTER = {
+    "AllowedToDelegateTo": lambda value: value != "-"
+}
 
 ALERT_CODE = "505"
 TITLE = "Kerberos约束委派权限授予"
@@ -52,7 +56,7 @@ class GrantDelegation(DetectBase):
                                                   allowed_to=allowed_to_list)
         else:
             self.delegation.new_delegation_record(
-                user=User(log.target_info.__dict__),
+                user=User(log.target_info.get_doc()),
                 delegation_type=CONSTRAINED_DELEGATION,
                 allowed_to=allowed_to_list
             )
@@ -14,6 +14,7 @@ from models.Log import Log
 from modules.detect.DetectBase import DetectBase, HIGH_LEVEL
 from tools.common.common import get_cn_from_dn
 from modules.record_handle.AccountInfo import AccountInfo
+from tools.common.GroupGraph import group_graph, get_group_domain
 
 EVENT_ID = [4728, 4732, 4756]
 
@@ -34,7 +35,10 @@ class ModifySensitiveGroup(DetectBase):
         group_name = log.target_info.user_name
 
         sensitive_groups = list(map(lambda x: x["name"], main_config.sensitive_groups))
-        if group_name in sensitive_groups:
+        # 嵌套在敏感组中的组同样视为敏感组
+        if group_name in sensitive_groups or \
+                group_graph.is_sensitive_group(get_group_domain(log.target_info.domain_name, log.dc_computer_name),
+                                               log.event_data["TargetSid"]):
             # 添加到了敏感组，更新redis缓存
             self.account_info.set_target_sensitive_cache(self.log.event_data["MemberSid"], "true")
             return self._generate_alert_doc()
@@ -14,6 +14,12 @@ from models.Log import Log
 from modules.detect.DetectBase import DetectBase, HIGH_LEVEL
 
 EVENT_ID = [4771]
+# 构建Log对象之前对原始 event_data 的预过滤条件
+PREFILTER = {
+    "TicketOptions": "0x50802000",
+    "PreAuthType": "0",
+    "Status": "0xe"
+}
 
 ALERT_CODE = "510"
 TITLE = "万能钥匙-主动检测"
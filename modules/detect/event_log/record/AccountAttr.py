@@ -13,6 +13,11 @@ from tools.UACFlagsParser import UACFlagsParser
 
 
 EVENT_ID = [4738]
+# 构建Log对象之前对原始 event_data 的预过滤条件
+PREFILTER = {
+    "NewUacValue": lambda value: value != "-",
+    "OldUacValue": lambda value: value != "-"
+}
 
 
 class AccountAttr(object):
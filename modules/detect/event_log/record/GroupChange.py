@@ -13,6 +13,7 @@
 from models.Log import Log
 from modules.record_handle.AccountActivity import AccountActivity, GROUP_CHANGE
 from tools.common.common import get_cn_from_dn
+from tools.common.GroupGraph import group_graph, get_group_domain
 
 EVENT_ID = [4728, 4729, 4732, 4733, 4756, 4757]
 
@@ -32,6 +33,11 @@ class GroupChange(object):
         group_name = log.event_data["TargetUserName"]
         domain = log.subject_info.domain_name
 
+        # 更新组成员关系图
+        group_graph.apply_change(domain=get_group_domain(log.target_info.domain_name, log.dc_computer_name),
+                                 member_sid=target_user_sid,
+                                 group_sid=log.event_data["TargetSid"], add=operator_type == "add")
+
         form_data = {
             "group_name": group_name,
             "operator_type": operator_type
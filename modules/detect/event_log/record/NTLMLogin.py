@@ -9,6 +9,10 @@ from tools.common.common import ip_filter
 
 
 EVENT_ID = [4624]
+# 构建Log对象之前对原始 event_data 的预过滤条件
+PREFILTER = {
+    "AuthenticationPackageName": "NTLM"
+}
 
 
 class NTLMLogin(object):
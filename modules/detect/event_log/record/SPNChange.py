@@ -14,6 +14,12 @@ from modules.record_handle.AccountInfo import AccountInfo
 from tools.common.common import get_cn_from_dn
 
 EVENT_ID = [5136]
+# 构建Log对象之前对原始 event_data 的预过滤条件
+PREFILTER = {
+    "AttributeLDAPDisplayName": "servicePrincipalName",
+    "ObjectClass": "user",
+    "OperatorType": ["%%14675", "%%14674"]
+}
 
 
 class SPNChange(object):
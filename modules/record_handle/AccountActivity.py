@@ -5,11 +5,12 @@
 """
     详细记录账户的在域内的重要敏感活动
 
-    如果每次都index，会存在性能瓶颈，使用bulk，达到一定数量或者距离上一条数据时间过长时，执行入库操作。
+    如果每次都index，会存在性能瓶颈，通过进程内共用的 BulkIndexer 在后台批量入库。
 """
 
 
 from tools.database.ElsaticHelper import *
+from tools.database.BulkIndexer import bulk_indexer
 from tools.common.common import datetime_now_obj, datetime_to_log_date, get_netbios_domain
 
 ACCOUNT_ATTR_CHANGE = "account_attr"            # 4738
@@ -22,7 +23,6 @@ NTLM_LOGIN = "ntlm_login"                       # 4624
 
 class AccountActivity(object):
     def __init__(self, activity_type):
-        self.es = ElasticHelper()
         self.activity_type = activity_type
 
     def save_activity(self, domain, user_name, sid, dc_name, timestamp, data: dict):
@@ -38,6 +38,6 @@ class AccountActivity(object):
 
         index = ElasticConfig.user_activity_write_index_prefix + datetime_to_log_date(datetime_now_obj())
 
-        self.es.delay_index(body=doc,
-                            index=index,
-                            doc_type=ElasticConfig.user_activity_doc_type)
+        bulk_indexer.add(body=doc,
+                         index=index,
+                         doc_type=ElasticConfig.user_activity_doc_type)
@@ -8,9 +8,20 @@
 
 from tools.database.ElsaticHelper import *
 from tools.database.RedisHelper import RedisHelper
+from tools.common.LocalCache import LocalCache, MISSING
+from tools.common.SingleFlight import SingleFlight
 
 REDIS_KEY_LAST_WORKSTATION_IP_SUFFIX = "_ip_to_workstation"
 REDIS_KEY_LAST_IP_WORKSTATION_SUFFIX = "_workstation_to_ip"
+# redis缓存过期时间一天
+HISTORY_REDIS_EXPIRE_TIME = 60*60*24
+# IP与主机名的对应关系会被其它进程更新，进程内只缓存一分钟
+HISTORY_LOCAL_EXPIRE_TIME = 60
+HISTORY_LOCAL_CACHE_MAX_NUM = 100000
+
+history_cache = LocalCache("account_history", HISTORY_LOCAL_CACHE_MAX_NUM)
+# 同一个键的并发ES查询只执行一次
+history_flight = SingleFlight("account_history")
 
 
 class AccountHistory(object):
@@ -20,28 +31,44 @@ class AccountHistory(object):
 
     def set_workstation_by_ip(self, ip: str, workstation: str):
         key = ip + REDIS_KEY_LAST_WORKSTATION_IP_SUFFIX
-        self.redis.set_str_value(key, workstation, expire=60*60*24)
+        self._set_value(key, workstation)
 
     def set_ip_by_workstation(self, ip: str, workstation: str):
         key = workstation + REDIS_KEY_LAST_IP_WORKSTATION_SUFFIX
-        self.redis.set_str_value(key, ip, expire=60*60*24)
+        self._set_value(key, ip)
 
     def get_last_workstation_by_ip(self, ip: str) -> str:
         key = ip + REDIS_KEY_LAST_WORKSTATION_IP_SUFFIX
-        workstation = self.redis.get_str_value(key)
+        workstation = self._get_value(key)
         if workstation:
             return workstation
         else:
-            return self.search_last_workstation_by_ip(ip)
+            return history_flight.do(key, lambda: self.search_last_workstation_by_ip(ip))
 
     def get_last_ip_by_workstation(self, workstation: str) -> str:
         key = workstation + REDIS_KEY_LAST_IP_WORKSTATION_SUFFIX
-        ip = self.redis.get_str_value(key)
+        ip = self._get_value(key)
         if ip:
             return ip
         else:
             return self.search_last_ip_by_workstation(workstation)
 
+    def _get_value(self, key):
+        """
+            先查进程内缓存，再查redis
+        """
+        value = history_cache.get(key)
+        if value is not MISSING:
+            return value
+        value = self.redis.get_str_value(key)
+        if value is not None:
+            history_cache.set(key, value, HISTORY_LOCAL_EXPIRE_TIME)
+        return value
+
+    def _set_value(self, key, value):
+        self.redis.set_str_value(key, value, expire=HISTORY_REDIS_EXPIRE_TIME)
+        history_cache.set(key, value, HISTORY_LOCAL_EXPIRE_TIME)
+
     def search_last_workstation_by_ip(self, ip: str) -> str:
         query = {
             "query": get_must_statement(
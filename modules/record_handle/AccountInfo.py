@@ -5,6 +5,10 @@
 from models.User import User
 from modules.record_handle.AccountHistory import AccountHistory
 from tools.LDAPSearch import LDAPSearch
+from tools.common.DirectorySnapshot import directory
+from tools.common.GroupGraph import group_graph
+from tools.common.LocalCache import LocalCache, MISSING
+from tools.common.SingleFlight import SingleFlight
 from tools.database.ElsaticHelper import *
 from tools.database.RedisHelper import RedisHelper
 from settings.config import main_config
@@ -12,6 +16,16 @@ from tools.common.common import get_cn_from_dn, get_netbios_domain
 
 # 默认过期时间一天
 ACCOUNT_INFO_REDIS_EXPIRE_TIME = 60*60*24
+# 敏感账户缓存过期时间七天
+SENSITIVE_REDIS_EXPIRE_TIME = 60*60*24*7
+# 进程内缓存的最大键数
+ACCOUNT_INFO_LOCAL_CACHE_MAX_NUM = 100000
+# 进程内缓存的最长过期时间一分钟，失效通知与其它进程的并发读取交错时，旧值最多保留这么久
+ACCOUNT_INFO_LOCAL_EXPIRE_TIME = 60
+# 账户不存在的结果只缓存在进程内，过期时间十分钟
+ACCOUNT_INFO_NOT_FOUND_EXPIRE_TIME = 60*10
+# 账户不存在时进程内缓存的值
+NOT_FOUND = ""
 # 通过sid查username的键后缀
 REDIS_KEY_SID_USERNAME_SUFFIX = "_sid_to_username"
 # 通过username查sid的键后缀
@@ -36,42 +50,72 @@ REDIS_KEY_USERNAME_AES_SUPPORT_SUFFIX = "_username_aes_support"
 REDIS_KEY_SID_SENSITIVE_SUFFIX = "_sid_sensitive"
 
 
+account_cache = LocalCache("account_info", ACCOUNT_INFO_LOCAL_CACHE_MAX_NUM)
+# 同一个键的并发LDAP查询只执行一次
+account_flight = SingleFlight("account_info")
+
+
 class AccountInfo(object):
     def __init__(self):
         self.redis = RedisHelper()
         self.account_history = AccountHistory()
         self.es = ElasticHelper()
 
+    def _get_value(self, key):
+        """
+            先查进程内缓存，再查redis，redis中的值按剩余过期时间放入进程内缓存，最长 ACCOUNT_INFO_LOCAL_EXPIRE_TIME
+
+            :return: 缓存的值，不存在时返回 None，已确认账户不存在时返回 NOT_FOUND
+        """
+        value = account_cache.get(key)
+        if value is not MISSING:
+            return value
+        value, ttl = self.redis.get_str_value_with_ttl(key)
+        if value is not None:
+            account_cache.set(key, value, min(ttl, ACCOUNT_INFO_LOCAL_EXPIRE_TIME) if ttl > 0
+                              else ACCOUNT_INFO_LOCAL_EXPIRE_TIME)
+        return value
+
+    def _set_value(self, key, value, expire=None):
+        self.redis.set_str_value(key, value, expire=expire)
+        account_cache.set(key, value, min(expire or ACCOUNT_INFO_REDIS_EXPIRE_TIME, ACCOUNT_INFO_LOCAL_EXPIRE_TIME))
+
     def check_target_is_admin_by_sid(self, sid: str, domain: str) -> bool:
         """
             检查一个账户是否拥有管理员权限
         """
+        entry = directory.get_by_sid(domain, sid)
+        if entry is not None:
+            return entry.admin_count == 1
+
         key = sid + REDIS_KEY_SID_IS_ADMIN_SUFFIX
-        record = self.redis.get_str_value(key)
-        # 存在redis缓存记录
-        if record:
-            if record == "true":
-                return True
-            else:
-                return False
+        record = self._get_value(key)
         # 不存在 则通过ldap查询，再更新redis缓存
-        else:
-            ldap = LDAPSearch(domain)
-            user_entry = ldap.search_by_sid(sid=sid, attributes=["adminCount"])
-            if user_entry:
-                entry_attributes = user_entry.entry_attributes_as_dict
-                if len(entry_attributes["adminCount"]) > 0 and entry_attributes["adminCount"][0] == 1:
-                    self.redis.set_str_value(key, "true", expire=ACCOUNT_INFO_REDIS_EXPIRE_TIME)
-                    return True
-            self.redis.set_str_value(key, "false", expire=ACCOUNT_INFO_REDIS_EXPIRE_TIME)
-            return False
+        if not record:
+            record = account_flight.do(key, lambda: self._search_is_admin_by_sid(sid, domain, key))
+        return record == "true"
+
+    def _search_is_admin_by_sid(self, sid: str, domain: str, key: str) -> str:
+        ldap = LDAPSearch(domain)
+        user_entry = ldap.search_by_sid(sid=sid, attributes=["adminCount"])
+        if user_entry:
+            entry_attributes = user_entry.entry_attributes_as_dict
+            if len(entry_attributes["adminCount"]) > 0 and entry_attributes["adminCount"][0] == 1:
+                self._set_value(key, "true", expire=ACCOUNT_INFO_REDIS_EXPIRE_TIME)
+                return "true"
+        self._set_value(key, "false", expire=ACCOUNT_INFO_REDIS_EXPIRE_TIME)
+        return "false"
 
     def check_target_is_user_by_sid(self, sid: str, domain: str) -> bool:
         """
             检查目标账号是否为 OU=Users
         """
+        entry = directory.get_by_sid(domain, sid)
+        if entry is not None:
+            return "OU=Users" in entry.dn
+
         key = sid + REDIS_KEY_SID_IS_USERS_SUFFIX
-        record = self.redis.get_str_value(key)
+        record = self._get_value(key)
         # 存在redis缓存记录
         if record:
             if record == "true":
@@ -85,17 +129,21 @@ class AccountInfo(object):
             if user_entry:
                 dn = user_entry.entry_dn
                 if "OU=Users" in dn:
-                    self.redis.set_str_value(key, "true", expire=ACCOUNT_INFO_REDIS_EXPIRE_TIME)
+                    self._set_value(key, "true", expire=ACCOUNT_INFO_REDIS_EXPIRE_TIME)
                     return True
-            self.redis.set_str_value(key, "false", expire=ACCOUNT_INFO_REDIS_EXPIRE_TIME)
+            self._set_value(key, "false", expire=ACCOUNT_INFO_REDIS_EXPIRE_TIME)
             return False
 
     def check_target_is_user_by_name(self, user: str, domain: str) -> bool:
         """
             检查目标账号是否为 OU=Users
         """
+        entry = directory.get_by_name(domain, user)
+        if entry is not None:
+            return "OU=Users".lower() in entry.dn.lower() or "CN=Users".lower() in entry.dn.lower()
+
         key = user + REDIS_KEY_USERNAME_IS_USERS_SUFFIX
-        record = self.redis.get_str_value(key)
+        record = self._get_value(key)
         # 存在redis缓存记录
         if record:
             if record == "true":
@@ -109,23 +157,27 @@ class AccountInfo(object):
             if user_entry:
                 dn = str(user_entry.entry_dn)
                 if "OU=Users".lower() in dn.lower() or "CN=Users".lower() in dn.lower():
-                    self.redis.set_str_value(key, "true", expire=ACCOUNT_INFO_REDIS_EXPIRE_TIME)
+                    self._set_value(key, "true", expire=ACCOUNT_INFO_REDIS_EXPIRE_TIME)
                     return True
-            self.redis.set_str_value(key, "false", expire=ACCOUNT_INFO_REDIS_EXPIRE_TIME)
+            self._set_value(key, "false", expire=ACCOUNT_INFO_REDIS_EXPIRE_TIME)
             return False
 
     def get_user_info_by_name(self, user_name: str, domain: str) -> User:
         key = user_name + REDIS_KEY_USERNAME_SID_SUFFIX
-        # 先查redis
-        user_sid = self.redis.get_str_value(key)
-        # redis 缓存未命中 再查mongo
+        entry = directory.get_by_name(domain, user_name)
+        # 先查本地目录副本，再查redis
+        user_sid = entry.sid if entry is not None else self._get_value(key)
+        if user_sid == NOT_FOUND:
+            return
+        # redis 缓存未命中 再查ldap
         if not user_sid:
             ldap = LDAPSearch(domain)
             user_entry = ldap.search_by_name(user_name, attributes=["objectSid"])
             if not user_entry:
+                account_cache.set(key, NOT_FOUND, ACCOUNT_INFO_NOT_FOUND_EXPIRE_TIME)
                 return
             user_sid = user_entry.entry_attributes_as_dict["objectSid"][0]
-            self.redis.set_str_value(key, user_sid, expire=ACCOUNT_INFO_REDIS_EXPIRE_TIME)
+            self._set_value(key, user_sid, expire=ACCOUNT_INFO_REDIS_EXPIRE_TIME)
         user = User({
             "user_name": user_name,
             "user_sid": user_sid,
@@ -136,15 +188,13 @@ class AccountInfo(object):
 
     def get_user_info_by_sid(self, sid: str, domain: str) -> User:
         key = sid + REDIS_KEY_SID_USERNAME_SUFFIX
-        # 先查redis
-        user_name = self.redis.get_str_value(key)
-        if not user_name:
-            ldap = LDAPSearch(domain)
-            user_entry = ldap.search_by_sid(sid, attributes=["sAMAccountName"])
-            if not user_entry:
-                return None
-            user_name = user_entry.entry_attributes_as_dict["sAMAccountName"][0]
-            self.redis.set_str_value(key, user_name, expire=ACCOUNT_INFO_REDIS_EXPIRE_TIME)
+        entry = directory.get_by_sid(domain, sid)
+        # 先查本地目录副本，再查redis
+        user_name = entry.name if entry is not None else self._get_value(key)
+        if user_name is None:
+            user_name = account_flight.do(key, lambda: self._search_name_by_sid(sid, domain, key))
+        if user_name == NOT_FOUND:
+            return None
         user = User({
             "user_name": user_name,
             "user_sid": sid,
@@ -153,10 +203,25 @@ class AccountInfo(object):
         })
         return user
 
+    def _search_name_by_sid(self, sid: str, domain: str, key: str) -> str:
+        ldap = LDAPSearch(domain)
+        user_entry = ldap.search_by_sid(sid, attributes=["sAMAccountName"])
+        if not user_entry:
+            account_cache.set(key, NOT_FOUND, ACCOUNT_INFO_NOT_FOUND_EXPIRE_TIME)
+            return NOT_FOUND
+        user_name = user_entry.entry_attributes_as_dict["sAMAccountName"][0]
+        self._set_value(key, user_name, expire=ACCOUNT_INFO_REDIS_EXPIRE_TIME)
+        return user_name
+
     def check_target_is_aes_support(self, name: str, domain: str) -> bool:
+        entry = directory.get_by_name(domain, name)
+        if entry is not None:
+            # 等于8 支持AES128加密
+            return entry.enc_types is not None and entry.enc_types >= 8
+
         key = name + REDIS_KEY_USERNAME_AES_SUPPORT_SUFFIX
         # 先查redis
-        is_support = self.redis.get_str_value(key)
+        is_support = self._get_value(key)
         #
         if is_support is not None:
             return is_support == "true"
@@ -171,10 +236,10 @@ class AccountInfo(object):
             support_types = support_types[0]
             # 等于8 支持AES128加密
             if support_types >= 8:
-                self.redis.set_str_value(key, "true")
+                self._set_value(key, "true")
                 return True
             else:
-                self.redis.set_str_value(key, "false")
+                self._set_value(key, "false")
                 return False
 
     def user_is_sensitive_by_sid(self, sid: str, domain: str) -> bool:
@@ -182,7 +247,7 @@ class AccountInfo(object):
             检查某个用户是否为敏感用户
 
             1. adminCount 1
-            2. 属于敏感组
+            2. 属于敏感组 (本地关系图包括嵌套组)
             3. 蜜罐账户
             4. 自定义敏感用户
 
@@ -199,22 +264,29 @@ class AccountInfo(object):
             if user["sid"] == sid:
                 return True
 
+        # 本地目录副本和组成员关系图，包括嵌套在敏感组中的组
+        entry = directory.get_by_sid(domain, sid)
+        in_sensitive_group = group_graph.in_sensitive_group(domain, sid)
+        if entry is not None and in_sensitive_group is not None:
+            return entry.admin_count == 1 or in_sensitive_group
+
         # 先查缓存
         _cache_is_sensitive = self.get_target_sensitive_cache(sid)
         if _cache_is_sensitive is not None:
             return _cache_is_sensitive == "true"
 
         # LDAP 查询较慢，性能瓶颈
+        sensitive_key = sid + REDIS_KEY_SID_SENSITIVE_SUFFIX
         ldap = LDAPSearch(domain)
         user_entry = ldap.search_by_sid(sid, attributes=["adminCount", "memberOf"])
         if not user_entry:
-            self.set_target_sensitive_cache(sid, "false")
+            self._set_value(sensitive_key, "false", expire=SENSITIVE_REDIS_EXPIRE_TIME)
             return False
 
         # adminCount
         if len(user_entry.entry_attributes_as_dict["adminCount"]) > 0 and \
                 user_entry.entry_attributes_as_dict["adminCount"][0] == 1:
-            self.set_target_sensitive_cache(sid, "true")
+            self._set_value(sensitive_key, "true", expire=SENSITIVE_REDIS_EXPIRE_TIME)
             return True
 
         # 敏感组
@@ -223,9 +295,9 @@ class AccountInfo(object):
         for g in groups:
             g_name = get_cn_from_dn(g)
             if g_name in sensitive_groups:
-                self.set_target_sensitive_cache(sid, "true")
+                self._set_value(sensitive_key, "true", expire=SENSITIVE_REDIS_EXPIRE_TIME)
                 return True
-        self.set_target_sensitive_cache(sid, "false")
+        self._set_value(sensitive_key, "false", expire=SENSITIVE_REDIS_EXPIRE_TIME)
         return False
 
     def computer_is_sensitive_by_name(self, name: str, domain: str) -> bool:
@@ -248,12 +320,16 @@ class AccountInfo(object):
         return False
 
     def set_target_sensitive_cache(self, sid, value):
+        """
+            账户的敏感状态发生变化，同时使所有进程的进程内缓存失效
+        """
         key = sid + REDIS_KEY_SID_SENSITIVE_SUFFIX
-        self.redis.set_str_value(key, value, expire=60*60*24*7)
+        self.redis.set_str_value(key, value, expire=SENSITIVE_REDIS_EXPIRE_TIME)
+        account_cache.invalidate(key)
 
     def get_target_sensitive_cache(self, sid):
         key = sid + REDIS_KEY_SID_SENSITIVE_SUFFIX
-        data = self.redis.get_str_value(key)
+        data = self._get_value(key)
         return data
 
 
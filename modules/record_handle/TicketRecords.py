@@ -9,6 +9,7 @@ from settings.config import main_config
 from models.Kerberos import Kerberos
 from tools.common.common import utc_to_datetime, datetime_to_log_date, datetime_now_obj
 from tools.database.ElsaticHelper import *
+from tools.database.BulkIndexer import bulk_indexer
 from tools.database.RedisHelper import RedisHelper
 
 REDIS_TICKET_HASH_USERNAME_SUFFIX = "_ticket_hash_username"
@@ -26,9 +27,9 @@ class TicketRecords(object):
 
         index = ElasticConfig.krb5_ticket_write_index_prefix + datetime_to_log_date(datetime_now_obj())
         # 保存到ES中
-        self.es.delay_index(body=ticket_doc,
-                            index=index,
-                            doc_type=ElasticConfig.krb5_ticket_doc_type)
+        bulk_indexer.add(body=ticket_doc,
+                         index=index,
+                         doc_type=ElasticConfig.krb5_ticket_doc_type)
 
     def exist_ticket_by_hash(self, ticket_hash: str, ticket_type: str) -> bool:
         result = self.redis.get_str_value(ticket_hash)
@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+# coding: utf-8
+# author: 9ian1i   https://github.com/Qianlitp
+
+"""
+    离线回放与吞吐基准测试
+
+    将录制的事件日志 (每行一条JSON，格式与消息队列中的消息一致) 通过真实的检测模块回放，
+    ES、Mongo、Redis、LDAP 全部替换为内存实现，并可以为每次往返注入固定延迟。
+
+    输出：
+        1. 每秒处理事件数
+        2. 每个检测模块的调用次数、p50/p99/最大耗时
+        3. 平均每条事件的各后端往返次数
+
+    python3 scripts/benchmark.py -d corp.com -f events.ndjson --es-latency 2 --mongo-latency 1
+"""
+
+import os
+import sys
+import time
+import optparse
+import threading
+from datetime import datetime
+from collections import defaultdict
+
+import simplejson
+
+now_path = os.path.abspath(__file__)
+home_path = "/".join(now_path.split("/")[:-2])
+sys.path.append(home_path)
+
+# 必须在导入其它项目模块之前替换底层客户端
+from tools.database.ClientRegistry import install_clients
+from tools.database.MemoryBackend import BackendStats, MemoryElasticsearch, MemoryMongoClient, MemoryRedis, \
+    MemoryLDAP
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[int(round(q * (len(sorted_values) - 1)))]
+
+
+def load_events(file_list: list) -> list:
+    events = []
+    for file_name in file_list:
+        with open(file_name, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    events.append(simplejson.loads(line))
+    return events
+
+
+def parse_option():
+    parser = optparse.OptionParser(usage="Usage:  benchmark.py -d <domain> -f <events.ndjson> [options]")
+    parser.add_option("-d", "--domain", action="store", dest="domain", help="A FQDN domain name. e.g: corp.360.cn")
+    parser.add_option("-f", "--file", action="append", dest="files", default=[],
+                      help="Recorded events, one JSON document per line. Can be repeated.")
+    parser.add_option("--es-latency", action="store", dest="es_latency", type="float", default=0.0,
+                      help="Injected latency per Elasticsearch round trip, in ms.")
+    parser.add_option("--mongo-latency", action="store", dest="mongo_latency", type="float", default=0.0,
+                      help="Injected latency per MongoDB round trip, in ms.")
+    parser.add_option("--redis-latency", action="store", dest="redis_latency", type="float", default=0.0,
+                      help="Injected latency per Redis round trip, in ms.")
+    parser.add_option("--ldap-latency", action="store", dest="ldap_latency", type="float", default=0.0,
+                      help="Injected latency per LDAP round trip, in ms.")
+    parser.add_option("--ldap-json", action="store", dest="ldap_json",
+                      help="Optional directory entries exported by ldap3, loaded into the in-memory LDAP server.")
+    parser.add_option("--threads", action="store", dest="threads", type="int", default=None,
+                      help="Module threads per engine, default ENGINE_THREAD_NUM.")
+    parser.add_option("--batch", action="store", dest="batch", type="int", default=0,
+                      help="Replay in batches of this size using do_analyze_batch.")
+    parser.add_option("--learning", action="store_true", dest="learning", default=False,
+                      help="Keep the learning period active instead of moving it to the past.")
+    return parser
+
+
+def main():
+    parser = parse_option()
+    options, args = parser.parse_args()
+    if not options.domain or not options.files:
+        parser.print_help()
+        sys.exit(1)
+
+    stats = BackendStats()
+    es = MemoryElasticsearch(stats, options.es_latency / 1000)
+    install_clients(mongo=MemoryMongoClient(stats, options.mongo_latency / 1000),
+                    redis_client=MemoryRedis(stats, options.redis_latency / 1000),
+                    es=es)
+
+    from tools.common.common import get_dn_domain_name, get_netbios_domain
+    from tools.common.Logger import logger
+    import tools.LDAPSearch
+    ldap = MemoryLDAP([get_dn_domain_name(options.domain)], stats, options.ldap_latency / 1000, options.ldap_json)
+    tools.LDAPSearch.Connection = ldap.connection
+
+    from settings.config import notify_config_changed
+    from settings.database_config import ElasticConfig, MongoConfig
+    from tools.database.RedisHelper import RedisHelper
+    from tools.database.MongoHelper import MongoHelper
+    from scripts.init_settings import init_ldap_settings, init_default_settings, init_sensitive_groups
+    import start
+
+    events = load_events(options.files)
+    logger.info("loaded {count} events.".format(count=len(events)))
+
+    # 初始化配置，域控列表取自回放数据
+    init_ldap_settings(options.domain, "memory", "benchmark", "benchmark")
+    init_default_settings(options.domain)
+    init_sensitive_groups(options.domain)
+    redis = RedisHelper()
+    dc_names = sorted({e["computer_name"].split(".")[0] for e in events if "computer_name" in e})
+    redis.set_str_value("dc_name_list_setting", simplejson.dumps({get_netbios_domain(options.domain): dc_names}))
+    if not options.learning:
+        redis.set_str_value("learning_end_time_setting", "2000-01-01 00:00:00")
+    # 回放从空数据开始，滑动窗口计数覆盖全部回放事件
+    redis.set_str_value("brute_force_window_start", "2000-01-01 00:00:00")
+    notify_config_changed()
+
+    if options.threads is not None:
+        start.ENGINE_THREAD_NUM = options.threads
+    # 基准测试不输出监控指标文件，最近事件存储由回放直接写入
+    start.METRICS_FILE_DIR = ""
+    start.RECENT_EVENT_FEED = False
+    # 账户信息查询走内存LDAP，统计每条事件的LDAP开销
+    start.DIRECTORY_SNAPSHOT = False
+    start.recent_events.start(since=datetime.min)
+    engine = build_bench_engine()
+    engine.load()
+
+    stats.reset()
+    begin = time.perf_counter()
+    batch = []
+    for event in events:
+        # 模拟日志先于检测入库ES
+        if "@timestamp" in event:
+            index = ElasticConfig.event_log_write_index_prefix + event["@timestamp"][:10].replace("-", ".")
+            es.preload(index, ElasticConfig.event_log_doc_type, event)
+            start.recent_events.add(event)
+            start.logon_sessions.add(event)
+        if options.batch > 0:
+            batch.append(event)
+            if len(batch) >= options.batch:
+                engine.do_analyze_batch(batch)
+                batch = []
+        else:
+            try:
+                engine.do_analyze(event)
+            except Exception as e:
+                logger.error("analyze error: " + str(e))
+    if batch:
+        engine.do_analyze_batch(batch)
+    from tools.database.BulkIndexer import bulk_indexer
+    bulk_indexer.close()
+    elapsed = time.perf_counter() - begin
+
+    alerts = MongoHelper(MongoConfig.uri, MongoConfig.db, MongoConfig.alerts_collection)
+    report(len(events), elapsed, engine.latency, stats, alerts.get_handle().count_documents({}))
+
+
+def build_bench_engine():
+    """
+        检测引擎需要在替换客户端之后才能导入
+    """
+    import start
+
+    class BenchEngine(start.Engine):
+        """
+            记录每个检测模块每次运行的耗时
+        """
+        def __init__(self):
+            super().__init__()
+            self._latency_lock = threading.Lock()
+            self.latency = defaultdict(list)
+
+        def _run_module(self, m_object, data):
+            begin = time.perf_counter()
+            try:
+                super()._run_module(m_object, data)
+            finally:
+                cost = time.perf_counter() - begin
+                with self._latency_lock:
+                    self.latency[type(m_object).__name__].append(cost)
+    return BenchEngine()
+
+
+def report(event_count: int, elapsed: float, latency: dict, stats: BackendStats, alert_count: int):
+    print()
+    print("events: {count}  elapsed: {elapsed:.2f}s  events/sec: {eps:.1f}  alerts: {alerts}".format(
+        count=event_count, elapsed=elapsed, eps=event_count / elapsed if elapsed > 0 else 0, alerts=alert_count))
+
+    print()
+    print("{:<32}{:>10}{:>12}{:>12}{:>12}{:>12}".format("module", "calls", "p50(ms)", "p99(ms)", "max(ms)",
+                                                        "total(s)"))
+    rows = sorted(latency.items(), key=lambda x: -sum(x[1]))
+    for name, costs in rows:
+        costs = sorted(costs)
+        print("{:<32}{:>10}{:>12.3f}{:>12.3f}{:>12.3f}{:>12.3f}".format(
+            name, len(costs), percentile(costs, 0.5) * 1000, percentile(costs, 0.99) * 1000, costs[-1] * 1000,
+            sum(costs)))
+
+    print()
+    print("{:<12}{:<24}{:>12}{:>16}".format("backend", "operation", "calls", "per event"))
+    for (backend, op), count in sorted(stats.counts.items(), key=lambda x: (x[0][0], -x[1])):
+        print("{:<12}{:<24}{:>12}{:>16.3f}".format(backend, op, count, count / max(event_count, 1)))
+    for backend in ("es", "mongo", "redis", "ldap"):
+        total = stats.total(backend)
+        print("{:<12}{:<24}{:>12}{:>16.3f}".format(backend, "TOTAL", total, total / max(event_count, 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+# coding: utf-8
+# author: 9ian1i   https://github.com/Qianlitp
+
+"""
+    按天索引的生命周期管理，每天执行一次
+
+    1. 删除超过最大保留期限的全部索引，不只是恰好到期的那一天，定时任务漏跑也不会留下过期索引
+    2. 不再写入的索引 (WARM_AFTER_DAYS 天之前) 转为只读：
+        - 刷新间隔调大，副本数调小
+        - 收缩到 SHRINK_SHARDS 个分片，收缩后的索引名为 原索引名 + SHRINK_SUFFIX，
+          原索引名作为新索引的别名，按日期拼接索引名的查询不受影响
+        - 合并段到 FORCE_MERGE_SEGMENTS 个
+        - 禁止写入
+
+    每一步是否需要执行由索引的实际状态 (分片数、收缩后的索引是否存在、是否已禁止写入) 决定，
+    过程中断时下次执行会继续完成：
+        - 收缩失败时取消分片分配限制，下次执行重新收缩
+        - 收缩后的索引已存在时，只完成合并和替换
+        - 不需要收缩的索引在合并完成后才禁止写入
+"""
+import os
+import sys
+from datetime import datetime
+
+now_path = os.path.abspath(__file__)
+home_path = "/".join(now_path.split("/")[:-2])
+sys.path.append(home_path)
+
+from tools.database.ElsaticHelper import ElasticHelper
+from settings.config import main_config
+from settings.database_config import ElasticConfig
+from tools.common.common import datetime_now_obj, datetime_utc_now_obj
+from elasticsearch5.exceptions import NotFoundError
+
+from tools.common.Logger import logger
+
+# 超过多少天的索引不再写入，当天和前一天的索引仍可能收到延迟的日志
+WARM_AFTER_DAYS = 2
+# 只读索引的分片数、副本数和刷新间隔
+SHRINK_SHARDS = 1
+WARM_REPLICAS = 0
+WARM_REFRESH_INTERVAL = "60s"
+# 只读索引合并后的段数
+FORCE_MERGE_SEGMENTS = 1
+# 收缩后的索引名后缀
+SHRINK_SUFFIX = "_shrink"
+# 等待分片分配完成的最长时间
+WAIT_TIMEOUT = "30m"
+
+
+def main():
+    logger.info("run scheduled task: index lifecycle")
+    es = ElasticHelper()
+    raw_data_expire = main_config.raw_data_expire
+    # 索引前缀 -> (最大保留天数, 是否按本地日期划分)
+    # 事件日志和流量由 logstash 按UTC日期写入，用户活动和票据记录按本地日期写入
+    lifecycle_map = {
+        ElasticConfig.event_log_write_index_prefix: (raw_data_expire["dc_log"], False),
+        ElasticConfig.traffic_write_index_prefix: (raw_data_expire["dc_krb5"], False),
+        ElasticConfig.krb5_ticket_write_index_prefix: (raw_data_expire["krb5_ticket"], True),
+        ElasticConfig.user_activity_write_index_prefix: (raw_data_expire["user_activity"], True)
+    }
+
+    for index_prefix, (expire, local_date) in lifecycle_map.items():
+        today = (datetime_now_obj() if local_date else datetime_utc_now_obj()).date()
+        try:
+            indices = list_indices(es, index_prefix)
+        except NotFoundError:
+            continue
+        for index_name, (index_date, settings) in sorted(indices.items()):
+            age = (today - index_date).days
+            try:
+                if age >= int(expire):
+                    es.delete_index(index_name)
+                    logger.info("delete index {name} successfully.".format(name=index_name))
+                elif age >= WARM_AFTER_DAYS:
+                    to_warm(es, index_name, settings, indices)
+            except Exception as e:
+                logger.error("index lifecycle error: {name} {error}".format(name=index_name, error=str(e)))
+
+
+def list_indices(es: ElasticHelper, index_prefix) -> dict:
+    """
+        :return: 索引名 -> (索引日期, 索引设置)，忽略名称中没有日期的索引
+    """
+    result = {}
+    rsp = es.get_settings(index=index_prefix + "*", flat_settings=True)
+    for index_name, value in rsp.items():
+        try:
+            index_date = datetime.strptime(index_name[len(index_prefix):len(index_prefix) + 10], "%Y.%m.%d").date()
+        except ValueError:
+            continue
+        result[index_name] = (index_date, value["settings"])
+    return result
+
+
+def to_warm(es: ElasticHelper, index_name, settings: dict, indices: dict):
+    if index_name.endswith(SHRINK_SUFFIX):
+        source = index_name[:-len(SHRINK_SUFFIX)]
+        if source in indices:
+            # 上次收缩未完成
+            finish_shrink(es, source, index_name)
+        return
+    if index_name + SHRINK_SUFFIX in indices:
+        # 由收缩后的索引继续处理
+        return
+
+    shards = int(settings.get("index.number_of_shards", SHRINK_SHARDS))
+    if shards > SHRINK_SHARDS and shards % SHRINK_SHARDS == 0:
+        # 收缩要求原索引禁止写入
+        _set_warm_settings(es, index_name, block_write=True)
+        shrink(es, index_name, index_name + SHRINK_SUFFIX)
+        return
+
+    if settings.get("index.blocks.write") == "true":
+        # 已完成合并
+        return
+    _set_warm_settings(es, index_name, block_write=False)
+    es.force_merge(index=index_name, max_num_segments=FORCE_MERGE_SEGMENTS)
+    logger.info("force merge index {name} successfully.".format(name=index_name))
+    es.put_settings(index=index_name, body={"index.blocks.write": True})
+    logger.info("set index {name} read-only.".format(name=index_name))
+
+
+def _set_warm_settings(es: ElasticHelper, index_name, block_write: bool):
+    body = {
+        "index.refresh_interval": WARM_REFRESH_INTERVAL,
+        "index.number_of_replicas": WARM_REPLICAS
+    }
+    if block_write:
+        body["index.blocks.write"] = True
+    es.put_settings(index=index_name, body=body)
+
+
+def shrink(es: ElasticHelper, source, target):
+    """
+        收缩要求每个分片都有一份副本位于同一个节点，先将索引全部分配到剩余磁盘空间最大的数据节点
+    """
+    es.put_settings(index=source, body={"index.routing.allocation.require._name": _select_node(es)})
+    try:
+        _wait_for_green(es, source)
+        aliases = es.get_alias(index=source).get(source, {}).get("aliases", {})
+        es.shrink(index=source, target=target, body={
+            "settings": {
+                "index.number_of_shards": SHRINK_SHARDS,
+                "index.number_of_replicas": WARM_REPLICAS,
+                "index.refresh_interval": WARM_REFRESH_INTERVAL,
+                "index.routing.allocation.require._name": None,
+                "index.blocks.write": True
+            },
+            "aliases": aliases
+        })
+    except Exception:
+        # 收缩后的索引未创建时取消分配限制，下次执行重新选择节点并收缩，已创建时由下次执行继续完成
+        if not es.exists_index(target):
+            es.put_settings(index=source, body={"index.routing.allocation.require._name": None})
+        raise
+    logger.info("shrink index {source} to {target}.".format(source=source, target=target))
+    finish_shrink(es, source, target)
+
+
+def finish_shrink(es: ElasticHelper, source, target):
+    _wait_for_green(es, target)
+    es.force_merge(index=target, max_num_segments=FORCE_MERGE_SEGMENTS)
+    # 删除原索引并将原索引名作为新索引的别名，在同一个请求中完成
+    es.update_aliases(body={
+        "actions": [
+            {"remove_index": {"index": source}},
+            {"add": {"index": target, "alias": source}}
+        ]
+    })
+    logger.info("replace index {source} with {target} successfully.".format(source=source, target=target))
+
+
+def _select_node(es: ElasticHelper) -> str:
+    nodes = es.nodes_stats(metric="fs")["nodes"].values()
+    data_nodes = [node for node in nodes if "data" in node.get("roles", ["data"])]
+    node = max(data_nodes, key=lambda x: x["fs"]["total"]["available_in_bytes"])
+    return node["name"]
+
+
+def _wait_for_green(es: ElasticHelper, index_name):
+    rsp = es.cluster_health(index=index_name, wait_for_status="green", wait_for_no_relocating_shards=True,
+                            timeout=WAIT_TIMEOUT)
+    if rsp.get("timed_out"):
+        raise TimeoutError("wait for index {name} green timeout".format(name=index_name))
+
+
+if __name__ == '__main__':
+    main()
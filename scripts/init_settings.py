@@ -22,6 +22,7 @@ from crontab import CronTab
 from ldap3 import Entry
 from settings.default_settings import default_settings, default_sensitive_groups
 from tools.database.RedisHelper import RedisHelper
+from settings.config import notify_config_changed
 
 
 REDIS_KEY_SUFFIX = "_setting"
@@ -66,6 +67,7 @@ def init_ldap_settings(domain, server, user, password):
     }, upsert=True)
     redis = RedisHelper()
     redis.set_str_value("ldap" + REDIS_KEY_SUFFIX, simplejson.dumps(doc))
+    notify_config_changed()
 
 
 def init_default_settings(domain):
@@ -102,6 +104,7 @@ def init_default_settings(domain):
             redis.set_str_value(key, simplejson.dumps(value))
         elif isinstance(value, int):
             redis.set_str_value(key, str(value))
+    notify_config_changed()
 
 
 def set_learning_end_time_setting():
@@ -119,6 +122,7 @@ def set_learning_end_time_setting():
     }, upsert=True)
     key = name + REDIS_KEY_SUFFIX
     redis.set_str_value(key, datetime_to_common_str(value))
+    notify_config_changed()
 
 
 def init_sensitive_groups(domain):
@@ -147,6 +151,7 @@ def init_sensitive_groups(domain):
         }
     }, upsert=True)
     redis.set_str_value("sensitive_entry" + REDIS_KEY_SUFFIX, simplejson.dumps(sensitive_entry))
+    notify_config_changed()
 
 
 def check_es_template() -> bool:
@@ -212,6 +217,7 @@ def get_all_dc_names(domain: str):
     }, True)
     redis = RedisHelper()
     redis.set_str_value("dc_name_list" + REDIS_KEY_SUFFIX, simplejson.dumps(doc))
+    notify_config_changed()
 
 
 def get_all_constrained_delegation_users(domain: str):
@@ -276,13 +282,14 @@ def load_settings():
             redis.set_str_value(key, simplejson.dumps(each["value"]))
         else:
             redis.set_str_value(key, each["value"])
+    notify_config_changed()
 
 
 def set_crontab_tasks():
     """
         设置定时任务：
 
-        1. 定期删除过期的ES索引
+        1. 按天索引的生命周期管理，删除过期索引、不再写入的索引转为只读
         2. 定时扫描万能钥匙
     """
     logger.info("set crontab tasks.")
@@ -297,16 +304,16 @@ def set_crontab_tasks():
     logger.info("set skeleton_key_scan every 2 min.")
     # my_user_cron.remove(skeleton_job)
 
-    # 定时删除过期索引 每天删除
-    delete_index_job = my_user_cron.new(
-        command='/usr/bin/python3 {project_dir}/scripts/delete_index.py >/dev/null 2>&1'
+    # 索引生命周期管理 每天执行
+    index_lifecycle_job = my_user_cron.new(
+        command='/usr/bin/python3 {project_dir}/scripts/index_lifecycle.py >/dev/null 2>&1'
         .format(project_dir=project_dir))
-    delete_index_job.day.every(1)
-    delete_index_job.hour.on(0)
-    delete_index_job.minute.on(0)
-    delete_index_job.set_comment("delete_index_job")
-    logger.info("set delete_index_job every day.")
-    # my_user_cron.remove(delete_index_job)
+    index_lifecycle_job.day.every(1)
+    index_lifecycle_job.hour.on(0)
+    index_lifecycle_job.minute.on(0)
+    index_lifecycle_job.set_comment("index_lifecycle_job")
+    logger.info("set index_lifecycle_job every day.")
+    # my_user_cron.remove(index_lifecycle_job)
 
     my_user_cron.write()
 
@@ -6,35 +6,126 @@
     全局配置文件
 
     为了在不重启检测引擎的情况下改变配置  所有配置信息都保存在redis缓存中 热修改读取
+
+    检测模块在每条事件中都会多次读取配置，进程内保存一份配置快照，以下情况快照失效、重新从redis读取：
+      1. 收到配置更新的发布订阅通知，或者redis的 *_setting 键空间通知
+      2. 定期检查到配置版本号发生变化
+      3. 快照超过最长有效期，兼容未更新版本号的写入方
+    修改配置后应调用 notify_config_changed
 """
+import time
+import threading
 import simplejson
 from datetime import datetime
 from tools.database.RedisHelper import RedisHelper
 
+# 配置版本号，每次修改配置后自增
+REDIS_KEY_CONFIG_VERSION = "config_version"
+# 配置更新通知的频道
+REDIS_CHANNEL_CONFIG_UPDATE = "config_update"
+# 配置键的后缀
+REDIS_KEY_SETTING_SUFFIX = "_setting"
+# 检查配置版本号的间隔，单位秒
+CONFIG_VERSION_CHECK_INTERVAL = 5
+# 配置快照最长有效期，单位秒
+CONFIG_SNAPSHOT_MAX_AGE = 60
+
 
 class GetConfig(object):
     def __init__(self):
         self.redis = RedisHelper()
+        self._snapshot = {}
+        self._snapshot_time = 0
+        self._version = None
+        self._version_check_time = 0
+        self._lock = threading.Lock()
+        self._listener = None
 
     def get_str(self, key) -> str:
-        return self.redis.get_str_value(key)
+        return self._get("str", key, self.redis.get_str_value)
 
     def get_int(self, key) -> int:
-        return int(self.redis.get_str_value(key))
+        return self._get("int", key, lambda k: int(self.redis.get_str_value(k)))
 
     def get_dict(self, key) -> dict:
-        return simplejson.loads(self.redis.get_str_value(key))
+        return self._get("obj", key, lambda k: simplejson.loads(self.redis.get_str_value(k)))
 
     def get_obj(self, key):
-        return simplejson.loads(self.redis.get_str_value(key))
+        return self._get("obj", key, lambda k: simplejson.loads(self.redis.get_str_value(k)))
 
     def get_list(self, key) -> list:
-        return self.redis.get_all_list(key)
+        return self._get("list", key, self.redis.get_all_list)
+
+    def get_datetime(self, key) -> datetime:
+        return self._get("datetime", key, lambda k: str_to_datetime(self.redis.get_str_value(k)))
+
+    def invalidate(self):
+        """
+            丢弃当前配置快照
+        """
+        self._snapshot = {}
+        self._snapshot_time = time.monotonic()
+
+    def _get(self, value_type, key, loader):
+        self._start_listener()
+        self._check_version()
+        snapshot = self._snapshot
+        cache_key = (value_type, key)
+        if cache_key in snapshot:
+            return snapshot[cache_key]
+        value = loader(key)
+        snapshot[cache_key] = value
+        return value
+
+    def _check_version(self):
+        now = time.monotonic()
+        if now - self._snapshot_time > CONFIG_SNAPSHOT_MAX_AGE:
+            self.invalidate()
+            return
+        if now - self._version_check_time < CONFIG_VERSION_CHECK_INTERVAL:
+            return
+        self._version_check_time = now
+        version = self.redis.get_str_value(REDIS_KEY_CONFIG_VERSION)
+        if version != self._version:
+            self._version = version
+            self.invalidate()
+
+    def _start_listener(self):
+        if self._listener is not None:
+            return
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name="config_listener", daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        """
+            订阅配置更新通知，连接断开后重连，重连期间的更新由版本号检查兜底
+        """
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                pubsub.subscribe(REDIS_CHANNEL_CONFIG_UPDATE)
+                pubsub.psubscribe("__keyspace@*__:*" + REDIS_KEY_SETTING_SUFFIX)
+                self.invalidate()
+                for _ in pubsub.listen():
+                    self.invalidate()
+            except Exception as e:
+                time.sleep(CONFIG_VERSION_CHECK_INTERVAL)
 
 
 config_redis = GetConfig()
 
 
+def notify_config_changed():
+    """
+        修改redis中的配置后调用，更新版本号并通知所有检测进程
+    """
+    version = config_redis.redis.incr(REDIS_KEY_CONFIG_VERSION)
+    config_redis.redis.publish(REDIS_CHANNEL_CONFIG_UPDATE, version)
+    config_redis.invalidate()
+
+
 def str_to_datetime(utc_str):
     """
         字符串时间转化为datetime对象
@@ -50,7 +141,7 @@ class MainConfig(object):
     # NTLMRelay GoldenTicket UnknownFileShare
     @property
     def learning_end_time(self) -> datetime:
-        return str_to_datetime(config_redis.get_str("learning_end_time_setting"))
+        return config_redis.get_datetime("learning_end_time_setting")
 
     # 需要分析的域名列表
     @property
@@ -10,6 +10,30 @@ class ElasticConfig(object):
     # 修改ES配置信息
     host = "127.0.0.1:9200"
     uri = "http://{host}/".format(host=host)
+    # 每个进程到单个ES节点的最大连接数
+    max_connections = 32
+
+    # -----------后台批量写入-------------
+    # 用户活动、票据记录通过进程内的后台线程批量写入，满足任一条件即提交
+    bulk_max_docs = 500
+    bulk_max_bytes = 5 * 1024 * 1024
+    bulk_flush_interval = 5
+    # 待写入数据的内存上限，超出后写入方阻塞等待
+    bulk_queue_max_bytes = 50 * 1024 * 1024
+    # 被拒绝或请求失败时的最大重试次数，间隔指数退避
+    bulk_max_retries = 5
+
+    # -----------检索请求合并-------------
+    # 同一进程内在该时间窗口内发起的检索合并为一次 _msearch 请求，单位秒，0 为关闭
+    search_batch_window = 0.002
+    # 单次 _msearch 最多合并的检索数
+    search_batch_size = 50
+    # 并发发送 _msearch 请求的线程数
+    search_batch_senders = 4
+
+    # -----------事件日志索引-------------
+    # 新建的事件日志索引按 @timestamp、computer_name 排序 (index sorting)，需要 ES 6.0 以上版本
+    event_log_index_sort = False
 
     # -----------下方名称默认即可-------------
     event_log_index = "dc_log_all"
@@ -36,6 +60,8 @@ class MongoConfig(object):
     user = "WatchAD"
     password = "WatchAD-by-0KEE"
     uri = "mongodb://{user}:{password}@{host}/".format(host=host, user=user, password=password)
+    # 每个进程的最大连接数
+    max_pool_size = 100
 
     # -----------下方名称默认即可-------------
     db = "WatchAD"
@@ -57,6 +83,9 @@ class RedisConfig(object):
     """
     host = "127.0.0.1"
     port = 6379
+    # 每个进程的最大连接数，以及连接用尽时的等待时间(秒)
+    max_connections = 100
+    pool_timeout = 20
 
 
 # rabbit mq
@@ -75,3 +104,47 @@ class MqConfig(object):
     exchange = "WatchAD"
     exchange_type = "fanout"
 
+    # -----------批量消费模式-------------
+    # 开启后按批次消费消息，整批检测和告警入库完成后再手动确认，进程异常退出时未确认的消息会重新投递
+    batch_mode = False
+    # 预取窗口大小，批量模式下至少为 batch_size
+    prefetch_count = 200
+    # 单个批次的最大消息数
+    batch_size = 100
+    # 批次最长等待时间，单位秒，未攒满也会提交处理
+    batch_timeout = 1
+    # --------------------------------------
+
+    # asyncio 引擎同时处理中的最大消息数，即预取窗口大小
+    async_max_in_flight = 500
+
+    # -----------按键分片模式-------------
+    # 开启后由单独的路由进程消费主队列，按分片键将事件转发到每个引擎进程独占的队列，
+    # 同一来源的事件总是由同一个进程处理，进程内可以直接保存关联状态
+    shard_mode = False
+    # 分片键 source_ip: 来源IP  logon_id: 域控+登录会话ID  computer_name: 域控计算机名
+    shard_key = "source_ip"
+    shard_exchange = "WatchAD_shard"
+    shard_queue_prefix = "watch_ad_analytics_shard_"
+    # 一致性哈希环上每个进程的虚拟节点数，进程数变化时只有少部分分片键会迁移
+    shard_virtual_nodes = 64
+    # 进程数减少后，检查并迁移多余分片队列的最大序号
+    shard_max_queue_num = 64
+    # --------------------------------------
+
+
+# ldap
+class LdapConfig(object):
+    """
+        LDAP连接池配置，域控地址和账号在初始化时写入配置信息
+    """
+    # 每个进程对每个域的最大连接数，以及连接用尽时的等待时间(秒)
+    pool_size = 10
+    pool_timeout = 20
+    # 连接空闲超过该时间后，取出时先检查是否可用，单位秒
+    idle_check_interval = 60
+    # 建立连接和等待响应的超时时间，单位秒
+    connect_timeout = 5
+    receive_timeout = 30
+    # 是否在建立连接时从域控读取 schema 和 DSA 信息，关闭时使用 ldap3 内置的 AD schema
+    read_schema = False
@@ -2,17 +2,77 @@
 # coding: utf-8
 # author: 9ian1i   https://github.com/Qianlitp
 
-dc_log_template = {
-    "template": "dc_log_*",
-    "order": 1,
-    "settings": {
+from settings.database_config import ElasticConfig
+
+# 检测模块通过 term/terms/wildcard/聚合 查询的 event_data 字段，只建立 keyword 索引
+# 查询语句使用 event_data.<字段>.keyword，与动态映射生成的旧索引保持一致，新增查询字段时需要加入此列表
+EVENT_DATA_KEYWORD_FIELDS = (
+    "AuditSourceName", "IpAddress", "LmPackageName", "NewProcessName", "ProcessName", "RelativeTargetName",
+    "ShareName", "Status", "SubjectLogonId", "SubjectUserName", "TargetLogonId", "TargetUserName",
+    "WorkstationName"
+)
+# 通过 match 查询 (分词、忽略大小写) 的 event_data 字段
+EVENT_DATA_TEXT_FIELDS = ("ObjectName",)
+# 只保存在 _source 中、不建立索引的大文本字段
+EVENT_DATA_SOURCE_ONLY_FIELDS = ("TaskContent", "TaskContentNew")
+# 其它字符串字段超过该长度时不建立索引
+KEYWORD_IGNORE_ABOVE = 1024
+
+
+def get_event_data_mapping() -> dict:
+    """
+        生成 event_data 的映射，不再由动态映射为每个字段同时建立 text 和 keyword 索引
+    """
+    properties = {}
+    for field in EVENT_DATA_KEYWORD_FIELDS:
+        # 字段本身不建索引，只保留查询使用的 .keyword 子字段
+        properties[field] = {
+            "type": "keyword",
+            "index": False,
+            "doc_values": False,
+            "fields": {
+                "keyword": {"type": "keyword", "ignore_above": KEYWORD_IGNORE_ABOVE}
+            }
+        }
+    for field in EVENT_DATA_TEXT_FIELDS:
+        properties[field] = {"type": "text"}
+    for field in EVENT_DATA_SOURCE_ONLY_FIELDS:
+        properties[field] = {"type": "keyword", "index": False, "doc_values": False}
+    return {
+        "properties": properties
+    }
+
+
+def get_event_log_settings() -> dict:
+    settings = {
         "number_of_shards": 10,
         "number_of_replicas": 1,
         "index.refresh_interval": "1s"
-    },
+    }
+    if ElasticConfig.event_log_index_sort:
+        # 同一时间段、同一域控的事件在磁盘上相邻，按时间范围和域控的查询可以提前结束
+        settings["index.sort.field"] = ["@timestamp", "computer_name"]
+        settings["index.sort.order"] = ["desc", "asc"]
+    return settings
+
+
+dc_log_template = {
+    "template": "dc_log_*",
+    "order": 1,
+    "settings": get_event_log_settings(),
     "mappings": {
         "security_log": {
             "include_in_all": "false",
+            "dynamic_templates": [
+                {
+                    # 未列出的 event_data 字段只建立 keyword 索引，不再分词
+                    "event_data_strings": {
+                        "path_match": "event_data.*",
+                        "match_mapping_type": "string",
+                        "mapping": {"type": "keyword", "ignore_above": KEYWORD_IGNORE_ABOVE}
+                    }
+                }
+            ],
             "properties": {
                 "task": {"type": "keyword"},
                 "event_id": {"type": "integer"},
@@ -25,10 +85,9 @@ dc_log_template = {
                 "opcode": {"type": "keyword"},
                 "thread_id": {"type": "keyword"},
                 "host": {"type": "keyword"},
-                "event_data": {
-                    "properties": {}
-                },
-                "message": {"type": "keyword"},
+                "event_data": get_event_data_mapping(),
+                # 事件的完整描述文本，只保存在 _source 中
+                "message": {"type": "keyword", "index": False, "doc_values": False},
                 "version": {"type": "integer"},
                 "@timestamp": {"type": "date"}
             }
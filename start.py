@@ -10,29 +10,74 @@
     -> 启动消费者
 
     -> 注册回调
+
+    python3 start.py          多进程检测引擎，每个进程逐条或按批次消费
+    python3 start.py shard N  分片模式下的第N个检测引擎进程，只消费自己的分片队列，未开启分片模式时同上
+    python3 start.py router   分片模式下的路由进程，单进程运行
+    python3 start.py async [N]  基于 asyncio 事件循环的检测引擎，单进程同时处理多条消息，分片模式下消费第N个分片队列
+    python3 start.py delay    延迟检测，单进程运行
 """
 
+import os
 import sys
 import time
+import asyncio
+import traceback
 from models.Log import Log
 # from models.Kerberos import Kerberos
 from tools.common.common import get_walk_files, format_module_path, datetime_now_obj
 from tools.common.Logger import logger
+from tools.common.KeyedExecutor import KeyedExecutor
+from tools.common.Metrics import metrics, start_stats_file, start_http_server
+from tools.common.RecentEventStore import recent_events
+from tools.common.LogonSessionTable import logon_sessions
+from tools.common.DirectorySnapshot import directory
 from tools.database.Consumer import Consumer
+from tools.database.AsyncConsumer import AsyncConsumer
+from tools.database.ShardRouter import ShardRouter
+from tools.database.EventFeed import EventFeed
+from tools.database.BulkIndexer import install_signal_handlers
 from tools.database.MongoHelper import MongoHelper
-from settings.database_config import MongoConfig
+from settings.database_config import MongoConfig, MqConfig
 from modules.alert.alert import Alert
 from _project_dir import project_dir
 
+# 每个引擎进程内并发执行检测模块的线程数，小于等于1时退化为串行执行
+ENGINE_THREAD_NUM = 8
+# asyncio 引擎执行检测模块的线程数，模块内部多为阻塞IO，可以设置得更大
+ENGINE_ASYNC_THREAD_NUM = 32
+# 监控指标文件的输出目录和间隔(秒)，目录为空时不输出
+METRICS_FILE_DIR = project_dir + "/metrics"
+METRICS_FILE_INTERVAL = 30
+# 监控指标 HTTP 端口，0 表示不开启，多个进程依次使用后续端口
+METRICS_HTTP_PORT = 0
+# 每个进程单独接收全部事件保存到最近事件存储，向前查找优先在内存中完成
+RECENT_EVENT_FEED = True
+# 每个进程在本地保存域目录副本并定时增量同步，账户信息查询优先在本地完成
+DIRECTORY_SNAPSHOT = True
+
 
 class Engine(object):
-    def __init__(self):
+    def __init__(self, shard_index=None):
+        """
+            :param shard_index: 分片模式下当前进程的分片序号
+        """
+        self.shard_index = shard_index if MqConfig.shard_mode else None
         self.event_log_modules_map = None
         # self.traffic_kerberos_modules_map = None
         self.mongo = MongoHelper(MongoConfig.uri, MongoConfig.db, MongoConfig.delay_run_collection)
         self.alert = Alert()
+        self.executor = KeyedExecutor(ENGINE_THREAD_NUM) if ENGINE_THREAD_NUM > 1 else None
 
     def load(self):
+        self._start_metrics()
+        # 退出前写完批量写入队列中的剩余数据
+        install_signal_handlers()
+        if RECENT_EVENT_FEED:
+            EventFeed(recent_events, logon_sessions).start()
+        if DIRECTORY_SNAPSHOT:
+            directory.start()
+
         # 加载事件日志检测模块
         logger.info("loading detect modules based on event_log")
         self.event_log_modules_map = self._load_module("event_log", "EVENT_ID")
@@ -48,11 +93,17 @@ class Engine(object):
         self.load()
 
         # 启动消费者
-        c = Consumer()
+        c = Consumer(self.shard_index)
         # 注册回调
         logger.info("start MQ consumer and register callback func.")
+        if self.shard_index is not None:
+            logger.info("consume shard queue: " + c.queue)
         logger.info("status: main process running")
-        c.run(self.do_analyze)
+        if MqConfig.batch_mode:
+            logger.info("consume in batch mode, batch size: {size}".format(size=MqConfig.batch_size))
+            c.run_batch(self.do_analyze_batch)
+        else:
+            c.run(self.do_analyze)
 
     def delay_run(self):
         """
@@ -73,12 +124,39 @@ class Engine(object):
                 #                       alert_code=alert_code)
                 if data["type"] == "wineventlog":
                     log = Log(data)
-                    self._run_analyze(data=log, data_type=log.event_id, modules_map=self.event_log_modules_map,
-                                      alert_code=alert_code)
+                    module_list = self.event_log_modules_map.get(log.event_id, [])
+                    self._wait(self._run_analyze(data=log, module_list=module_list, alert_code=alert_code))
             # 删除完成检测数据
             self._clear_confirmed_data(data_list)
 
+    @staticmethod
+    def _start_metrics():
+        if METRICS_FILE_DIR:
+            start_stats_file(METRICS_FILE_DIR, METRICS_FILE_INTERVAL)
+        if METRICS_HTTP_PORT:
+            start_http_server(METRICS_HTTP_PORT)
+
     def do_analyze(self, data: dict):
+        self._wait(self._analyze(data))
+
+    def do_analyze_batch(self, data_list: list):
+        """
+            批量检测，同一批次的不同事件可以并发执行，单条消息的异常不影响同批次其它消息
+        """
+        futures = []
+        for data in data_list:
+            try:
+                futures.extend(self._analyze(data))
+            except Exception as e:
+                traceback.print_exc()
+        self._wait(futures)
+
+    def _analyze(self, data: dict) -> list:
+        """
+            分发单条数据到检测模块
+
+            :return: 已提交检测任务的 Future 列表
+        """
         # 解析krb5流量
         # if data["type"] == "krb5":
         #     krb = Kerberos(data)
@@ -87,36 +165,78 @@ class Engine(object):
         #     self._run_analyze(data=krb, data_type=krb.msg_type, modules_map=self.traffic_kerberos_modules_map)
         # 解析事件日志
         if data["type"] == "wineventlog":
+            metrics.inc("watchad_events_total", (("event_id", data["event_id"]),))
+            logon_sessions.share(data)
             if data["event_id"] == 4662:
-                return
+                return []
             if "event_data" not in data and data["event_id"] != 1100:
-                return
+                return []
+            # 在构建Log对象之前，用各模块声明的预过滤条件筛选出需要运行的模块
+            module_list = self._match_modules(self.event_log_modules_map, data["event_id"], data.get("event_data", {}))
+            if not module_list:
+                return []
             log = Log(data)
-            if log.event_id not in self.event_log_modules_map:
-                return
-            self._run_analyze(data=log, data_type=log.event_id, modules_map=self.event_log_modules_map)
+            return self._run_analyze(data=log, module_list=module_list)
+        return []
 
-    def _run_analyze(self, data, data_type, modules_map: dict, alert_code=None):
+    @staticmethod
+    def _match_modules(modules_map: dict, data_type, event_data: dict) -> list:
+        """
+            根据分发表和原始的 event_data 筛选需要运行的模块
+        """
+        if data_type not in modules_map:
+            return []
+        return [m for m in modules_map[data_type] if m["prefilter"] is None or m["prefilter"](event_data)]
+
+    def _run_analyze(self, data, module_list: list, alert_code=None):
         """
             运行检测模块
         :param data: 数据字典
-        :param data_type: log.event_id 的值或者 krb.msg_type
-        :param modules_map: 加载了检测模块的字典
+        :param module_list: 需要运行的检测模块列表
         :param alert_code:  可选，具体检测的告警代码，指定了之后只运行该模块
-        :return:
+        :return: 已提交检测任务的 Future 列表，串行执行时为空
         """
-        module_list = modules_map[data_type]
+        futures = []
         for module in module_list:
             code = module["code"]
             if alert_code and alert_code != code:
                 continue
             m_object = module["object"]
-            # 运行检测模块的语句
-            alert_doc = m_object.run(data)
-            if alert_doc:
-                # 存在问题，告警
+            if self.executor:
+                # 模块对象保存了当前事件的状态，同一模块的任务按提交顺序串行执行；
+                # unique_id 以告警代码开头，因此同一 unique_id 的告警也按顺序生成，保证告警合并正确
+                futures.append(self.executor.submit(id(m_object), self._run_module, m_object, data))
+            else:
+                self._run_module(m_object, data)
+        return futures
+
+    def _run_module(self, m_object, data):
+        labels = (("alert_code", getattr(m_object, "code", type(m_object).__name__)),
+                  ("event_id", getattr(data, "event_id", "")))
+        try:
+            with metrics.timed("watchad_module_seconds", labels):
+                # 运行检测模块的语句
+                alert_doc = m_object.run(data)
+        except Exception:
+            metrics.inc("watchad_module_errors_total", labels)
+            raise
+        if alert_doc:
+            # 存在问题，告警
+            metrics.inc("watchad_alerts_total", labels)
+            with metrics.timed("watchad_alert_generate_seconds", labels[:1]):
                 self.alert.generate(alert_doc)
 
+    @staticmethod
+    def _wait(futures: list):
+        """
+            等待检测任务全部完成，单个模块的异常不影响其它模块
+        """
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                traceback.print_exc()
+
     def _load_module(self, name: str, data_type: str) -> dict:
         modules_map = {}
 
@@ -135,10 +255,13 @@ class Engine(object):
             logger.info("loaded module: " + module_path)
             data_types = getattr(module, data_type)
             assert isinstance(data_types, list)
+            m_object = getattr(module, f)()
+            prefilter = _compile_prefilter(getattr(module, "PREFILTER", None))
             for d_type in data_types:
                 _register_module(d_type, {
                     "code": getattr(module, "ALERT_CODE") if hasattr(module, "ALERT_CODE") else None,
-                    "object": getattr(module, f)()
+                    "object": m_object,
+                    "prefilter": prefilter
                 })
         return modules_map
 
@@ -162,8 +285,86 @@ class Engine(object):
         self.mongo.delete_many(query)
 
 
+def _compile_prefilter(spec):
+    """
+        将模块声明的 PREFILTER 编译为作用于原始 event_data 的判断函数
+
+        PREFILTER 为 字段名 -> 条件 的字典，全部条件满足才会运行该模块，字段不存在视为不满足：
+            字符串、数字   字段值相等
+            列表、元组、集合   字段值在其中
+            函数   以字段值为参数，返回 True 表示满足
+    """
+    if not spec:
+        return None
+
+    checks = []
+    for field, cond in spec.items():
+        if callable(cond):
+            checks.append((field, cond))
+        elif isinstance(cond, (list, tuple, set, frozenset)):
+            checks.append((field, frozenset(cond).__contains__))
+        else:
+            checks.append((field, cond.__eq__))
+
+    def _prefilter(event_data: dict) -> bool:
+        for field, check in checks:
+            if field not in event_data or check(event_data[field]) is not True:
+                return False
+        return True
+    return _prefilter
+
+
+class AsyncEngine(Engine):
+    """
+        基于 asyncio 的检测引擎
+
+        消费和确认在事件循环中完成，每条消息一个协程，等待检测模块执行时不阻塞后续消息的接收，
+        进程内同时处理的消息数由 MqConfig.async_max_in_flight 控制。
+        检测模块本身仍是同步实现，在线程池中执行，同一模块的任务依然按顺序执行。
+    """
+    def __init__(self, shard_index=None):
+        super().__init__(shard_index)
+        self.executor = KeyedExecutor(ENGINE_ASYNC_THREAD_NUM)
+
+    def start(self):
+        self.load()
+
+        loop = asyncio.get_event_loop()
+        c = AsyncConsumer(loop, self.shard_index)
+        logger.info("start async MQ consumer and register callback func.")
+        if self.shard_index is not None:
+            logger.info("consume shard queue: " + c.queue)
+        logger.info("status: async main process running")
+        c.run(self.async_analyze)
+
+    async def async_analyze(self, data: dict):
+        futures = self._analyze(data)
+        if not futures:
+            return
+        results = await asyncio.gather(*[asyncio.wrap_future(f) for f in futures], return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                traceback.print_exception(type(result), result, result.__traceback__)
+
+
+def start_router():
+    """
+        分片模式的路由进程，分片数即检测引擎进程数
+    """
+    if not MqConfig.shard_mode:
+        logger.info("shard mode is disabled, router exit.")
+        return
+    ShardRouter(int(os.environ.get("WATCHAD_ENGINE_NUM", 1))).run()
+
+
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == "delay":
         Engine().delay_run()
+    elif len(sys.argv) > 2 and sys.argv[1] == "shard":
+        Engine(int(sys.argv[2])).start()
+    elif len(sys.argv) > 1 and sys.argv[1] == "router":
+        start_router()
+    elif len(sys.argv) > 1 and sys.argv[1] == "async":
+        AsyncEngine(int(sys.argv[2]) if len(sys.argv) > 2 else None).start()
     else:
         Engine().start()
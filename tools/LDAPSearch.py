@@ -4,28 +4,167 @@
 
 """
     通过 LDAP 检索域内的相关信息
+
+    每个进程对每个域维护一个已绑定的长连接池，LDAPSearch 对象本身不再建立连接，检索时从连接池取出连接，
+    用完归还。连接空闲较久时取出前先检查是否可用，检索过程中连接断开时重新建立连接重试一次。
 """
 
+import time
 import random
+import threading
+from collections import deque
 
-from ldap3 import Server, Connection, ALL, Entry
+from ldap3 import Server, Connection, ALL, OFFLINE_AD_2012_R2, BASE, Entry
+from ldap3.core.exceptions import LDAPException
 
 from settings.config import main_config
+from settings.database_config import LdapConfig
 from tools.common.common import get_netbios_domain
 from tools.common.errors import LDAPSearchFailException
+from tools.common.Metrics import instrument_backend
+
+_pools_lock = threading.Lock()
+# (域, 服务器, 账号, 密码) -> 连接池，配置变更后自动使用新的连接池
+_pools = {}
+
+
+class LDAPConnectionPool(object):
+    def __init__(self, server, user, password, size=LdapConfig.pool_size):
+        self.server_uri = server
+        self.user = user
+        self.password = password
+        self._server = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        # [(归还时间, 连接)]，后进先出，优先使用最近用过的连接
+        self._idle = deque()
+
+    def acquire(self) -> Connection:
+        if not self._slots.acquire(timeout=LdapConfig.pool_timeout):
+            raise LDAPSearchFailException("ldap connection pool timeout")
+        try:
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    return self._connect()
+                released_time, con = item
+                if not con.closed and (time.monotonic() - released_time < LdapConfig.idle_check_interval
+                                       or _is_alive(con)):
+                    return con
+                _close(con)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, con: Connection, broken=False):
+        """
+            :param broken: 连接已不可用，直接关闭不再放回连接池
+        """
+        if broken:
+            _close(con)
+        else:
+            with self._lock:
+                self._idle.append((time.monotonic(), con))
+        self._slots.release()
+
+    def _connect(self) -> Connection:
+        if self._server is None:
+            self._server = Server(self.server_uri, get_info=ALL if LdapConfig.read_schema else OFFLINE_AD_2012_R2,
+                                  connect_timeout=LdapConfig.connect_timeout)
+        return Connection(self._server, user=self.user, password=self.password, auto_bind=True,
+                          receive_timeout=LdapConfig.receive_timeout)
+
+
+def get_pool(domain) -> LDAPConnectionPool:
+    account = main_config.ldap_account[domain]
+    key = (domain, account["server"], account["user"], account["password"])
+    pool = _pools.get(key)
+    if pool is not None:
+        return pool
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = LDAPConnectionPool(account["server"], account["user"], account["password"])
+        return _pools[key]
+
+
+def _is_alive(con: Connection) -> bool:
+    try:
+        return con.search("", "(objectClass=*)", search_scope=BASE, attributes=["1.1"])
+    except Exception:
+        return False
+
 
+def _close(con: Connection):
+    try:
+        con.unbind()
+    except Exception:
+        pass
 
+
+@instrument_backend("ldap")
 class LDAPSearch(object):
     def __init__(self, domain):
         self.domain = get_netbios_domain(domain)
-        self.con = Connection(self._get_server(),
-                              user=main_config.ldap_account[self.domain]["user"],
-                              password=main_config.ldap_account[self.domain]["password"],
-                              auto_bind=True)
+        self.pool = get_pool(self.domain)
         self.domain_dn = main_config.ldap_account[self.domain]["dn"]
 
-    def _get_server(self):
-        return Server(main_config.ldap_account[self.domain]["server"], get_info=ALL)
+    def _search(self, search_filter, attributes, search_base=None, **kwargs) -> (dict, list):
+        """
+            默认在域根DN下检索
+
+            :return: (检索结果, 条目列表)
+        """
+        def _run(con):
+            con.search(search_base if search_base is not None else self.domain_dn, search_filter,
+                       attributes=attributes, **kwargs)
+            return con.result, con.entries
+        return self._with_connection(_run)
+
+    def _with_connection(self, func):
+        """
+            从连接池取出连接执行操作，连接异常时重新建立连接重试一次
+        """
+        for retry in range(2):
+            con = self.pool.acquire()
+            try:
+                rsp = func(con)
+            except LDAPException:
+                self.pool.release(con, broken=True)
+                if retry:
+                    raise LDAPSearchFailException()
+                continue
+            except Exception:
+                self.pool.release(con, broken=True)
+                raise
+            self.pool.release(con)
+            return rsp
+
+    def search_paged(self, search_filter, attributes, paged_size=1000) -> list:
+        """
+            分页检索全部结果，整个检索过程使用同一个连接
+
+            :return: [{"dn": DN, "attributes": {属性名: 值}}]
+        """
+        def _run(con):
+            rsp = con.extend.standard.paged_search(self.domain_dn, search_filter, attributes=attributes,
+                                                   paged_size=paged_size, generator=False)
+            if con.result["result"] != 0:
+                print(con.result)
+                raise LDAPSearchFailException()
+            return [each for each in rsp if each.get("type") == "searchResEntry"]
+        return self._with_connection(_run)
+
+    def get_highest_committed_usn(self) -> int:
+        """
+            当前域控已提交的最大USN，每台域控独立计数
+        """
+        result, entries = self._search("(objectClass=*)", attributes=["highestCommittedUSN"], search_base="",
+                                       search_scope=BASE)
+        if result["result"] != 0 or len(entries) == 0:
+            print(result)
+            raise LDAPSearchFailException()
+        return int(entries[0]["highestCommittedUSN"].value)
 
     def search_by_sid(self, sid, attributes=None) -> Entry:
         """
@@ -33,12 +172,12 @@ class LDAPSearch(object):
         """
         if attributes is None:
             attributes = ['cn']
-        self.con.search(self.domain_dn, '(ObjectSID={sid})'.format(sid=sid), attributes=attributes)
-        if self.con.result["result"] == 0 and len(self.con.entries) > 0:
+        result, entries = self._search('(ObjectSID={sid})'.format(sid=sid), attributes=attributes)
+        if result["result"] == 0 and len(entries) > 0:
             # sid 是唯一的 取数组第一个即可
-            entry = self.con.entries[0]
+            entry = entries[0]
             return entry
-        elif self.con.result["result"] != 0:
+        elif result["result"] != 0:
             raise LDAPSearchFailException()
 
     def search_by_name(self, user, attributes=None) -> Entry:
@@ -47,13 +186,12 @@ class LDAPSearch(object):
         """
         if attributes is None:
             attributes = ["CN"]
-        dn = self.domain_dn
-        self.con.search(dn, '(sAMAccountName=%s)' % user, attributes=attributes)
-        if self.con.result["result"] == 0 and len(self.con.entries) > 0:
-            entry = self.con.entries[0]
+        result, entries = self._search('(sAMAccountName=%s)' % user, attributes=attributes)
+        if result["result"] == 0 and len(entries) > 0:
+            entry = entries[0]
             return entry
-        elif self.con.result["result"] != 0:
-            print(self.con.result)
+        elif result["result"] != 0:
+            print(result)
             raise LDAPSearchFailException()
 
     def search_by_cn(self, cn, attributes=None) -> Entry:
@@ -62,22 +200,20 @@ class LDAPSearch(object):
         """
         if attributes is None:
             attributes = ["CN"]
-        dn = self.domain_dn
-        self.con.search(dn, '(CN=%s)' % cn, attributes=attributes)
-        if self.con.result["result"] == 0 and len(self.con.entries) > 0:
-            entry = self.con.entries[0]
+        result, entries = self._search('(CN=%s)' % cn, attributes=attributes)
+        if result["result"] == 0 and len(entries) > 0:
+            entry = entries[0]
             return entry
-        elif len(self.con.entries) == 0:
+        elif len(entries) == 0:
             return None
-        elif self.con.result["result"] != 0:
-            print(self.con.result)
+        elif result["result"] != 0:
+            print(result)
             raise LDAPSearchFailException()
 
     def search_admins(self):
         admin_users = []
-        self.con.search(self.domain_dn, '(&(adminCount=1)(objectclass=person))', attributes=['sAMAccountName', 'objectsid'])
-        if self.con.result["result"] == 0:
-            entries = self.con.entries
+        result, entries = self._search('(&(adminCount=1)(objectclass=person))', attributes=['sAMAccountName', 'objectsid'])
+        if result["result"] == 0:
             for en in entries:
                 name = en["sAMAccountName"][0]
                 sid = en["objectSid"][0]
@@ -91,82 +227,75 @@ class LDAPSearch(object):
             raise LDAPSearchFailException()
 
     def search_domain_controller(self):
-        dn = self.domain_dn
-        self.con.search(dn, "(&(objectCategory=computer)(userAccountControl:1.2.840.113556.1.4.803:=532480))",
-                        attributes=["cn", "dnsHostName", "objectSid"])
-        if self.con.result["result"] == 0 and len(self.con.entries) > 0:
-            return self.con.entries
-        elif self.con.result["result"] != 0:
-            print(self.con.result)
+        result, entries = self._search("(&(objectCategory=computer)(userAccountControl:1.2.840.113556.1.4.803:=532480))",
+                                       attributes=["cn", "dnsHostName", "objectSid"])
+        if result["result"] == 0 and len(entries) > 0:
+            return entries
+        elif result["result"] != 0:
+            print(result)
             raise LDAPSearchFailException()
 
     def search_constrained_accounts(self):
         """
             查找所有约束委派账户
         """
-        dn = self.domain_dn
-        self.con.search(dn, "(msDS-AllowedToDelegateTo=*)",
-                        attributes=["cn", "objectSid", "sAMAccountName", "msDS-AllowedToDelegateTo"])
-        if self.con.result["result"] == 0 and len(self.con.entries) > 0:
-            return self.con.entries
-        elif self.con.result["result"] != 0:
-            print(self.con.result)
+        result, entries = self._search("(msDS-AllowedToDelegateTo=*)",
+                                       attributes=["cn", "objectSid", "sAMAccountName", "msDS-AllowedToDelegateTo"])
+        if result["result"] == 0 and len(entries) > 0:
+            return entries
+        elif result["result"] != 0:
+            print(result)
             raise LDAPSearchFailException()
 
     def search_res_constrained_accounts(self):
         """
             查找所有基于资源约束委派账户
         """
-        dn = self.domain_dn
-        self.con.search(dn, "(msDS-AllowedToActOnBehalfOfOtherIdentity=*)",
-                        attributes=["cn", "objectSid", "sAMAccountName", "msDS-AllowedToActOnBehalfOfOtherIdentity"])
-        if self.con.result["result"] == 0 and len(self.con.entries) > 0:
-            return self.con.entries
-        elif self.con.result["result"] != 0:
-            print(self.con.result)
+        result, entries = self._search("(msDS-AllowedToActOnBehalfOfOtherIdentity=*)",
+                                       attributes=["cn", "objectSid", "sAMAccountName", "msDS-AllowedToActOnBehalfOfOtherIdentity"])
+        if result["result"] == 0 and len(entries) > 0:
+            return entries
+        elif result["result"] != 0:
+            print(result)
             raise LDAPSearchFailException()
 
     def search_unconstrained_accounts(self):
         """
             无约束委派的账户
         """
-        dn = self.domain_dn
-        self.con.search(dn, "(userAccountControl:1.2.840.113556.1.4.803:=524288)",
-                        attributes=["cn", "objectSid", "sAMAccountName"])
-        if self.con.result["result"] == 0 and len(self.con.entries) > 0:
-            return self.con.entries
-        elif self.con.result["result"] != 0:
-            print(self.con.result)
+        result, entries = self._search("(userAccountControl:1.2.840.113556.1.4.803:=524288)",
+                                       attributes=["cn", "objectSid", "sAMAccountName"])
+        if result["result"] == 0 and len(entries) > 0:
+            return entries
+        elif result["result"] != 0:
+            print(result)
             raise LDAPSearchFailException()
 
     def search_pre_auth_not_required(self):
-        dn = self.domain_dn
-        self.con.search(dn, "(userAccountControl:1.2.840.113556.1.4.803:=4194304)",
-                        attributes=["cn", "objectSid", "sAMAccountName"])
-        if self.con.result["result"] == 0 and len(self.con.entries) > 0:
-            return self.con.entries
-        elif self.con.result["result"] != 0:
-            print(self.con.result)
+        result, entries = self._search("(userAccountControl:1.2.840.113556.1.4.803:=4194304)",
+                                       attributes=["cn", "objectSid", "sAMAccountName"])
+        if result["result"] == 0 and len(entries) > 0:
+            return entries
+        elif result["result"] != 0:
+            print(result)
             raise LDAPSearchFailException()
 
     def search_spn_account(self):
-        dn = self.domain_dn
-        self.con.search(dn, "(servicePrincipalName=ldap*)",
-                        attributes=["cn", "servicePrincipalName", "sAMAccountName"])
-        if self.con.result["result"] == 0 and len(self.con.entries) > 0:
-            return self.con.entries
-        elif self.con.result["result"] != 0:
-            print(self.con.result)
+        result, entries = self._search("(servicePrincipalName=ldap*)",
+                                       attributes=["cn", "servicePrincipalName", "sAMAccountName"])
+        if result["result"] == 0 and len(entries) > 0:
+            return entries
+        elif result["result"] != 0:
+            print(result)
             raise LDAPSearchFailException()
 
     def get_support_aes_account(self):
-        dn = self.domain_dn
-        self.con.search(dn, "(&(objectClass=Computer)(msds-supportedencryptiontypes>=8))",
-                        attributes=["sAMAccountName"], paged_size=200)
-        if self.con.result["result"] == 0 and len(self.con.entries) > 0:
-            return self.con.entries[random.randint(20, 180)]
-        elif self.con.result["result"] != 0:
-            print(self.con.result)
+        result, entries = self._search("(&(objectClass=Computer)(msds-supportedencryptiontypes>=8))",
+                                       attributes=["sAMAccountName"], paged_size=200)
+        if result["result"] == 0 and len(entries) > 0:
+            return entries[random.randint(20, 180)]
+        elif result["result"] != 0:
+            print(result)
             raise LDAPSearchFailException()
 
 
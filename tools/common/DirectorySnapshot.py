@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+# coding: utf-8
+# author: 9ian1i   https://github.com/Qianlitp
+
+"""
+    域目录本地副本
+
+    后台线程首次通过LDAP分页拉取域内全部用户、计算机和组，之后每 DIRECTORY_SYNC_MINUTES 分钟按 uSNChanged 增量同步，
+    账户是否为管理员、SID与用户名互查、是否支持AES、所属组等查询直接在本地索引中完成，不再为每条事件查询LDAP。
+
+    uSNChanged 由每台域控独立计数，同步始终通过配置中的同一个LDAP服务器进行。
+    增量同步无法发现已删除的对象，每 DIRECTORY_FULL_SYNC_HOURS 小时重新全量拉取一次。
+    组成员变化只改变组对象的 uSNChanged，增量同步时根据组的 member 属性更新成员的 memberOf。
+    每次同步后更新组成员关系图 (GroupGraph)。
+
+    域的首次全量拉取完成之前，或本地找不到对象时查询返回 None，调用方继续使用LDAP查询。
+"""
+
+import time
+import threading
+import traceback
+
+from settings.config import main_config
+from tools.common.Logger import logger
+from tools.common.common import get_cn_from_dn, get_netbios_domain
+from tools.common.GroupGraph import group_graph
+from tools.LDAPSearch import LDAPSearch
+
+# 增量同步间隔，单位分钟
+DIRECTORY_SYNC_MINUTES = 5
+# 全量同步间隔，单位小时
+DIRECTORY_FULL_SYNC_HOURS = 24
+# 分页检索每页的对象数
+DIRECTORY_PAGE_SIZE = 1000
+
+OBJECT_FILTER = "(|(objectClass=user)(objectClass=group))"
+ATTRIBUTES = ["objectSid", "sAMAccountName", "adminCount", "memberOf", "distinguishedName", "userAccountControl",
+              "msDS-SupportedEncryptionTypes", "objectClass"]
+# 增量同步时额外获取组的成员，全量同步时成员关系由 memberOf 得到
+INCREMENTAL_ATTRIBUTES = ATTRIBUTES + ["member"]
+
+
+class DirectoryEntry(object):
+    __slots__ = ("sid", "name", "dn", "admin_count", "member_of", "uac", "enc_types", "is_group")
+
+    def __init__(self, sid, name, dn, admin_count, member_of, uac, enc_types, is_group):
+        self.sid = sid
+        self.name = name
+        self.dn = dn
+        self.admin_count = admin_count
+        # 所属组的小写DN，只整体替换不原地修改，查询线程可以直接遍历
+        self.member_of = member_of
+        self.uac = uac
+        self.enc_types = enc_types
+        self.is_group = is_group
+
+    @property
+    def cn(self) -> str:
+        return get_cn_from_dn(self.dn)
+
+
+class DomainDirectory(object):
+    """
+        单个域的本地索引，只由同步线程写入
+    """
+    def __init__(self):
+        self.by_sid = {}
+        # 小写 sAMAccountName -> SID
+        self.sid_by_name = {}
+        # 小写DN -> SID
+        self.sid_by_dn = {}
+        # 组的小写DN -> 成员的小写DN集合
+        self.members = {}
+        self.usn = None
+        self.full_sync_time = None
+
+    def update(self, response: dict):
+        """
+            :param response: 分页检索返回的一个对象 {"dn": DN, "attributes": {属性名: 值}}
+        """
+        attributes = response["attributes"]
+        sid = _first(attributes.get("objectSid"))
+        if not sid:
+            return
+        sid = str(sid)
+        dn = response["dn"]
+        entry = DirectoryEntry(
+            sid=sid,
+            name=_first(attributes.get("sAMAccountName")),
+            dn=dn,
+            admin_count=_first(attributes.get("adminCount")),
+            member_of=frozenset(g.lower() for g in attributes.get("memberOf") or []),
+            uac=_first(attributes.get("userAccountControl")),
+            enc_types=_first(attributes.get("msDS-SupportedEncryptionTypes")),
+            is_group="group" in [c.lower() for c in attributes.get("objectClass") or []]
+        )
+        dn_key = dn.lower()
+
+        old = self.by_sid.get(sid)
+        if old is not None:
+            old_dn_key = old.dn.lower()
+            if old.name and self.sid_by_name.get(old.name.lower()) == sid:
+                del self.sid_by_name[old.name.lower()]
+            if self.sid_by_dn.get(old_dn_key) == sid:
+                del self.sid_by_dn[old_dn_key]
+            for group in old.member_of:
+                self.members.get(group, set()).discard(old_dn_key)
+            if old.is_group and old_dn_key != dn_key:
+                # 组改名，成员的 memberOf 随之更新
+                self.members[dn_key] = self.members.pop(old_dn_key, set())
+                for member in self.members[dn_key]:
+                    self._replace_group(member, old_dn_key, dn_key)
+
+        self.by_sid[sid] = entry
+        if entry.name:
+            self.sid_by_name[entry.name.lower()] = sid
+        self.sid_by_dn[dn_key] = sid
+        for group in entry.member_of:
+            self.members.setdefault(group, set()).add(dn_key)
+        if entry.is_group and "member" in attributes:
+            self._set_members(dn_key, set(m.lower() for m in attributes.get("member") or []))
+
+    def _set_members(self, group: str, members: set):
+        old_members = self.members.get(group, set())
+        for member in members - old_members:
+            self._replace_group(member, None, group)
+        for member in old_members - members:
+            self._replace_group(member, group, None)
+        self.members[group] = members
+
+    def _replace_group(self, member: str, old_group, new_group):
+        sid = self.sid_by_dn.get(member)
+        if sid is None:
+            return
+        entry = self.by_sid[sid]
+        member_of = set(entry.member_of)
+        member_of.discard(old_group)
+        if new_group is not None:
+            member_of.add(new_group)
+        entry.member_of = frozenset(member_of)
+
+
+class DirectorySnapshot(object):
+    def __init__(self):
+        # NetBIOS域名 -> DomainDirectory，全量同步完成后整体替换
+        self._domains = {}
+        self._thread = None
+
+    def start(self):
+        group_graph.start()
+        self._thread = threading.Thread(target=self._run, name="directory_sync", daemon=True)
+        self._thread.start()
+
+    def get_by_sid(self, domain, sid) -> DirectoryEntry:
+        directory = self._get_directory(domain)
+        if directory is None or not sid:
+            return None
+        return directory.by_sid.get(sid)
+
+    def get_by_name(self, domain, name) -> DirectoryEntry:
+        directory = self._get_directory(domain)
+        if directory is None or not name:
+            return None
+        sid = directory.sid_by_name.get(name.lower())
+        return directory.by_sid.get(sid) if sid is not None else None
+
+    def _get_directory(self, domain) -> DomainDirectory:
+        if not domain:
+            return None
+        return self._domains.get(get_netbios_domain(domain))
+
+    def _run(self):
+        while True:
+            try:
+                domains = list(main_config.ldap_account.keys())
+            except Exception:
+                logger.error(traceback.format_exc())
+                domains = []
+            for domain in domains:
+                try:
+                    self.sync(domain)
+                except Exception:
+                    logger.error("directory sync error: " + domain)
+                    logger.error(traceback.format_exc())
+            time.sleep(DIRECTORY_SYNC_MINUTES * 60)
+
+    def sync(self, domain):
+        ldap = LDAPSearch(domain)
+        current = self._domains.get(domain)
+        # 先记录当前的USN，拉取过程中发生的变化由下一次增量同步补齐
+        usn = ldap.get_highest_committed_usn()
+        if current is None or time.monotonic() - current.full_sync_time >= DIRECTORY_FULL_SYNC_HOURS * 3600:
+            directory = DomainDirectory()
+            for each in ldap.search_paged(OBJECT_FILTER, ATTRIBUTES, DIRECTORY_PAGE_SIZE):
+                directory.update(each)
+            directory.usn = usn
+            directory.full_sync_time = time.monotonic()
+            self._domains[domain] = directory
+            group_graph.load(domain, directory)
+            logger.info("directory full sync {domain}: {count} objects.".format(domain=domain,
+                                                                              count=len(directory.by_sid)))
+            return
+        if usn <= current.usn:
+            # 敏感组配置可能有变化
+            group_graph.load(domain, current, changed=False)
+            return
+        changed = ldap.search_paged("(&{filter}(uSNChanged>={usn}))".format(filter=OBJECT_FILTER, usn=current.usn + 1),
+                                    INCREMENTAL_ATTRIBUTES, DIRECTORY_PAGE_SIZE)
+        for each in changed:
+            current.update(each)
+        current.usn = usn
+        group_graph.load(domain, current, changed=len(changed) > 0)
+        logger.debug("directory incremental sync {domain}: {count} objects.".format(domain=domain, count=len(changed)))
+
+
+def _first(value):
+    if isinstance(value, (list, tuple)):
+        return value[0] if value else None
+    return value
+
+
+directory = DirectorySnapshot()
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+# coding: utf-8
+# author: 9ian1i   https://github.com/Qianlitp
+
+"""
+    组成员关系图
+
+    由域目录副本 (DirectorySnapshot) 的 memberOf 构建 成员SID -> 所属组SID 的关系图，
+    并预先计算每个敏感组的全部直接和嵌套成员，判断账户是否属于敏感组只需要一次集合查找，不会漏掉嵌套组。
+
+    引擎处理到组成员变更事件 (4728/4729/4732/4733/4756/4757) 时立即更新关系图，并经Redis发布订阅通知其它引擎进程同样更新。
+    最近 GROUP_CHANGE_KEEP_MINUTES 分钟内的变更在重新构建后再次应用，避免被同步自尚未复制该变更的域控的数据覆盖。
+"""
+
+import time
+import uuid
+import threading
+from collections import deque
+
+import simplejson
+
+from settings.config import main_config
+from tools.common.common import get_netbios_domain
+from tools.database.RedisHelper import RedisHelper
+
+# 重新构建后再次应用的最近变更时间范围，单位分钟
+GROUP_CHANGE_KEEP_MINUTES = 15
+# 组成员变更通知的频道
+REDIS_CHANNEL_GROUP_CHANGE = "group_change"
+# 订阅断开后的重连间隔，单位秒
+RECONNECT_INTERVAL = 5
+
+# 区分通知来自哪个进程
+PROCESS_TOKEN = uuid.uuid4().hex
+
+
+class _DomainGraph(object):
+    def __init__(self, sensitive_groups: frozenset):
+        # 成员SID -> 直接所属组SID集合
+        self.parents = {}
+        # 组SID -> 直接成员SID集合
+        self.children = {}
+        self.sensitive_groups = sensitive_groups
+        # 敏感组SID -> 全部直接和嵌套成员SID
+        self.closures = {}
+        # 所有敏感组成员的并集，只整体替换，查询时不加锁
+        self.sensitive_members = frozenset()
+
+
+class GroupGraph(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        # NetBIOS域名 -> _DomainGraph
+        self._domains = {}
+        # 最近的变更 [(时间, 域, 成员SID, 组SID, 是否为添加)]
+        self._changes = deque()
+        self._listener = None
+
+    def load(self, domain, directory, changed=True):
+        """
+            由域目录副本重新构建，目录未变化且敏感组配置未变化时跳过
+
+            :param directory: DirectorySnapshot 中单个域的 DomainDirectory
+        """
+        sensitive_groups = _get_sensitive_groups(directory)
+        current = self._domains.get(domain)
+        if not changed and current is not None and current.sensitive_groups == sensitive_groups:
+            return
+        graph = _DomainGraph(sensitive_groups)
+        for entry in list(directory.by_sid.values()):
+            for group_dn in entry.member_of:
+                group_sid = directory.sid_by_dn.get(group_dn)
+                if group_sid is not None:
+                    _link(graph, entry.sid, group_sid, True)
+        with self._lock:
+            self._expire_changes()
+            for _, change_domain, member_sid, group_sid, add in self._changes:
+                if change_domain == domain:
+                    _link(graph, member_sid, group_sid, add)
+            graph.closures = {group_sid: _closure(graph, group_sid) for group_sid in sensitive_groups}
+            graph.sensitive_members = frozenset().union(*graph.closures.values())
+            self._domains[domain] = graph
+
+    def apply_change(self, domain, member_sid, group_sid, add: bool):
+        """
+            组成员变更事件，同时通知其它进程
+        """
+        domain = get_netbios_domain(domain)
+        self._apply(domain, member_sid, group_sid, add)
+        RedisHelper().publish(REDIS_CHANNEL_GROUP_CHANGE, simplejson.dumps({
+            "domain": domain,
+            "member_sid": member_sid,
+            "group_sid": group_sid,
+            "add": add,
+            "process": PROCESS_TOKEN
+        }))
+
+    def _apply(self, domain, member_sid, group_sid, add: bool):
+        with self._lock:
+            self._changes.append((time.monotonic(), domain, member_sid, group_sid, add))
+            self._expire_changes()
+            graph = self._domains.get(domain)
+            if graph is None:
+                return
+            _link(graph, member_sid, group_sid, add)
+            affected = [s for s in graph.sensitive_groups if s == group_sid or group_sid in graph.closures[s]]
+            if not affected:
+                return
+            for sensitive_group in affected:
+                graph.closures[sensitive_group] = _closure(graph, sensitive_group)
+            graph.sensitive_members = frozenset().union(*graph.closures.values())
+
+    def in_sensitive_group(self, domain, sid):
+        """
+            :return: 是否直接或嵌套属于任一敏感组，关系图尚未构建时返回 None
+        """
+        graph = self._get_graph(domain)
+        if graph is None:
+            return None
+        return sid in graph.sensitive_members
+
+    def is_sensitive_group(self, domain, group_sid) -> bool:
+        """
+            组本身是敏感组，或嵌套在敏感组中
+        """
+        graph = self._get_graph(domain)
+        if graph is None:
+            return False
+        return group_sid in graph.sensitive_groups or group_sid in graph.sensitive_members
+
+    def _get_graph(self, domain) -> _DomainGraph:
+        if not domain:
+            return None
+        return self._domains.get(get_netbios_domain(domain))
+
+    def _expire_changes(self):
+        cutoff = time.monotonic() - GROUP_CHANGE_KEEP_MINUTES * 60
+        while self._changes and self._changes[0][0] < cutoff:
+            self._changes.popleft()
+
+    def start(self):
+        """
+            开始接收其它进程的组成员变更，在首次构建之前启动，构建期间的变更也会再次应用
+        """
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name="group_change_listener", daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        """
+            订阅其它进程处理的组成员变更，连接断开期间的变更由下一次目录同步补齐
+        """
+        while True:
+            try:
+                pubsub = RedisHelper().pubsub()
+                pubsub.subscribe(REDIS_CHANNEL_GROUP_CHANGE)
+                for message in pubsub.listen():
+                    data = simplejson.loads(message["data"])
+                    if data["process"] == PROCESS_TOKEN:
+                        continue
+                    self._apply(data["domain"], data["member_sid"], data["group_sid"], data["add"])
+            except Exception:
+                time.sleep(RECONNECT_INTERVAL)
+
+
+def get_group_domain(target_domain, dc_computer_name) -> str:
+    """
+        组变更事件中组所在的域，Builtin 组属于域控所在的域
+    """
+    if target_domain and target_domain.lower() != "builtin":
+        return target_domain
+    return dc_computer_name.split(".", 1)[-1]
+
+
+def _get_sensitive_groups(directory) -> frozenset:
+    sids = set()
+    for group in main_config.sensitive_groups:
+        if group.get("sid") and group["sid"] in directory.by_sid:
+            sids.add(group["sid"])
+            continue
+        sid = directory.sid_by_name.get(group["name"].lower())
+        if sid is not None:
+            sids.add(sid)
+    return frozenset(sids)
+
+
+def _link(graph: _DomainGraph, member_sid, group_sid, add: bool):
+    if add:
+        graph.parents.setdefault(member_sid, set()).add(group_sid)
+        graph.children.setdefault(group_sid, set()).add(member_sid)
+    else:
+        graph.parents.get(member_sid, set()).discard(group_sid)
+        graph.children.get(group_sid, set()).discard(member_sid)
+
+
+def _closure(graph: _DomainGraph, group_sid) -> frozenset:
+    members = set()
+    stack = [group_sid]
+    while stack:
+        for member in graph.children.get(stack.pop(), ()):
+            if member not in members:
+                members.add(member)
+                stack.append(member)
+    return frozenset(members)
+
+
+group_graph = GroupGraph()
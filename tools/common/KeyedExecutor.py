@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+# coding: utf-8
+# author: 9ian1i   https://github.com/Qianlitp
+
+"""
+    按键串行的线程池
+
+    相同 key 的任务严格按提交顺序依次执行，不同 key 的任务在有限的线程池中并发执行
+"""
+
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+
+# 单个 key 连续执行的任务数上限，超过后让出线程，避免热点 key 长期占用线程
+DRAIN_LIMIT = 32
+
+
+class KeyedExecutor(object):
+    def __init__(self, max_workers: int):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="watchad_engine")
+        self._lock = threading.Lock()
+        self._queues = {}
+
+    def submit(self, key, func, *args, **kwargs) -> Future:
+        future = Future()
+        task = (future, func, args, kwargs)
+        with self._lock:
+            if key in self._queues:
+                self._queues[key].append(task)
+                return future
+            self._queues[key] = deque([task])
+        self._pool.submit(self._drain, key)
+        return future
+
+    def _drain(self, key):
+        for _ in range(DRAIN_LIMIT):
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                future, func, args, kwargs = queue.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        # 仍有剩余任务，重新排队，保证其它 key 也能得到执行
+        with self._lock:
+            if not self._queues[key]:
+                del self._queues[key]
+                return
+        self._pool.submit(self._drain, key)
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
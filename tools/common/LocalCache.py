@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+# coding: utf-8
+# author: 9ian1i   https://github.com/Qianlitp
+
+"""
+    进程内LRU缓存
+
+    放在Redis缓存之前，服务账户、域控机器账户等被反复查询的键不再每次都访问Redis。
+    每个键有各自的过期时间，超过 max_num 个键时淘汰最久未使用的键；缓存值可以为 None，用于缓存不存在的结果。
+
+    需要所有进程同时失效的键通过 invalidate 删除，经Redis发布订阅通知其它进程。
+    命中、未命中和淘汰次数以 watchad_local_cache_*_total 指标输出，标签为缓存名称。
+"""
+
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+import simplejson
+
+from tools.common.Metrics import metrics
+from tools.database.RedisHelper import RedisHelper
+
+# 缓存失效通知的频道
+REDIS_CHANNEL_CACHE_INVALIDATE = "local_cache_invalidate"
+# 订阅断开后的重连间隔，单位秒
+RECONNECT_INTERVAL = 5
+
+# 表示缓存中不存在该键，与缓存值 None 区分
+MISSING = object()
+# 区分通知来自哪个进程
+PROCESS_TOKEN = uuid.uuid4().hex
+
+_caches_lock = threading.Lock()
+# 名称 -> LocalCache
+_caches = {}
+_listener = None
+
+
+class LocalCache(object):
+    def __init__(self, name, max_num):
+        self.name = name
+        self.max_num = max_num
+        self._lock = threading.Lock()
+        # 键 -> (过期时间, 值)，按最近使用排序
+        self._data = OrderedDict()
+        self._labels = (("cache", name),)
+        with _caches_lock:
+            _caches[name] = self
+
+    def get(self, key):
+        """
+            :return: 缓存值，不存在或已过期时返回 MISSING
+        """
+        _start_listener()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] <= time.monotonic():
+                del self._data[key]
+                item = None
+            if item is not None:
+                self._data.move_to_end(key)
+        if item is None:
+            metrics.inc("watchad_local_cache_misses_total", self._labels)
+            return MISSING
+        metrics.inc("watchad_local_cache_hits_total", self._labels)
+        return item[1]
+
+    def set(self, key, value, ttl):
+        """
+            :param ttl: 过期时间，单位秒
+        """
+        evicted = 0
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_num:
+                self._data.popitem(last=False)
+                evicted += 1
+        if evicted:
+            metrics.inc("watchad_local_cache_evictions_total", self._labels, n=evicted)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate(self, key):
+        """
+            删除本进程的缓存，并通知其它进程删除
+        """
+        self.delete(key)
+        RedisHelper().publish(REDIS_CHANNEL_CACHE_INVALIDATE,
+                              simplejson.dumps({"cache": self.name, "key": key, "process": PROCESS_TOKEN}))
+
+
+def _start_listener():
+    global _listener
+    if _listener is not None:
+        return
+    with _caches_lock:
+        if _listener is None:
+            _listener = threading.Thread(target=_listen, name="local_cache_listener", daemon=True)
+            _listener.start()
+
+
+def _listen():
+    """
+        订阅其它进程的失效通知，连接断开期间的通知会丢失，由缓存的过期时间兜底
+    """
+    while True:
+        try:
+            pubsub = RedisHelper().pubsub()
+            pubsub.subscribe(REDIS_CHANNEL_CACHE_INVALIDATE)
+            for message in pubsub.listen():
+                data = simplejson.loads(message["data"])
+                if data["process"] == PROCESS_TOKEN:
+                    continue
+                cache = _caches.get(data["cache"])
+                if cache is not None:
+                    cache.delete(data["key"])
+        except Exception:
+            time.sleep(RECONNECT_INTERVAL)
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+# coding: utf-8
+# author: 9ian1i   https://github.com/Qianlitp
+
+"""
+    登录会话表
+
+    由 4624/4634 事件直接维护 (登录会话ID, 用户名) -> 来源IP、主机名、登录类型、登录时间，
+    告警生成时根据 SubjectLogonId 查找来源IP不再需要查询ES。
+
+    本地表由每个进程的最近事件接收线程 (EventFeed) 写入，包含全部域控的登录事件。
+    开启 LOGON_SESSION_SHARED 后，引擎消费到的登录事件同时写入Redis，本地未命中时再查询Redis，
+    进程重启后仍然可以找到重启之前的会话。
+
+    会话在注销 LOGOFF_GRACE_MINUTES 分钟后、或登录 LOGON_SESSION_MAX_HOURS 小时后淘汰，时间均以事件时间为准。
+"""
+
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+import simplejson
+
+from tools.common.common import utc_to_datetime
+from tools.database.RedisHelper import RedisHelper
+
+# 会话最长保存时间，单位小时
+LOGON_SESSION_MAX_HOURS = 24
+# 注销后继续保存的时间，单位分钟，注销之后才处理的告警仍然可以找到来源
+LOGOFF_GRACE_MINUTES = 10
+# 本地保存的最大会话数
+LOGON_SESSION_MAX_NUM = 500000
+# 是否通过Redis在多个进程间共享
+LOGON_SESSION_SHARED = False
+
+REDIS_KEY_PREFIX = "logon_session:"
+
+
+class LogonSessionTable(object):
+    def __init__(self, max_num=LOGON_SESSION_MAX_NUM):
+        self.max_num = max_num
+        self.lifetime = timedelta(hours=LOGON_SESSION_MAX_HOURS)
+        self.grace = timedelta(minutes=LOGOFF_GRACE_MINUTES)
+        self._lock = threading.Lock()
+        # 按登录时间排序的在线会话，以及按注销时间排序的已注销会话
+        self._sessions = OrderedDict()
+        self._logged_off = OrderedDict()
+        self._newest = None
+        self._redis = None
+
+    def add(self, event: dict):
+        """
+            写入本地表，非 4624/4634 事件直接忽略
+        """
+        event_id = event.get("event_id")
+        if event_id not in (4624, 4634) or "@timestamp" not in event:
+            return
+        event_data = event.get("event_data", {})
+        key = (event_data.get("TargetLogonId"), event_data.get("TargetUserName"))
+        ts = utc_to_datetime(event["@timestamp"])
+        with self._lock:
+            if event_id == 4624:
+                self._logged_off.pop(key, None)
+                self._sessions.pop(key, None)
+                self._sessions[key] = _session_doc(event)
+            else:
+                session = self._sessions.pop(key, None)
+                if session is not None:
+                    self._logged_off.pop(key, None)
+                    self._logged_off[key] = (ts, session)
+            if self._newest is None or ts > self._newest:
+                self._newest = ts
+            self._evict()
+
+    def _evict(self):
+        while self._sessions and (len(self._sessions) + len(self._logged_off) > self.max_num or
+                                  next(iter(self._sessions.values()))["logon_time"] < self._newest - self.lifetime):
+            self._sessions.popitem(last=False)
+        while self._logged_off and next(iter(self._logged_off.values()))[0] < self._newest - self.grace:
+            self._logged_off.popitem(last=False)
+
+    def share(self, event: dict):
+        """
+            开启共享时将引擎消费到的登录事件写入Redis，每条事件只由消费到它的进程写入一次
+        """
+        if not LOGON_SESSION_SHARED or event.get("event_id") not in (4624, 4634):
+            return
+        event_data = event.get("event_data", {})
+        redis_key = _redis_key(event_data.get("TargetLogonId"), event_data.get("TargetUserName"))
+        if event["event_id"] == 4624:
+            session = _session_doc(event)
+            session["logon_time"] = event["@timestamp"]
+            self._get_redis().set_str_value(redis_key, simplejson.dumps(session),
+                                            expire=int(self.lifetime.total_seconds()))
+        else:
+            self._get_redis().set_expire(redis_key, int(self.grace.total_seconds()))
+
+    def get(self, logon_id: str, user_name: str):
+        """
+            :return: 会话信息 {ip_address, workstation_name, logon_type, logon_time, computer_name}，不存在时返回 None
+        """
+        key = (logon_id, user_name)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None and key in self._logged_off:
+                session = self._logged_off[key][1]
+        if session is None and LOGON_SESSION_SHARED:
+            value = self._get_redis().get_str_value(_redis_key(logon_id, user_name))
+            if value:
+                session = simplejson.loads(value)
+                session["logon_time"] = utc_to_datetime(session["logon_time"])
+        return session
+
+    def _get_redis(self) -> RedisHelper:
+        if self._redis is None:
+            self._redis = RedisHelper()
+        return self._redis
+
+
+def _session_doc(event: dict) -> dict:
+    event_data = event.get("event_data", {})
+    return {
+        "ip_address": event_data.get("IpAddress"),
+        "workstation_name": event_data.get("WorkstationName"),
+        "logon_type": event_data.get("LogonType"),
+        "logon_time": utc_to_datetime(event["@timestamp"]),
+        "computer_name": event.get("computer_name")
+    }
+
+
+def _redis_key(logon_id, user_name) -> str:
+    return "{prefix}{logon_id}:{user_name}".format(prefix=REDIS_KEY_PREFIX, logon_id=logon_id, user_name=user_name)
+
+
+logon_sessions = LogonSessionTable()
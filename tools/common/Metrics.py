@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+# coding: utf-8
+# author: 9ian1i   https://github.com/Qianlitp
+
+"""
+    进程内的监控指标
+
+    计数器和耗时直方图，标签为 (名称, 值) 元组。直方图使用固定分桶，单次记录只需一次加锁和二分查找，
+    可以在生产环境常开。指标通过以下方式输出：
+
+        1. 定期写入 JSON 文件，每个进程一个文件
+        2. 本地 HTTP 端口，Prometheus 文本格式
+"""
+
+import os
+import time
+import bisect
+import inspect
+import functools
+import threading
+import simplejson
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from tools.common.Logger import logger
+
+# 直方图分桶上限，单位秒
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# HTTP 端口被占用时依次尝试后续端口的数量，同一台机器上运行多个引擎进程
+HTTP_PORT_RETRY = 32
+
+
+class Histogram(object):
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q) -> float:
+        """
+            按分桶估算分位数，返回所在分桶的上限
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for i, c in enumerate(self.counts):
+            total += c
+            if total >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else float("inf")
+        return float("inf")
+
+
+class Metrics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, labels=(), n=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = Histogram()
+            h.observe(seconds)
+
+    def timed(self, name, labels):
+        return _Timer(self, name, labels)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in self._counters.items()]
+            histograms = [{
+                "name": name,
+                "labels": dict(labels),
+                "count": h.count,
+                "sum": h.sum,
+                "p50": h.quantile(0.5),
+                "p99": h.quantile(0.99),
+                "buckets": dict(zip(list(map(str, BUCKETS)) + ["+Inf"], h.counts))
+            } for (name, labels), h in self._histograms.items()]
+        return {"counters": counters, "histograms": histograms}
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append("{name}{labels} {value}".format(name=name, labels=_format_labels(labels), value=value))
+            for (name, labels), h in sorted(self._histograms.items(), key=lambda x: x[0]):
+                cumulative = 0
+                for bound, c in zip(list(BUCKETS) + ["+Inf"], h.counts):
+                    cumulative += c
+                    lines.append("{name}_bucket{labels} {value}".format(
+                        name=name, labels=_format_labels(labels + (("le", str(bound)),)), value=cumulative))
+                lines.append("{name}_sum{labels} {value}".format(name=name, labels=_format_labels(labels), value=h.sum))
+                lines.append("{name}_count{labels} {value}".format(name=name, labels=_format_labels(labels),
+                                                                    value=h.count))
+        return "\n".join(lines) + "\n"
+
+
+class _Timer(object):
+    __slots__ = ("_metrics", "_name", "_labels", "_start")
+
+    def __init__(self, metrics, name, labels):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._metrics.observe(self._name, self._labels, time.perf_counter() - self._start)
+        return False
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join('{k}="{v}"'.format(k=k, v=str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+
+metrics = Metrics()
+
+
+def instrument_backend(backend: str):
+    """
+        类装饰器，记录后端操作类所有公开方法的调用耗时和异常次数，标签为 backend、op
+    """
+    def decorator(cls):
+        for name, func in list(vars(cls).items()):
+            if name.startswith("_") or not inspect.isfunction(func):
+                continue
+            setattr(cls, name, _wrap_backend_call(backend, name, func))
+        return cls
+    return decorator
+
+
+def _wrap_backend_call(backend, op, func):
+    labels = (("backend", backend), ("op", op))
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            metrics.inc("watchad_backend_errors_total", labels)
+            raise
+        finally:
+            metrics.observe("watchad_backend_seconds", labels, time.perf_counter() - start)
+    return wrapper
+
+
+def _process_name() -> str:
+    # supervisor 会为子进程设置进程名环境变量
+    return os.environ.get("SUPERVISOR_PROCESS_NAME", "engine_" + str(os.getpid()))
+
+
+def start_stats_file(directory: str, interval: int):
+    """
+        定期将指标写入 directory/<进程名>.json
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, _process_name() + ".json")
+
+    def _dump():
+        while True:
+            time.sleep(interval)
+            try:
+                doc = metrics.to_dict()
+                doc["process"] = _process_name()
+                doc["time"] = time.time()
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    simplejson.dump(doc, f)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                logger.error("dump metrics error: " + str(e))
+
+    threading.Thread(target=_dump, name="metrics_file", daemon=True).start()
+    logger.info("metrics stats file: " + path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics.json":
+            body = simplejson.dumps(metrics.to_dict()).encode("utf-8")
+            content_type = "application/json"
+        else:
+            body = metrics.to_prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int, host: str = "127.0.0.1"):
+    """
+        在本地端口提供 /metrics (Prometheus 文本格式) 和 /metrics.json，端口被占用时尝试后续端口
+    """
+    for p in range(port, port + HTTP_PORT_RETRY):
+        try:
+            server = HTTPServer((host, p), _MetricsHandler)
+        except OSError:
+            continue
+        threading.Thread(target=server.serve_forever, name="metrics_http", daemon=True).start()
+        logger.info("metrics http server: http://{host}:{port}/metrics".format(host=host, port=p))
+        return server
+    logger.error("no available port for metrics http server from {port}".format(port=port))
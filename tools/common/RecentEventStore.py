@@ -0,0 +1,301 @@
+#!/usr/bin/python3
+# coding: utf-8
+# author: 9ian1i   https://github.com/Qianlitp
+
+"""
+    进程内最近事件存储
+
+    每个引擎进程通过独立的队列接收交换机上的全部事件 (见 EventFeed)，按 (域控计算机名, 记录号) 和时间保存最近一段时间的事件。
+    检测模块向前查找时，存储已覆盖的时间段直接在内存中回答，更早的部分再查询ES，不再需要等待日志写入ES。
+
+    覆盖起始时间 (watermark)：在此之后产生的事件都已经保存在存储中。开始接收时为当前时间，
+    之后因超出时间窗口或数量上限淘汰事件时随之后移。
+
+    除时间分区外，事件还按 事件ID、域控计算机名 以及 INDEXED_FIELDS 中的字段值建立索引，
+    "某域控上N分钟内是否存在满足条件的X事件" 这类查询只需要遍历最小的索引列表。
+
+    每个进程都保存全部事件，只保留向前查找用到的字段 (事件ID、域控计算机名、记录号和 STORED_FIELDS)，
+    新增的向前查找条件需要把字段加入 STORED_FIELDS，条件中有未保存的字段时存储无法回答，exists 返回 None。
+"""
+
+import re
+import bisect
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+from tools.common.common import utc_to_datetime, datetime_utc_now_obj
+
+# 保存的时间窗口，单位分钟
+RECENT_EVENT_WINDOW_MINUTES = 60
+# 全部域控平均每秒产生的事件数，超出时存储覆盖的时间段缩短，更早的部分查询ES
+RECENT_EVENT_PER_SECOND = 50
+# 保存的最大事件数，超出后按分钟淘汰最早的事件
+RECENT_EVENT_MAX_NUM = RECENT_EVENT_WINDOW_MINUTES * 60 * RECENT_EVENT_PER_SECOND
+# 等待当前事件到达存储的最长时间，单位秒
+RECENT_EVENT_WAIT_TIMEOUT = 2
+# 建立索引的 event_data 字段
+INDEXED_FIELDS = ("SubjectLogonId", "TargetLogonId", "ProcessName", "NewProcessName", "RelativeTargetName",
+                  "SubjectUserName", "TargetUserName")
+# 保存的 event_data 字段，包括索引字段和向前查找中精确匹配、分词匹配的字段
+STORED_FIELDS = INDEXED_FIELDS + ("IpAddress", "ShareName", "LmPackageName", "WorkstationName", "ObjectName",
+                                  "AuditSourceName")
+# 不同域控的事件到达顺序与时间顺序不完全一致，倒序查找时额外多查找的时间
+ORDER_SLACK = timedelta(minutes=1)
+
+
+class RecentEventStore(object):
+    def __init__(self, window_minutes=RECENT_EVENT_WINDOW_MINUTES, max_num=RECENT_EVENT_MAX_NUM):
+        self.window = timedelta(minutes=window_minutes)
+        self.max_num = max_num
+        self.active = False
+        self._cond = threading.Condition()
+        self._records = {}
+        # 按分钟分区，分区起始时间 -> [(时间, 事件)]
+        self._buckets = {}
+        self._bucket_keys = []
+        self._count = 0
+        self._newest = None
+        self._watermark = None
+        # (字段, 值) -> deque([(时间, 事件)])，按到达顺序
+        self._index = {}
+
+    def start(self, since=None):
+        """
+            开始接收事件，清空已有数据
+
+            :param since: 覆盖起始时间，默认为当前时间；离线回放时传入足够早的时间
+        """
+        with self._cond:
+            self._records.clear()
+            self._index.clear()
+            self._buckets.clear()
+            self._bucket_keys = []
+            self._count = 0
+            self._newest = None
+            self._watermark = since if since is not None else datetime_utc_now_obj()
+            self.active = True
+
+    def stop(self):
+        """
+            停止接收，例如接收连接断开，此后的查询全部交给ES直到重新 start
+        """
+        with self._cond:
+            self.active = False
+
+    def add(self, event: dict):
+        if "@timestamp" not in event or "computer_name" not in event:
+            return
+        ts = utc_to_datetime(event["@timestamp"])
+        event = _compact(event)
+        bucket_key = ts.replace(second=0, microsecond=0)
+        with self._cond:
+            if not self.active:
+                return
+            bucket = self._buckets.get(bucket_key)
+            if bucket is None:
+                bucket = self._buckets[bucket_key] = []
+                bisect.insort(self._bucket_keys, bucket_key)
+            bucket.append((ts, event))
+            self._records[(event["computer_name"], event.get("record_number"))] = event
+            for index_key in _index_keys(event):
+                entries = self._index.get(index_key)
+                if entries is None:
+                    entries = self._index[index_key] = deque()
+                entries.append((ts, event))
+            self._count += 1
+            if self._newest is None or ts > self._newest:
+                self._newest = ts
+            self._evict()
+            self._cond.notify_all()
+
+    def _evict(self):
+        while self._bucket_keys and (self._count > self.max_num or
+                                     self._bucket_keys[0] + timedelta(minutes=1) < self._newest - self.window):
+            key = self._bucket_keys.pop(0)
+            bucket_end = key + timedelta(minutes=1)
+            for _, event in self._buckets.pop(key):
+                self._records.pop((event["computer_name"], event.get("record_number")), None)
+                self._count -= 1
+                for index_key in _index_keys(event):
+                    entries = self._index.get(index_key)
+                    # 索引按到达顺序保存，淘汰的事件基本都在队首
+                    while entries and entries[0][0] < bucket_end:
+                        entries.popleft()
+                    if entries is not None and not entries:
+                        del self._index[index_key]
+            self._watermark = max(self._watermark, bucket_end)
+
+    def get(self, computer_name, record_number):
+        with self._cond:
+            return self._records.get((computer_name, record_number))
+
+    def wait_for(self, computer_name, record_number, timeout=RECENT_EVENT_WAIT_TIMEOUT) -> bool:
+        """
+            等待指定事件到达存储，事件到达时立即返回，不轮询
+
+            :return: 存储中是否已有该事件，未开始接收时直接返回 False
+        """
+        key = (computer_name, record_number)
+        with self._cond:
+            if not self.active:
+                return False
+            return self._cond.wait_for(lambda: key in self._records or not self.active, timeout) \
+                and key in self._records
+
+    def coverage_start(self, since, until):
+        """
+            查询 [since, until) 时间段时，存储可以回答的起始时间
+
+            :return: 存储覆盖 [返回值, until)，更早的部分需要查询ES；存储无法回答时返回 None
+        """
+        with self._cond:
+            if not self.active or self._watermark is None or self._watermark >= until:
+                return None
+            return max(since, self._watermark)
+
+    def find(self, since, until, event_ids=None, predicate=None) -> list:
+        """
+            查找 [since, until) 时间段内满足条件的事件
+
+            :param event_ids: 可选，事件ID集合
+            :param predicate: 可选，以事件字典为参数的判断函数
+        """
+        result = []
+        with self._cond:
+            start = bisect.bisect_left(self._bucket_keys, since.replace(second=0, microsecond=0))
+            for key in self._bucket_keys[start:]:
+                if key >= until:
+                    break
+                for ts, event in self._buckets[key]:
+                    if ts < since or ts >= until:
+                        continue
+                    if event_ids is not None and event.get("event_id") not in event_ids:
+                        continue
+                    if predicate is not None and not predicate(event):
+                        continue
+                    result.append(event)
+        return result
+
+    def covers(self, since) -> bool:
+        """
+            存储是否保存了 since 之后的全部事件，此时查找不到即可确认不存在
+        """
+        with self._cond:
+            return self.active and self._watermark is not None and self._watermark <= since
+
+    def last_match(self, since=None, until=None, event_id=None, terms=None, matches=None):
+        """
+            查找时间段内最近一条满足条件的事件
+
+            :param since: 起始时间(包含)，为空则不限
+            :param until: 结束时间(不包含)，为空则不限
+            :param event_id: 可选，事件ID
+            :param terms: 字段 -> 值，精确匹配；字段为 computer_name 或 event_data 下的字段名
+            :param matches: event_data 字段 -> 文本，忽略大小写，字段包含文本中的全部词，与ES的 match 查询一致
+            :return: 事件字典，不存在或条件中有未保存的字段时返回 None
+        """
+        if not is_stored(terms, matches):
+            return None
+        since = since or datetime.min
+        until = until or datetime.max
+        terms = terms or {}
+        match_tokens = {field: _tokens(text) for field, text in (matches or {}).items()}
+
+        index_keys = [(_index_field(field), value) for field, value in terms.items()
+                      if field == "computer_name" or field in INDEXED_FIELDS]
+        if event_id is not None:
+            index_keys.append(("event_id", event_id))
+
+        with self._cond:
+            if not index_keys:
+                candidates = [entry for key in self._bucket_keys for entry in self._buckets[key]]
+            else:
+                candidates = min((self._index.get(key, ()) for key in index_keys), key=len)
+            for ts, event in reversed(candidates):
+                if ts >= until:
+                    continue
+                if ts < since:
+                    if ts < since - ORDER_SLACK:
+                        break
+                    continue
+                if event_id is not None and event.get("event_id") != event_id:
+                    continue
+                if not _match_terms(event, terms) or not _match_tokens(event, match_tokens):
+                    continue
+                return event
+        return None
+
+    def exists(self, since=None, until=None, event_id=None, terms=None, matches=None):
+        """
+            :return: 是否存在满足条件的事件，条件中有未保存的字段时返回 None，需要查询ES
+        """
+        if not is_stored(terms, matches):
+            return None
+        return self.last_match(since, until, event_id, terms, matches) is not None
+
+
+def is_stored(terms=None, matches=None) -> bool:
+    """
+        条件中的字段是否都保存在存储中
+    """
+    for field in list(terms or {}) + list(matches or {}):
+        if field != "computer_name" and field not in STORED_FIELDS:
+            return False
+    return True
+
+
+def _compact(event: dict) -> dict:
+    """
+        只保留向前查找用到的字段，时间单独保存
+    """
+    event_data = event.get("event_data") or {}
+    return {
+        "event_id": event.get("event_id"),
+        "computer_name": event["computer_name"],
+        "record_number": event.get("record_number"),
+        "event_data": {field: event_data[field] for field in STORED_FIELDS if field in event_data}
+    }
+
+
+def _index_field(field):
+    return field if field == "computer_name" else "event_data." + field
+
+
+def _index_keys(event: dict) -> list:
+    keys = [("event_id", event.get("event_id")), ("computer_name", event["computer_name"])]
+    event_data = event.get("event_data")
+    if event_data:
+        for field in INDEXED_FIELDS:
+            value = event_data.get(field)
+            if value is not None:
+                keys.append(("event_data." + field, value))
+    return keys
+
+
+def _match_terms(event: dict, terms: dict) -> bool:
+    event_data = event.get("event_data", {})
+    for field, value in terms.items():
+        actual = event.get(field) if field == "computer_name" else event_data.get(field)
+        if actual != value:
+            return False
+    return True
+
+
+def _tokens(text) -> list:
+    return re.findall(r"\w+", str(text).lower())
+
+
+def _match_tokens(event: dict, match_tokens: dict) -> bool:
+    event_data = event.get("event_data", {})
+    for field, tokens in match_tokens.items():
+        value = event_data.get(field)
+        if value is None:
+            return False
+        value_tokens = set(_tokens(value))
+        if not all(t in value_tokens for t in tokens):
+            return False
+    return True
+
+
+recent_events = RecentEventStore()
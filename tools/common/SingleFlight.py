@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+# coding: utf-8
+# author: 9ian1i   https://github.com/Qianlitp
+
+"""
+    缓存未命中时的查询合并
+
+    同一账户的大量事件同时到达时，各检测线程会同时未命中缓存，并各自对同一个键发起LDAP或ES查询。
+    同一个键同时只执行一次查询，其它调用方等待并共享这次查询的结果：
+
+    1. 进程内：第一个调用方执行查询，其它线程等待它的结果
+    2. 进程间：执行查询前先通过 SET NX 获取 键 + LOCK_KEY_SUFFIX 的短期锁，查询完成后将结果写入锁的键，
+       其它进程轮询该键得到结果。锁过期或等待超时后自行查询
+
+    查询函数的返回值必须是字符串，查询出错时同一进程内的等待者得到同样的异常。
+"""
+
+import time
+import uuid
+import threading
+from concurrent.futures import Future
+
+from tools.common.Metrics import metrics
+from tools.database.RedisHelper import RedisHelper
+
+LOCK_KEY_SUFFIX = "_single_flight"
+# 锁的过期时间，应大于一次LDAP或ES查询的耗时，单位秒
+LOCK_EXPIRE = 30
+# 查询结果在锁的键中保留的时间，单位秒
+RESULT_EXPIRE = 5
+# 其它进程轮询结果的间隔，单位秒
+POLL_INTERVAL = 0.05
+# 锁的值为 RESULT_PREFIX + 结果时表示查询已完成
+RESULT_PREFIX = "="
+
+
+class SingleFlight(object):
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        # 键 -> 正在执行的查询的 Future
+        self._calls = {}
+
+    def do(self, key, func) -> str:
+        """
+            :param key: 查询结果对应的缓存键
+            :param func: 执行实际查询的函数，返回字符串
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+        if not leader:
+            metrics.inc("watchad_single_flight_shared_total", (("flight", self.name), ("scope", "process")))
+            return future.result()
+
+        try:
+            result = self._do_across_processes(key, func)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def _do_across_processes(self, key, func) -> str:
+        redis = RedisHelper()
+        lock_key = key + LOCK_KEY_SUFFIX
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + LOCK_EXPIRE
+        while True:
+            if redis.set_str_value_nx(lock_key, token, expire=LOCK_EXPIRE):
+                break
+            value = redis.get_str_value(lock_key)
+            if value is not None and value.startswith(RESULT_PREFIX):
+                metrics.inc("watchad_single_flight_shared_total", (("flight", self.name), ("scope", "redis")))
+                return value[len(RESULT_PREFIX):]
+            if time.monotonic() >= deadline:
+                # 持有锁的进程迟迟没有结果，不再等待
+                return func()
+            time.sleep(POLL_INTERVAL)
+
+        try:
+            result = func()
+        except BaseException:
+            # 释放锁，其它进程不必等到锁过期
+            redis.delete(lock_key)
+            raise
+        redis.set_str_value(lock_key, RESULT_PREFIX + result, expire=RESULT_EXPIRE)
+        return result
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+# coding: utf-8
+# author: 9ian1i   https://github.com/Qianlitp
+
+"""
+    滑动时间窗口计数
+
+    按 key (如来源IP) 统计时间窗口内每个 item (如目标用户) 出现的次数，每条事件的计数更新和
+    (当前item次数, 不同item数, 最大item次数) 的查询都是常数时间，不再需要每次都做一次聚合查询。
+
+    两种实现：
+        SlidingWindowCounter       进程内存，要求同一个 key 的事件都由同一个进程处理 (按 key 分片消费)
+        RedisSlidingWindowCounter  Redis 有序集合，多个进程共享计数
+
+    member 为事件的唯一标识，重复投递的事件不会重复计数。
+"""
+
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+from tools.common.common import datetime_utc_now_obj, str_to_datetime, datetime_to_common_str
+from tools.database.RedisHelper import RedisHelper
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class _WindowState(object):
+    __slots__ = ("events", "members", "counts", "freq", "max_count", "newest")
+
+    def __init__(self):
+        # 按到达顺序 [(时间, item, member)]
+        self.events = deque()
+        self.members = set()
+        # item -> 次数
+        self.counts = {}
+        # 次数 -> 该次数的item数，用于维护最大次数
+        self.freq = {}
+        self.max_count = 0
+        self.newest = None
+
+
+class SlidingWindowCounter(object):
+    def __init__(self, window: timedelta):
+        self.window = window
+        self._lock = threading.Lock()
+        self._states = {}
+        self._started = datetime_utc_now_obj()
+        self._newest = None
+        self._last_sweep = None
+
+    def coverage_start(self) -> datetime:
+        """
+            在此之后的事件都已计数，更早的时间段需要其它数据源补充
+        """
+        return self._started
+
+    def add(self, key, item, member, ts: datetime) -> (int, int, int):
+        """
+            :return: (当前item在窗口内的次数, 窗口内不同item数, 窗口内单个item的最大次数)
+        """
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                state = self._states[key] = _WindowState()
+            if member not in state.members:
+                state.events.append((ts, item, member))
+                state.members.add(member)
+                self._incr(state, item, 1)
+            if state.newest is None or ts > state.newest:
+                state.newest = ts
+            self._evict(state, state.newest - self.window)
+            self._sweep(ts)
+            return state.counts.get(item, 0), len(state.counts), state.max_count
+
+    def most_common(self, key, n) -> list:
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                return []
+            return sorted(state.counts.items(), key=lambda x: -x[1])[:n]
+
+    @staticmethod
+    def _incr(state: _WindowState, item, n):
+        count = state.counts.get(item, 0)
+        if count:
+            state.freq[count] -= 1
+        count += n
+        if count:
+            state.counts[item] = count
+            state.freq[count] = state.freq.get(count, 0) + 1
+        else:
+            del state.counts[item]
+        if count > state.max_count:
+            state.max_count = count
+        while state.max_count and not state.freq.get(state.max_count):
+            state.max_count -= 1
+
+    def _evict(self, state: _WindowState, cutoff: datetime):
+        while state.events and state.events[0][0] <= cutoff:
+            _, item, member = state.events.popleft()
+            state.members.discard(member)
+            self._incr(state, item, -1)
+
+    def _sweep(self, ts: datetime):
+        """
+            每分钟清理一次长时间没有新事件的 key
+        """
+        if self._newest is None or ts > self._newest:
+            self._newest = ts
+        if self._last_sweep is not None and self._newest - self._last_sweep < timedelta(minutes=1):
+            return
+        self._last_sweep = self._newest
+        cutoff = self._newest - self.window
+        for key in [k for k, s in self._states.items() if s.newest <= cutoff]:
+            del self._states[key]
+
+
+class RedisSlidingWindowCounter(object):
+    def __init__(self, window: timedelta, prefix: str):
+        self.window = window
+        self.prefix = prefix
+        self.redis = RedisHelper()
+        self._started = None
+
+    def coverage_start(self) -> datetime:
+        """
+            计数首次写入Redis的时间，各进程共用
+        """
+        if self._started is None:
+            start_key = self.prefix + "_window_start"
+            now = datetime_to_common_str(datetime_utc_now_obj())
+            self.redis.set_str_value_nx(start_key, now)
+            self._started = str_to_datetime(self.redis.get_str_value(start_key) or now)
+        return self._started
+
+    def add(self, key, item, member, ts: datetime) -> (int, int, int):
+        score = (ts - EPOCH).total_seconds()
+        return self.redis.sliding_window_add(
+            events_key="{prefix}_window_events:{key}".format(prefix=self.prefix, key=key),
+            counts_key="{prefix}_window_counts:{key}".format(prefix=self.prefix, key=key),
+            item=item,
+            member=member,
+            score=score,
+            cutoff=score - self.window.total_seconds(),
+            expire=int(self.window.total_seconds()) + 60
+        )
+
+    def most_common(self, key, n) -> list:
+        return self.redis.get_top_zset("{prefix}_window_counts:{key}".format(prefix=self.prefix, key=key), n)
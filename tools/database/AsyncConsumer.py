@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+# coding: utf-8
+# author: 9ian1i   https://github.com/Qianlitp
+
+"""
+    基于 asyncio 事件循环的消费者
+
+    每条消息作为一个协程任务处理，预取窗口即进程内同时处理的最大消息数，处理完成后手动确认
+    分片模式下消费当前进程的分片队列，与 Consumer 一致
+"""
+import asyncio
+import traceback
+import logging
+import pika
+import simplejson
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+from settings.database_config import MqConfig
+from tools.common.Logger import logger
+
+logging.getLogger("pika").setLevel(logging.ERROR)
+
+
+class AsyncConsumer(object):
+    def __init__(self, loop=None, shard_index=None):
+        """
+            :param shard_index: 分片模式下当前进程的分片序号，消费对应的分片队列
+        """
+        self.auth = pika.PlainCredentials(MqConfig.user, MqConfig.password)
+        self.loop = loop or asyncio.get_event_loop()
+        self.shard_index = shard_index
+        self.queue = MqConfig.main_queue if shard_index is None else MqConfig.shard_queue_prefix + str(shard_index)
+        if shard_index is None:
+            self.exchange = MqConfig.exchange
+            self.exchange_type = MqConfig.exchange_type
+            self.routing_key = None
+        else:
+            # 分片队列只接收路由进程按队列名转发的消息
+            self.exchange = MqConfig.shard_exchange
+            self.exchange_type = "direct"
+            self.routing_key = self.queue
+        self.connection = None
+        self.channel = None
+        self.handle_coro = None
+
+    def connect(self):
+        self.connection = AsyncioConnection(pika.ConnectionParameters(
+            host=MqConfig.host,
+            port=MqConfig.port,
+            credentials=self.auth,
+            heartbeat=0
+        ), on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_error,
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=self.loop)
+
+    def run(self, handle_coro):
+        """
+            :param handle_coro: 接收消息字典的协程函数
+        """
+        self.handle_coro = handle_coro
+        self.connect()
+        self.loop.run_forever()
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, connection, error):
+        logger.error("async consumer connect error: " + str(error))
+        self.loop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        logger.error("async consumer connection closed: " + str(reason))
+        self.loop.stop()
+
+    def _on_channel_open(self, channel):
+        self.channel = channel
+        self.channel.basic_qos(prefetch_count=MqConfig.async_max_in_flight, callback=self._on_qos_ok)
+
+    def _on_qos_ok(self, frame):
+        self.channel.exchange_declare(exchange=self.exchange, exchange_type=self.exchange_type, durable=True,
+                                      callback=self._on_exchange_ok)
+
+    def _on_exchange_ok(self, frame):
+        self.channel.queue_declare(queue=self.queue, durable=True, callback=self._on_queue_ok)
+
+    def _on_queue_ok(self, frame):
+        self.channel.queue_bind(queue=self.queue, exchange=self.exchange, routing_key=self.routing_key,
+                                callback=self._on_bind_ok)
+
+    def _on_bind_ok(self, frame):
+        self.channel.basic_consume(queue=self.queue, on_message_callback=self.callback, auto_ack=False)
+
+    def callback(self, ch, method, properties, body):
+        self.loop.create_task(self._handle(method.delivery_tag, body))
+
+    async def _handle(self, delivery_tag, body):
+        try:
+            assert isinstance(body, bytes)
+            message = simplejson.loads(body.decode("utf-8"))
+
+            await self.handle_coro(message)
+
+        except Exception as e:
+            traceback.print_exc()
+        finally:
+            if self.channel and self.channel.is_open:
+                self.channel.basic_ack(delivery_tag=delivery_tag)
@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+# coding: utf-8
+# author: 9ian1i   https://github.com/Qianlitp
+
+"""
+    进程内共用的ES批量写入
+
+    用户活动、票据记录等写入先放入内存队列，由后台线程在满足以下任一条件时提交 bulk 请求：
+
+        1. 队列中的文档数达到 ElasticConfig.bulk_max_docs
+        2. 队列中的数据量达到 ElasticConfig.bulk_max_bytes
+        3. 最早的文档等待超过 ElasticConfig.bulk_flush_interval 秒
+
+    队列总数据量超过 ElasticConfig.bulk_queue_max_bytes 时写入方阻塞等待。
+    被ES拒绝 (429/503) 的文档和整个请求失败时按指数退避重试，其它单条失败记录日志和监控指标后丢弃。
+    进程收到 SIGQUIT/SIGTERM 或正常退出时，先写完队列中的剩余数据。
+"""
+
+import os
+import time
+import atexit
+import signal
+import threading
+from collections import deque
+
+import simplejson
+
+from settings.database_config import ElasticConfig
+from tools.common.Logger import logger
+from tools.common.Metrics import metrics
+from tools.database.ElsaticHelper import ElasticHelper
+
+# 可以重试的单条写入状态码
+RETRY_STATUS = (429, 503)
+# 重试间隔，单位秒，每次翻倍直到上限
+RETRY_BACKOFF = 0.5
+RETRY_BACKOFF_MAX = 30
+# 退出时等待剩余数据写入的最长时间，单位秒
+DRAIN_TIMEOUT = 8
+
+
+class BulkIndexer(object):
+    def __init__(self, max_docs=ElasticConfig.bulk_max_docs, max_bytes=ElasticConfig.bulk_max_bytes,
+                 flush_interval=ElasticConfig.bulk_flush_interval, queue_max_bytes=ElasticConfig.bulk_queue_max_bytes,
+                 max_retries=ElasticConfig.bulk_max_retries):
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.queue_max_bytes = queue_max_bytes
+        self.max_retries = max_retries
+        self._cond = threading.Condition()
+        # [(action, 文档, 字节数)]
+        self._queue = deque()
+        self._queue_bytes = 0
+        self._oldest = None
+        self._closed = False
+        self._thread = None
+        self._es = None
+
+    def add(self, body: dict, index: str, doc_type: str):
+        action = {"index": {"_index": index, "_type": doc_type}}
+        size = len(simplejson.dumps(body, default=str)) + len(index) + len(doc_type) + 40
+        with self._cond:
+            closed = self._closed
+        if closed:
+            # 退出过程中的写入直接提交
+            self._write([(action, body, size)])
+            return
+        with self._cond:
+            if self._thread is None:
+                self._es = ElasticHelper()
+                self._thread = threading.Thread(target=self._run, name="bulk_indexer", daemon=True)
+                self._thread.start()
+            while self._queue and self._queue_bytes + size > self.queue_max_bytes:
+                self._cond.wait()
+            self._queue.append((action, body, size))
+            self._queue_bytes += size
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if len(self._queue) >= self.max_docs or self._queue_bytes >= self.max_bytes:
+                self._cond.notify_all()
+
+    def close(self, timeout=DRAIN_TIMEOUT):
+        """
+            停止接收并等待队列中的数据写入完成
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+            if thread.is_alive():
+                logger.error("bulk indexer drain timeout, {num} docs not written".format(num=len(self._queue)))
+
+    def _ready(self) -> bool:
+        if not self._queue:
+            return False
+        return self._closed or len(self._queue) >= self.max_docs or self._queue_bytes >= self.max_bytes \
+            or time.monotonic() - self._oldest >= self.flush_interval
+
+    def _take(self) -> list:
+        batch = []
+        batch_bytes = 0
+        while self._queue and len(batch) < self.max_docs and (not batch or batch_bytes < self.max_bytes):
+            entry = self._queue.popleft()
+            batch.append(entry)
+            batch_bytes += entry[2]
+        self._queue_bytes -= batch_bytes
+        self._oldest = time.monotonic() if self._queue else None
+        # 唤醒等待队列空间的写入方
+        self._cond.notify_all()
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._ready():
+                    if self._closed and not self._queue:
+                        return
+                    timeout = None
+                    if self._oldest is not None:
+                        timeout = max(self.flush_interval - (time.monotonic() - self._oldest), 0.01)
+                    self._cond.wait(timeout)
+                batch = self._take()
+            try:
+                self._write(batch)
+            except Exception as e:
+                logger.error("bulk indexer error: " + str(e))
+
+    def _write(self, batch: list):
+        es = self._es or ElasticHelper()
+        retries = 0
+        while batch:
+            body = []
+            for action, doc, _ in batch:
+                body.append(action)
+                body.append(doc)
+            retry = []
+            failed = 0
+            try:
+                rsp = es.bulk(body=body)
+            except Exception as e:
+                logger.error("bulk request error: " + str(e))
+                retry = batch
+            else:
+                if rsp.get("errors"):
+                    for item, entry in zip(rsp["items"], batch):
+                        result = list(item.values())[0]
+                        status = result.get("status", 200)
+                        if status in RETRY_STATUS:
+                            retry.append(entry)
+                        elif status >= 300 or result.get("error"):
+                            self._report_failure(entry, status, result.get("error"))
+                            failed += 1
+            metrics.inc("watchad_bulk_docs_total", n=len(batch) - len(retry) - failed)
+            if not retry:
+                return
+            retries += 1
+            if retries > self.max_retries:
+                for entry in retry:
+                    self._report_failure(entry, "retry exceeded", None)
+                return
+            time.sleep(min(RETRY_BACKOFF * 2 ** (retries - 1), RETRY_BACKOFF_MAX))
+            batch = retry
+
+    @staticmethod
+    def _report_failure(entry, status, error):
+        action = entry[0]["index"]
+        logger.error("bulk index failed: {index} {status} {error}".format(index=action["_index"], status=status,
+                                                                          error=simplejson.dumps(error)))
+        metrics.inc("watchad_bulk_errors_total", (("doc_type", action["_type"]),))
+
+
+bulk_indexer = BulkIndexer()
+
+
+def install_signal_handlers():
+    """
+        收到 SIGQUIT/SIGTERM 或正常退出时写完剩余数据，只能在主线程中调用
+    """
+    def _handler(signum, frame):
+        logger.info("received signal {num}, draining bulk indexer".format(num=signum))
+        bulk_indexer.close()
+        previous = previous_handlers[signum]
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            # 恢复原处理方式后重新发送信号
+            signal.signal(signum, previous if previous is not None else signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    previous_handlers = {}
+    for sig in (signal.SIGQUIT, signal.SIGTERM):
+        previous_handlers[sig] = signal.getsignal(sig)
+        signal.signal(sig, _handler)
+    atexit.register(bulk_indexer.close)
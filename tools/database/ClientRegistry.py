@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+# coding: utf-8
+# author: 9ian1i   https://github.com/Qianlitp
+
+"""
+    进程内共享的数据库客户端
+
+    各个检测模块、告警处理都会创建自己的 Helper 对象，底层客户端在进程内只创建一次，
+    所有 Helper 共用同一个连接池，连接池大小在 database_config 中配置
+"""
+
+import threading
+
+import redis
+from pymongo import MongoClient
+from elasticsearch5 import Elasticsearch
+
+from settings.database_config import ElasticConfig, MongoConfig, RedisConfig
+
+_lock = threading.Lock()
+_mongo_clients = {}
+_redis_client = None
+_es_client = None
+_mongo_override = None
+
+
+def install_clients(mongo=None, redis_client=None, es=None):
+    """
+        替换进程内的底层客户端，用于离线回放和基准测试，需要在创建任何 Helper 之前调用
+    """
+    global _mongo_override, _redis_client, _es_client
+    with _lock:
+        if mongo is not None:
+            _mongo_override = mongo
+        if redis_client is not None:
+            _redis_client = redis_client
+        if es is not None:
+            _es_client = es
+
+
+def get_mongo_client(uri) -> MongoClient:
+    if _mongo_override is not None:
+        return _mongo_override
+    client = _mongo_clients.get(uri)
+    if client is not None:
+        return client
+    with _lock:
+        if uri not in _mongo_clients:
+            _mongo_clients[uri] = MongoClient(uri, connect=False, maxPoolSize=MongoConfig.max_pool_size)
+        return _mongo_clients[uri]
+
+
+def get_redis_client() -> redis.Redis:
+    global _redis_client
+    if _redis_client is not None:
+        return _redis_client
+    with _lock:
+        if _redis_client is None:
+            kwargs = {
+                "host": RedisConfig.host,
+                "port": RedisConfig.port,
+                "max_connections": RedisConfig.max_connections,
+                "timeout": RedisConfig.pool_timeout
+            }
+            if hasattr(RedisConfig, "password"):
+                kwargs["password"] = RedisConfig.password
+            # 连接池用尽时阻塞等待，而不是直接抛出异常
+            pool = redis.BlockingConnectionPool(**kwargs)
+            _redis_client = redis.Redis(connection_pool=pool)
+        return _redis_client
+
+
+def get_es_client() -> Elasticsearch:
+    global _es_client
+    if _es_client is not None:
+        return _es_client
+    with _lock:
+        if _es_client is None:
+            _es_client = Elasticsearch(ElasticConfig.uri, maxsize=ElasticConfig.max_connections)
+        return _es_client
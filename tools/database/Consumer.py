@@ -17,11 +17,20 @@ logging.getLogger("pika").setLevel(logging.ERROR)
 
 
 class Consumer(object):
-    def __init__(self):
+    def __init__(self, shard_index=None):
+        """
+            :param shard_index: 分片模式下当前进程的分片序号，消费对应的分片队列
+        """
         self.auth = pika.PlainCredentials(MqConfig.user, MqConfig.password)
+        self.shard_index = shard_index
+        self.queue = MqConfig.main_queue if shard_index is None else MqConfig.shard_queue_prefix + str(shard_index)
         self.connection = None
         self.channel = None
         self.handle_func = None
+        self.handle_batch_func = None
+        self._batch = []
+        self._batch_last_tag = None
+        self._batch_timer = None
 
     def check_connection(self) -> bool:
         """
@@ -50,16 +59,54 @@ class Consumer(object):
         ))
         self.channel = self.connection.channel()
         self.channel.basic_qos(prefetch_count=1)
-        self.channel.exchange_declare(exchange=MqConfig.exchange, exchange_type=MqConfig.exchange_type, durable=True)
-        self.channel.queue_declare(queue=MqConfig.main_queue, durable=True)
-        self.channel.queue_bind(exchange=MqConfig.exchange, queue=MqConfig.main_queue)
-        self.channel.basic_consume(queue=MqConfig.main_queue, on_message_callback=self.callback, auto_ack=True)
+        self._declare_queue()
+        self.channel.basic_consume(queue=self.queue, on_message_callback=self.callback, auto_ack=True)
+
+    def connect_batch(self):
+        """
+            批量消费模式的队列连接
+
+            关闭自动确认，按预取窗口拉取消息，整批处理完成后再统一确认
+        """
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(
+            host=MqConfig.host,
+            port=MqConfig.port,
+            credentials=self.auth,
+            heartbeat=0
+        ))
+        self.channel = self.connection.channel()
+        # 预取窗口小于批次大小时，批次只能等超时才能提交
+        self.channel.basic_qos(prefetch_count=max(MqConfig.prefetch_count, MqConfig.batch_size))
+        self._declare_queue()
+        self.channel.basic_consume(queue=self.queue, on_message_callback=self.batch_callback, auto_ack=False)
+
+    def _declare_queue(self):
+        if self.shard_index is None:
+            self.channel.exchange_declare(exchange=MqConfig.exchange, exchange_type=MqConfig.exchange_type,
+                                          durable=True)
+            self.channel.queue_declare(queue=self.queue, durable=True)
+            self.channel.queue_bind(exchange=MqConfig.exchange, queue=self.queue)
+        else:
+            # 分片队列只接收路由进程按队列名转发的消息
+            self.channel.exchange_declare(exchange=MqConfig.shard_exchange, exchange_type="direct", durable=True)
+            self.channel.queue_declare(queue=self.queue, durable=True)
+            self.channel.queue_bind(exchange=MqConfig.shard_exchange, queue=self.queue, routing_key=self.queue)
 
     def run(self, handle_func):
         self.connect()
         self.handle_func = handle_func
         self.channel.start_consuming()
 
+    def run_batch(self, handle_batch_func):
+        """
+            批量消费
+
+            :param handle_batch_func: 接收消息字典列表的处理函数
+        """
+        self.connect_batch()
+        self.handle_batch_func = handle_batch_func
+        self.channel.start_consuming()
+
     def callback(self, ch, method, properties, body):
         # print(ch)
         # print(method)
@@ -73,6 +120,44 @@ class Consumer(object):
         except Exception as e:
             traceback.print_exc()
 
+    def batch_callback(self, ch, method, properties, body):
+        try:
+            assert isinstance(body, bytes)
+            message = simplejson.loads(body.decode("utf-8"))
+            self._batch.append(message)
+        except Exception as e:
+            # 无法解析的消息同样随批次确认丢弃，避免反复投递
+            traceback.print_exc()
+        self._batch_last_tag = method.delivery_tag
+
+        if len(self._batch) >= MqConfig.batch_size:
+            self._flush_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = self.connection.call_later(MqConfig.batch_timeout, self._on_batch_timeout)
+
+    def _on_batch_timeout(self):
+        self._batch_timer = None
+        self._flush_batch()
+
+    def _flush_batch(self):
+        """
+            处理当前批次，全部检测和告警入库完成后确认到最后一条消息
+        """
+        if self._batch_timer is not None:
+            self.connection.remove_timeout(self._batch_timer)
+            self._batch_timer = None
+        if self._batch_last_tag is None:
+            return
+
+        batch = self._batch
+        last_tag = self._batch_last_tag
+        self._batch = []
+        self._batch_last_tag = None
+
+        if batch:
+            self.handle_batch_func(batch)
+        self.channel.basic_ack(delivery_tag=last_tag, multiple=True)
+
 
 if __name__ == '__main__':
     Consumer().check_connection()
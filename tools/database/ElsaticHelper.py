@@ -2,57 +2,56 @@
 # coding: utf-8
 # author: 9ian1i   https://github.com/Qianlitp
 
-import time
 import logging
-from elasticsearch5 import Elasticsearch, helpers
+from datetime import timedelta
+from elasticsearch5 import helpers
 from tools.common.Logger import logger
-from tools.common.common import datetime_now_obj, get_n_min_ago
+from tools.common.Metrics import instrument_backend
+from tools.database.ClientRegistry import get_es_client
+from tools.database.SearchBatcher import search_batcher
+from tools.common.common import datetime_now_obj, get_n_min_ago, datetime_utc_now_obj
 
 from settings.database_config import ElasticConfig
 
 logging.getLogger("elasticsearch").setLevel(logging.ERROR)
 
+# 按天划分的索引: 别名 -> 索引前缀
+# 事件日志按 @timestamp 的UTC日期写入。用户活动和票据记录按写入时的本地日期写入，目前没有带时间范围的查询，仍查询别名
+DAILY_INDICES = {
+    ElasticConfig.event_log_index: ElasticConfig.event_log_write_index_prefix
+}
+# 时间范围覆盖的天数超过该值时直接查询别名
+TIME_INDICES_MAX_DAYS = 7
+# 未指定结束时间时，结束时间为当前时间加上该值，容忍日志时间与本机时间的偏差
+CLOCK_SKEW = timedelta(minutes=5)
 
+
+@instrument_backend("es")
 class ElasticHelper(object):
     def __init__(self):
-        self.es = Elasticsearch(ElasticConfig.uri)
+        # 进程内共用同一个ES客户端连接池
+        self.es = get_es_client()
         self._multi_search_results = []
-        self.bulk_task_queue = []
-        self.bulk_last_time = datetime_now_obj()
-
-    def delay_index(self, body, index, doc_type):
-        self.bulk_task_queue.append({
-            "index": {"_index": index, "_type": doc_type}
-        })
-        self.bulk_task_queue.append(body)
-
-        if self._can_do_bulk():
-            self.bulk(body=self.bulk_task_queue, index=index, doc_type=doc_type)
-            self.bulk_task_queue = []
-
-        self.bulk_last_time = datetime_now_obj()
-
-    def _can_do_bulk(self):
-        # 任务队列超过100条数据
-        if len(self.bulk_task_queue) > 100:
-            return True
-        # 时间间隔超过1分钟
-        if get_n_min_ago(1) > self.bulk_last_time:
-            return True
-        return False
 
     def index(self, body, index, doc_type):
         self.es.index(body=body, index=index, doc_type=doc_type)
 
-    def bulk(self, body, index, doc_type):
-        self.es.bulk(body=body, index=index, doc_type=doc_type)
+    def bulk(self, body, index=None, doc_type=None):
+        return self.es.bulk(body=body, index=index, doc_type=doc_type)
 
     def scan(self, body, index, doc_type):
         return helpers.scan(self.es, query=body, index=index, doc_type=doc_type, preserve_order=True)
 
-    def search(self, body, index, doc_type):
+    def search(self, body, index, doc_type, **params):
+        """
+            :param params: 其它请求参数，如查询 get_time_indices 返回的索引时使用 ignore_unavailable=True
+        """
         try:
-            rsp = self.es.search(body=body, index=index, doc_type=doc_type, request_timeout=100)
+            if ElasticConfig.search_batch_window > 0:
+                # 与同一时间窗口内的其它检索合并为一次 _msearch 请求
+                rsp = search_batcher.search(body=body, index=index, doc_type=doc_type, **params)
+            else:
+                rsp = self.es.search(body=body, index=index, doc_type=doc_type, request_timeout=100, **params)
             if rsp.get("error"):
                 logger.error(rsp.get("error").get("reason"))
                 return
@@ -67,6 +66,34 @@ class ElasticHelper(object):
     def delete_index(self, index):
         return self.es.indices.delete(index=index)
 
+    def exists_index(self, index) -> bool:
+        return self.es.indices.exists(index=index)
+
+    def get_settings(self, index, **kwargs):
+        return self.es.indices.get_settings(index=index, **kwargs)
+
+    def put_settings(self, body, index):
+        return self.es.indices.put_settings(body=body, index=index)
+
+    def get_alias(self, index):
+        return self.es.indices.get_alias(index=index)
+
+    def update_aliases(self, body):
+        return self.es.indices.update_aliases(body=body)
+
+    def shrink(self, index, target, body):
+        return self.es.indices.shrink(index=index, target=target, body=body, request_timeout=600)
+
+    def force_merge(self, index, max_num_segments):
+        # 合并完成后才返回
+        return self.es.indices.forcemerge(index=index, max_num_segments=max_num_segments, request_timeout=3600)
+
+    def cluster_health(self, index, **kwargs):
+        return self.es.cluster.health(index=index, request_timeout=3600, **kwargs)
+
+    def nodes_stats(self, metric):
+        return self.es.nodes.stats(metric=metric)
+
     def put_template(self, name, body, **kwargs):
         return self.es.indices.put_template(name=name, body=body, create=True, **kwargs)
 
@@ -79,39 +106,6 @@ class ElasticHelper(object):
     def get_template(self, name, **kwargs):
         return self.es.indices.get_template(name=name, **kwargs)
 
-    def wait_log_in_database(self, computer_name, record_number):
-        """
-            因为消息队列和入库ES是分开进行的，所以可能会出现当消费到某条日志时，ES还没入库，所以需要检查同步
-        """
-        count = 0
-        query = {
-            "query": get_must_statement(
-                get_term_statement("computer_name", computer_name),
-                get_term_statement("record_number", record_number)
-            ),
-            "_source": False,
-            "size": 1
-        }
-        while True:
-            try:
-                rsp = self.es.search(body=query,
-                                     index=ElasticConfig.event_log_index,
-                                     doc_type=ElasticConfig.event_log_doc_type,
-                                     request_timeout=100)
-                if rsp.get("error"):
-                    logger.error(rsp.get("error").get("reason"))
-                    break
-                if len(rsp["hits"]["hits"]) > 0:
-                    return rsp["hits"]["hits"][0]["_id"]
-                time.sleep(2)
-                # 最多等5次，即 2 * 5 = 10秒
-                if count == 10:
-                    break
-                count += 1
-            except Exception as e:
-                logger.error("es wait_log_in_database search error: " + str(e))
-                break
-
     def multi_search(self, body, index, doc_type):
         try:
             rsp = self.es.msearch(body=body,
@@ -126,6 +120,28 @@ class ElasticHelper(object):
             logger.error("es msearch error: " + str(e))
 
 
+def get_time_indices(alias, since, until=None) -> str:
+    """
+        将查询的时间范围 [since, until] 解析为覆盖的按天索引，检索只涉及这几天的分片
+
+        尚未创建或已被删除的索引需要在查询时通过 ignore_unavailable 忽略
+
+        :param alias: 索引别名，如 ElasticConfig.event_log_index
+        :param since: 起始时间，UTC
+        :param until: 结束时间，UTC，为空则为当前时间
+        :return: 逗号分隔的索引名，无法解析时返回别名
+    """
+    if alias not in DAILY_INDICES or since is None:
+        return alias
+    prefix = DAILY_INDICES[alias]
+    if until is None:
+        until = datetime_utc_now_obj() + CLOCK_SKEW
+    days = (until.date() - since.date()).days
+    if days < 0 or days >= TIME_INDICES_MAX_DAYS:
+        return alias
+    return ",".join(prefix + (since.date() + timedelta(days=n)).strftime("%Y.%m.%d") for n in range(days + 1))
+
+
 def get_time_range(compare, time, time_zone_offset=False):
     if time_zone_offset:
         return {
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+# coding: utf-8
+# author: 9ian1i   https://github.com/Qianlitp
+
+"""
+    最近事件接收
+
+    每个进程声明一个独占的临时队列绑定到主交换机 (fanout)，在后台线程中接收全部事件写入最近事件存储，
+    登录/注销事件同时写入登录会话表。
+    与检测消费者使用不同的连接，连接断开期间的事件无法补齐，重连后存储从当前时间重新开始覆盖。
+"""
+
+import time
+import logging
+import threading
+import traceback
+import pika
+import simplejson
+
+from settings.database_config import MqConfig
+from tools.common.Logger import logger
+from tools.common.RecentEventStore import RecentEventStore
+from tools.common.LogonSessionTable import LogonSessionTable
+
+logging.getLogger("pika").setLevel(logging.ERROR)
+
+# 连接断开后的重连间隔，单位秒
+RECONNECT_INTERVAL = 5
+
+
+class EventFeed(object):
+    def __init__(self, store: RecentEventStore, sessions: LogonSessionTable = None):
+        self.auth = pika.PlainCredentials(MqConfig.user, MqConfig.password)
+        self.store = store
+        self.sessions = sessions
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="event_feed", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                connection = pika.BlockingConnection(pika.ConnectionParameters(
+                    host=MqConfig.host,
+                    port=MqConfig.port,
+                    credentials=self.auth,
+                    heartbeat=0
+                ))
+                channel = connection.channel()
+                channel.basic_qos(prefetch_count=MqConfig.prefetch_count)
+                channel.exchange_declare(exchange=MqConfig.exchange, exchange_type=MqConfig.exchange_type,
+                                         durable=True)
+                result = channel.queue_declare(queue="", exclusive=True, auto_delete=True)
+                queue = result.method.queue
+                channel.queue_bind(exchange=MqConfig.exchange, queue=queue)
+                channel.basic_consume(queue=queue, on_message_callback=self.callback, auto_ack=True)
+                self.store.start()
+                logger.info("recent event feed started: " + queue)
+                channel.start_consuming()
+            except Exception as e:
+                logger.error("recent event feed error: " + str(e))
+            self.store.stop()
+            time.sleep(RECONNECT_INTERVAL)
+
+    def callback(self, ch, method, properties, body):
+        try:
+            message = simplejson.loads(body.decode("utf-8"))
+            if message.get("type") == "wineventlog":
+                self.store.add(message)
+                if self.sessions is not None:
+                    self.sessions.add(message)
+        except Exception as e:
+            traceback.print_exc()
@@ -0,0 +1,1016 @@
+#!/usr/bin/python3
+# coding: utf-8
+# author: 9ian1i   https://github.com/Qianlitp
+
+"""
+    ES、Mongo、Redis、LDAP 的内存替身，用于离线回放和基准测试
+
+    只实现检测引擎实际用到的接口和查询语法，数据全部保存在进程内存中。
+    每次调用计为一次后端往返，并可以注入固定延迟，模拟真实网络和后端的耗时：
+
+        stats = BackendStats()
+        es = MemoryElasticsearch(stats, latency=0.002)
+        install_clients(es=es)
+
+    注意：本模块不能导入 settings.config，否则会在替换客户端之前创建真实的 Redis 连接
+"""
+
+import re
+import copy
+import time
+import fnmatch
+import threading
+from datetime import datetime
+from collections import defaultdict, namedtuple
+
+from bson import ObjectId
+from ldap3 import Server, Connection, MOCK_SYNC, OFFLINE_AD_2012_R2
+
+_TIME_FORMATS = ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%d %H:%M:%S")
+
+
+class BackendStats(object):
+    """
+        按 后端、操作 统计往返次数
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = defaultdict(int)
+
+    def record(self, backend, op):
+        with self._lock:
+            self.counts[(backend, op)] += 1
+
+    def total(self, backend=None) -> int:
+        with self._lock:
+            return sum(count for (b, _), count in self.counts.items() if backend is None or b == backend)
+
+    def reset(self):
+        with self._lock:
+            self.counts.clear()
+
+
+class _MemoryBase(object):
+    BACKEND = ""
+
+    def __init__(self, stats: BackendStats = None, latency: float = 0.0):
+        """
+            :param stats: 往返次数统计
+            :param latency: 每次往返注入的延迟，单位秒
+        """
+        self._stats = stats
+        self._latency = latency
+        self._lock = threading.RLock()
+
+    def _round_trip(self, op):
+        if self._stats is not None:
+            self._stats.record(self.BACKEND, op)
+        if self._latency > 0:
+            time.sleep(self._latency)
+
+
+# ---------------------------------------- Redis ----------------------------------------
+
+
+def _to_bytes(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    return str(value).encode("utf-8")
+
+
+class MemoryRedis(_MemoryBase):
+    BACKEND = "redis"
+
+    def __init__(self, stats=None, latency=0.0):
+        super().__init__(stats, latency)
+        self._data = {}
+        self._deadline = {}
+
+    def _alive(self, key):
+        deadline = self._deadline.get(key)
+        if deadline is not None and deadline <= time.time():
+            self._data.pop(key, None)
+            self._deadline.pop(key, None)
+        return key in self._data
+
+    def _get_typed(self, key, factory, create=False):
+        """
+            读取集合类型的值，只有写操作才会创建不存在的键
+        """
+        key = _to_bytes(key)
+        if not self._alive(key):
+            if not create:
+                return factory()
+            self._data[key] = factory()
+        return self._data[key]
+
+    def pipeline(self, transaction=True):
+        return MemoryRedisPipeline(self)
+
+    def pubsub(self, **kwargs):
+        return MemoryPubSub()
+
+    def _call(self, op, *args, **kwargs):
+        self._round_trip(op)
+        with self._lock:
+            return getattr(self, "_" + op)(*args, **kwargs)
+
+    def get(self, name):
+        return self._call("get", name)
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        return self._call("set", name, value, ex, px, nx, xx)
+
+    def delete(self, *names):
+        return self._call("delete", *names)
+
+    def exists(self, *names):
+        return self._call("exists", *names)
+
+    def expire(self, name, time_):
+        return self._call("expire", name, time_)
+
+    def ttl(self, name):
+        return self._call("ttl", name)
+
+    def incr(self, name, amount=1):
+        return self._call("incr", name, amount)
+
+    def sadd(self, name, *values):
+        return self._call("sadd", name, *values)
+
+    def srem(self, name, *values):
+        return self._call("srem", name, *values)
+
+    def smembers(self, name):
+        return self._call("smembers", name)
+
+    def sismember(self, name, value):
+        return self._call("sismember", name, value)
+
+    def scard(self, name):
+        return self._call("scard", name)
+
+    def lpush(self, name, *values):
+        return self._call("lpush", name, *values)
+
+    def rpush(self, name, *values):
+        return self._call("rpush", name, *values)
+
+    def lrange(self, name, start, end):
+        return self._call("lrange", name, start, end)
+
+    def hset(self, name, key, value):
+        return self._call("hset", name, key, value)
+
+    def hget(self, name, key):
+        return self._call("hget", name, key)
+
+    def hgetall(self, name):
+        return self._call("hgetall", name)
+
+    def hdel(self, name, *keys):
+        return self._call("hdel", name, *keys)
+
+    def zadd(self, name, mapping, nx=False, xx=False):
+        return self._call("zadd", name, mapping, nx, xx)
+
+    def zincrby(self, name, amount, value):
+        return self._call("zincrby", name, amount, value)
+
+    def zscore(self, name, value):
+        return self._call("zscore", name, value)
+
+    def zcard(self, name):
+        return self._call("zcard", name)
+
+    def zrangebyscore(self, name, min, max, withscores=False):
+        return self._call("zrangebyscore", name, min, max, withscores)
+
+    def zremrangebyscore(self, name, min, max):
+        return self._call("zremrangebyscore", name, min, max)
+
+    def zrevrange(self, name, start, end, withscores=False):
+        return self._call("zrevrange", name, start, end, withscores)
+
+    def publish(self, channel, message):
+        self._round_trip("publish")
+        return 0
+
+    # ------ 以下为实际操作，调用时已持有锁 ------
+
+    def _get(self, name):
+        name = _to_bytes(name)
+        return self._data.get(name) if self._alive(name) else None
+
+    def _set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        name = _to_bytes(name)
+        exists = self._alive(name)
+        if (nx and exists) or (xx and not exists):
+            return None
+        self._data[name] = _to_bytes(value)
+        self._deadline.pop(name, None)
+        if ex:
+            self._deadline[name] = time.time() + ex
+        elif px:
+            self._deadline[name] = time.time() + px / 1000.0
+        return True
+
+    def _delete(self, *names):
+        count = 0
+        for name in map(_to_bytes, names):
+            if self._alive(name):
+                count += 1
+            self._data.pop(name, None)
+            self._deadline.pop(name, None)
+        return count
+
+    def _exists(self, *names):
+        return sum(1 for name in map(_to_bytes, names) if self._alive(name))
+
+    def _expire(self, name, time_):
+        name = _to_bytes(name)
+        if not self._alive(name):
+            return False
+        self._deadline[name] = time.time() + time_
+        return True
+
+    def _ttl(self, name):
+        name = _to_bytes(name)
+        if not self._alive(name):
+            return -2
+        if name not in self._deadline:
+            return -1
+        return int(self._deadline[name] - time.time())
+
+    def _incr(self, name, amount=1):
+        name = _to_bytes(name)
+        value = int(self._data[name]) + amount if self._alive(name) else amount
+        self._data[name] = _to_bytes(value)
+        return value
+
+    def _sadd(self, name, *values):
+        s = self._get_typed(name, set, create=True)
+        before = len(s)
+        s.update(map(_to_bytes, values))
+        return len(s) - before
+
+    def _srem(self, name, *values):
+        s = self._get_typed(name, set)
+        before = len(s)
+        s.difference_update(map(_to_bytes, values))
+        return before - len(s)
+
+    def _smembers(self, name):
+        return set(self._get_typed(name, set))
+
+    def _sismember(self, name, value):
+        return _to_bytes(value) in self._get_typed(name, set)
+
+    def _scard(self, name):
+        return len(self._get_typed(name, set))
+
+    def _lpush(self, name, *values):
+        lst = self._get_typed(name, list, create=True)
+        for value in values:
+            lst.insert(0, _to_bytes(value))
+        return len(lst)
+
+    def _rpush(self, name, *values):
+        lst = self._get_typed(name, list, create=True)
+        lst.extend(map(_to_bytes, values))
+        return len(lst)
+
+    def _lrange(self, name, start, end):
+        lst = self._get_typed(name, list)
+        end = len(lst) if end == -1 else end + 1
+        return list(lst[start:end])
+
+    def _hset(self, name, key, value):
+        h = self._get_typed(name, dict, create=True)
+        key = _to_bytes(key)
+        created = key not in h
+        h[key] = _to_bytes(value)
+        return int(created)
+
+    def _hget(self, name, key):
+        return self._get_typed(name, dict).get(_to_bytes(key))
+
+    def _hgetall(self, name):
+        return dict(self._get_typed(name, dict))
+
+    def _hdel(self, name, *keys):
+        h = self._get_typed(name, dict)
+        return sum(1 for key in map(_to_bytes, keys) if h.pop(key, None) is not None)
+
+
+    def _zadd(self, name, mapping, nx=False, xx=False):
+        z = self._get_typed(name, dict, create=True)
+        added = 0
+        for value, score in mapping.items():
+            value = _to_bytes(value)
+            exists = value in z
+            if (nx and exists) or (xx and not exists):
+                continue
+            z[value] = float(score)
+            added += int(not exists)
+        return added
+
+    def _zincrby(self, name, amount, value):
+        z = self._get_typed(name, dict, create=True)
+        value = _to_bytes(value)
+        z[value] = z.get(value, 0.0) + amount
+        return z[value]
+
+    def _zscore(self, name, value):
+        return self._get_typed(name, dict).get(_to_bytes(value))
+
+    def _zcard(self, name):
+        return len(self._get_typed(name, dict))
+
+    def _zrangebyscore(self, name, min, max, withscores=False):
+        low, high = float(min), float(max)
+        result = sorted(((v, s) for v, s in self._get_typed(name, dict).items() if low <= s <= high),
+                        key=lambda x: (x[1], x[0]))
+        return result if withscores else [v for v, _ in result]
+
+    def _zremrangebyscore(self, name, min, max):
+        z = self._get_typed(name, dict)
+        low, high = float(min), float(max)
+        removed = [v for v, s in z.items() if low <= s <= high]
+        for v in removed:
+            del z[v]
+        return len(removed)
+
+    def _zrevrange(self, name, start, end, withscores=False):
+        result = sorted(self._get_typed(name, dict).items(), key=lambda x: (x[1], x[0]), reverse=True)
+        result = result[start:] if end == -1 else result[start:end + 1]
+        return result if withscores else [v for v, _ in result]
+
+
+class MemoryRedisPipeline(object):
+    """
+        管道中的命令在 execute 时一次性执行，只计一次往返
+    """
+    def __init__(self, redis: MemoryRedis):
+        self._redis = redis
+        self._commands = []
+
+    def __getattr__(self, op):
+        if not hasattr(self._redis, "_" + op):
+            raise AttributeError(op)
+
+        def _queue(*args, **kwargs):
+            self._commands.append((op, args, kwargs))
+            return self
+        return _queue
+
+    def execute(self):
+        commands = self._commands
+        self._commands = []
+        self._redis._round_trip("pipeline")
+        with self._redis._lock:
+            return [getattr(self._redis, "_" + op)(*args, **kwargs) for op, args, kwargs in commands]
+
+
+class MemoryPubSub(object):
+    """
+        单进程内没有其它发布者，订阅后不会收到任何消息
+    """
+    def __init__(self):
+        self._closed = threading.Event()
+
+    def subscribe(self, *args, **kwargs):
+        pass
+
+    def psubscribe(self, *args, **kwargs):
+        pass
+
+    def listen(self):
+        self._closed.wait()
+        return iter(())
+
+    def close(self):
+        self._closed.set()
+
+
+# ---------------------------------------- Mongo ----------------------------------------
+
+
+def _get_path(doc, path: str):
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, dict):
+            if part not in value:
+                return None
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return None
+    return value
+
+
+def _set_path(doc, path: str, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _mongo_eq(value, cond) -> bool:
+    if isinstance(value, list) and not isinstance(cond, list):
+        return cond in value
+    return value == cond
+
+
+def _mongo_match_cond(value, cond) -> bool:
+    if not (isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond)):
+        return _mongo_eq(value, cond)
+    for op, arg in cond.items():
+        if op == "$eq":
+            ok = _mongo_eq(value, arg)
+        elif op == "$ne":
+            ok = not _mongo_eq(value, arg)
+        elif op == "$in":
+            ok = any(_mongo_eq(value, a) for a in arg)
+        elif op == "$nin":
+            ok = not any(_mongo_eq(value, a) for a in arg)
+        elif op == "$exists":
+            ok = (value is not None) == bool(arg)
+        elif op in ("$gt", "$gte", "$lt", "$lte"):
+            if value is None:
+                return False
+            try:
+                ok = {"$gt": value > arg, "$gte": value >= arg, "$lt": value < arg, "$lte": value <= arg}[op]
+            except TypeError:
+                ok = False
+        else:
+            raise NotImplementedError("memory mongo does not support " + op)
+        if not ok:
+            return False
+    return True
+
+
+def mongo_match(doc: dict, query: dict) -> bool:
+    for key, cond in query.items():
+        if key == "$and":
+            if not all(mongo_match(doc, q) for q in cond):
+                return False
+        elif key == "$or":
+            if not any(mongo_match(doc, q) for q in cond):
+                return False
+        elif not _mongo_match_cond(_get_path(doc, key), cond):
+            return False
+    return True
+
+
+def _mongo_apply_update(doc: dict, update: dict):
+    if not any(k.startswith("$") for k in update):
+        _id = doc.get("_id")
+        doc.clear()
+        doc.update(copy.deepcopy(update))
+        if _id is not None:
+            doc["_id"] = _id
+        return
+    for op, fields in update.items():
+        for path, value in fields.items():
+            if op == "$set":
+                _set_path(doc, path, copy.deepcopy(value))
+            elif op == "$unset":
+                parent = _get_path(doc, path.rsplit(".", 1)[0]) if "." in path else doc
+                if isinstance(parent, dict):
+                    parent.pop(path.rsplit(".", 1)[-1], None)
+            elif op == "$inc":
+                _set_path(doc, path, (_get_path(doc, path) or 0) + value)
+            elif op == "$push":
+                lst = _get_path(doc, path)
+                if lst is None:
+                    lst = []
+                    _set_path(doc, path, lst)
+                if isinstance(value, dict) and "$each" in value:
+                    lst.extend(copy.deepcopy(value["$each"]))
+                else:
+                    lst.append(copy.deepcopy(value))
+            elif op == "$addToSet":
+                lst = _get_path(doc, path)
+                if lst is None:
+                    lst = []
+                    _set_path(doc, path, lst)
+                values = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                for v in values:
+                    if v not in lst:
+                        lst.append(copy.deepcopy(v))
+            else:
+                raise NotImplementedError("memory mongo does not support " + op)
+
+
+InsertOneResult = namedtuple("InsertOneResult", ["inserted_id"])
+UpdateResult = namedtuple("UpdateResult", ["matched_count", "modified_count", "upserted_id"])
+DeleteResult = namedtuple("DeleteResult", ["deleted_count"])
+
+
+class MemoryCursor(object):
+    def __init__(self, docs: list):
+        self._docs = docs
+
+    def sort(self, key, direction=1):
+        keys = key if isinstance(key, list) else [(key, direction)]
+        for k, d in reversed(keys):
+            self._docs.sort(key=lambda doc: (_get_path(doc, k) is None, _get_path(doc, k)), reverse=d < 0)
+        return self
+
+    def skip(self, n):
+        self._docs = self._docs[n:]
+        return self
+
+    def limit(self, n):
+        if n:
+            self._docs = self._docs[:n]
+        return self
+
+    def count(self, *args, **kwargs):
+        return len(self._docs)
+
+    def __iter__(self):
+        return iter(self._docs)
+
+
+class MemoryCollection(_MemoryBase):
+    BACKEND = "mongo"
+
+    def __init__(self, stats=None, latency=0.0):
+        super().__init__(stats, latency)
+        self._docs = []
+
+    def _find(self, query):
+        return [doc for doc in self._docs if mongo_match(doc, query or {})]
+
+    def find(self, filter=None, projection=None, **kwargs):
+        self._round_trip("find")
+        with self._lock:
+            return MemoryCursor(copy.deepcopy(self._find(filter)))
+
+    def find_one(self, filter=None, *args, **kwargs):
+        self._round_trip("find_one")
+        with self._lock:
+            for doc in self._docs:
+                if mongo_match(doc, filter or {}):
+                    return copy.deepcopy(doc)
+
+    def count_documents(self, filter, **kwargs):
+        self._round_trip("count_documents")
+        with self._lock:
+            return len(self._find(filter))
+
+    def insert_one(self, document, **kwargs):
+        self._round_trip("insert_one")
+        with self._lock:
+            # 与 pymongo 一致，插入时在原文档上设置 _id
+            document.setdefault("_id", ObjectId())
+            self._docs.append(copy.deepcopy(document))
+            return InsertOneResult(document["_id"])
+
+    def insert_many(self, documents, **kwargs):
+        self._round_trip("insert_many")
+        with self._lock:
+            for document in documents:
+                document.setdefault("_id", ObjectId())
+                self._docs.append(copy.deepcopy(document))
+
+    def _update(self, filter, update, upsert, multi):
+        matched = 0
+        for doc in self._docs:
+            if mongo_match(doc, filter):
+                _mongo_apply_update(doc, update)
+                matched += 1
+                if not multi:
+                    break
+        if matched == 0 and upsert:
+            doc = {k: copy.deepcopy(v) for k, v in filter.items() if not k.startswith("$") and not isinstance(v, dict)}
+            _mongo_apply_update(doc, update)
+            doc.setdefault("_id", ObjectId())
+            self._docs.append(doc)
+            return UpdateResult(0, 0, doc["_id"])
+        return UpdateResult(matched, matched, None)
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        self._round_trip("update_one")
+        with self._lock:
+            return self._update(filter, update, upsert, multi=False)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        self._round_trip("update_many")
+        with self._lock:
+            return self._update(filter, update, upsert, multi=True)
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        self._round_trip("replace_one")
+        with self._lock:
+            return self._update(filter, replacement, upsert, multi=False)
+
+    def _delete(self, filter, multi):
+        deleted = 0
+        remain = []
+        for doc in self._docs:
+            if (multi or deleted == 0) and mongo_match(doc, filter):
+                deleted += 1
+            else:
+                remain.append(doc)
+        self._docs = remain
+        return DeleteResult(deleted)
+
+    def delete_one(self, filter, **kwargs):
+        self._round_trip("delete_one")
+        with self._lock:
+            return self._delete(filter, multi=False)
+
+    def delete_many(self, filter, **kwargs):
+        self._round_trip("delete_many")
+        with self._lock:
+            return self._delete(filter, multi=True)
+
+
+class MemoryMongoDatabase(object):
+    def __init__(self, stats, latency):
+        self._stats = stats
+        self._latency = latency
+        self._lock = threading.Lock()
+        self._collections = {}
+
+    def __getitem__(self, name) -> MemoryCollection:
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(self._stats, self._latency)
+            return self._collections[name]
+
+
+class MemoryMongoClient(object):
+    def __init__(self, stats=None, latency=0.0):
+        self._stats = stats
+        self._latency = latency
+        self._lock = threading.Lock()
+        self._dbs = {}
+
+    def __getitem__(self, name) -> MemoryMongoDatabase:
+        with self._lock:
+            if name not in self._dbs:
+                self._dbs[name] = MemoryMongoDatabase(self._stats, self._latency)
+            return self._dbs[name]
+
+    def server_info(self):
+        return {"version": "memory"}
+
+
+# ---------------------------------------- Elasticsearch ----------------------------------------
+
+
+def _es_field(src: dict, field: str):
+    if field.endswith(".keyword"):
+        field = field[:-len(".keyword")]
+    return _get_path(src, field)
+
+
+def _es_comparable(value):
+    if isinstance(value, str):
+        for fmt in _TIME_FORMATS:
+            try:
+                return datetime.strptime(value, fmt)
+            except ValueError:
+                continue
+    return value
+
+
+def _es_eq(value, term) -> bool:
+    if isinstance(value, list):
+        return any(_es_eq(v, term) for v in value)
+    return value == term or (value is not None and str(value) == str(term))
+
+
+def _es_tokens(value) -> list:
+    return re.findall(r"\w+", str(value).lower())
+
+
+def _es_clauses(clauses) -> list:
+    if clauses is None:
+        return []
+    return clauses if isinstance(clauses, list) else [clauses]
+
+
+def es_match(src: dict, query: dict) -> bool:
+    if not query:
+        return True
+    for q_type, body in query.items():
+        if q_type == "match_all":
+            ok = True
+        elif q_type == "constant_score":
+            ok = es_match(src, body.get("filter", {}))
+        elif q_type == "bool":
+            must = _es_clauses(body.get("must")) + _es_clauses(body.get("filter"))
+            should = _es_clauses(body.get("should"))
+            ok = all(es_match(src, q) for q in must) \
+                and not any(es_match(src, q) for q in _es_clauses(body.get("must_not"))) \
+                and (not should or any(es_match(src, q) for q in should))
+        elif q_type == "term":
+            field, value = next(iter(body.items()))
+            if isinstance(value, dict):
+                value = value["value"]
+            ok = _es_eq(_es_field(src, field), value)
+        elif q_type == "terms":
+            field, values = next(iter(body.items()))
+            value = _es_field(src, field)
+            ok = any(_es_eq(value, v) for v in values)
+        elif q_type == "exists":
+            ok = _es_field(src, body["field"]) is not None
+        elif q_type in ("wildcard", "prefix"):
+            field, pattern = next(iter(body.items()))
+            if isinstance(pattern, dict):
+                pattern = pattern["value"]
+            if q_type == "prefix":
+                pattern = pattern + "*"
+            value = _es_field(src, field)
+            ok = value is not None and fnmatch.fnmatchcase(str(value), pattern)
+        elif q_type == "match":
+            field, cond = next(iter(body.items()))
+            if not isinstance(cond, dict):
+                cond = {"query": cond}
+            tokens = set(_es_tokens(_es_field(src, field) or ""))
+            expected = _es_tokens(cond["query"])
+            if cond.get("operator", "or").lower() == "and":
+                ok = all(t in tokens for t in expected)
+            else:
+                ok = any(t in tokens for t in expected)
+        elif q_type == "range":
+            field, cond = next(iter(body.items()))
+            value = _es_field(src, field)
+            ok = value is not None
+            for op in ("gt", "gte", "lt", "lte"):
+                if not ok or op not in cond:
+                    continue
+                a, b = _es_comparable(value), _es_comparable(cond[op])
+                try:
+                    ok = {"gt": a > b, "gte": a >= b, "lt": a < b, "lte": a <= b}[op]
+                except TypeError:
+                    ok = False
+        else:
+            raise NotImplementedError("memory elasticsearch does not support query " + q_type)
+        if not ok:
+            return False
+    return True
+
+
+def _es_aggregate(hits: list, aggs: dict) -> dict:
+    result = {}
+    for name, body in aggs.items():
+        sub_aggs = body.get("aggs") or body.get("aggregations")
+        agg_type = next(k for k in body if k not in ("aggs", "aggregations"))
+        conf = body[agg_type]
+        if agg_type == "terms":
+            groups = defaultdict(list)
+            for hit in hits:
+                value = _es_field(hit["_source"], conf["field"])
+                for v in value if isinstance(value, list) else [value]:
+                    if v is not None:
+                        groups[v].append(hit)
+            ordered = sorted(groups.items(), key=lambda x: (-len(x[1]), str(x[0])))
+            buckets = []
+            for key, group in ordered[:conf.get("size", 10)]:
+                bucket = {"key": key, "doc_count": len(group)}
+                if sub_aggs:
+                    bucket.update(_es_aggregate(group, sub_aggs))
+                buckets.append(bucket)
+            result[name] = {
+                "doc_count_error_upper_bound": 0,
+                "sum_other_doc_count": sum(len(g) for _, g in ordered[conf.get("size", 10):]),
+                "buckets": buckets
+            }
+        elif agg_type in ("cardinality", "value_count", "max", "min", "sum", "avg"):
+            values = [_es_field(hit["_source"], conf["field"]) for hit in hits]
+            values = [v for v in values if v is not None]
+            if agg_type == "cardinality":
+                value = len(set(map(str, values)))
+            elif agg_type == "value_count":
+                value = len(values)
+            elif not values:
+                value = None
+            elif agg_type == "max":
+                value = max(values)
+            elif agg_type == "min":
+                value = min(values)
+            elif agg_type == "sum":
+                value = sum(values)
+            else:
+                value = sum(values) / len(values)
+            result[name] = {"value": value}
+        elif agg_type == "top_hits":
+            result[name] = {"hits": {"total": len(hits), "hits": hits[:conf.get("size", 3)]}}
+        else:
+            raise NotImplementedError("memory elasticsearch does not support aggregation " + agg_type)
+    return result
+
+
+def _es_sort_hits(hits: list, sort):
+    if not sort:
+        return
+    items = sort if isinstance(sort, list) else [sort]
+    for item in reversed(items):
+        if isinstance(item, str):
+            item = {item: "asc"}
+        for field, order in item.items():
+            if isinstance(order, dict):
+                order = order.get("order", "asc")
+            hits.sort(key=lambda hit: (_es_field(hit["_source"], field) is None,
+                                       _es_comparable(_es_field(hit["_source"], field))),
+                      reverse=order == "desc")
+
+
+class MemoryIndices(object):
+    def __init__(self, es):
+        self._es = es
+        self._templates = {}
+
+    def put_template(self, name, body, **kwargs):
+        self._es._round_trip("put_template")
+        self._templates[name] = body
+        return {"acknowledged": True}
+
+    def exists_template(self, name, **kwargs):
+        self._es._round_trip("exists_template")
+        return name in self._templates
+
+    def get_template(self, name, **kwargs):
+        self._es._round_trip("get_template")
+        return {name: self._templates[name]} if name in self._templates else {}
+
+    def delete_template(self, name, **kwargs):
+        self._es._round_trip("delete_template")
+        self._templates.pop(name, None)
+        return {"acknowledged": True}
+
+    def exists(self, index, **kwargs):
+        self._es._round_trip("exists")
+        with self._es._lock:
+            return len(self._es._resolve(index)) > 0
+
+    def delete(self, index, **kwargs):
+        self._es._round_trip("delete_index")
+        with self._es._lock:
+            for name in self._es._resolve(index):
+                del self._es._indices[name]
+        return {"acknowledged": True}
+
+
+class MemoryElasticsearch(_MemoryBase):
+    """
+        以 _all 结尾的索引名视为同前缀的全部按日索引的别名，如 dc_log_all -> dc_log_*
+    """
+    BACKEND = "es"
+
+    def __init__(self, stats=None, latency=0.0):
+        super().__init__(stats, latency)
+        self._indices = defaultdict(list)
+        self._id_seq = 0
+        self.indices = MemoryIndices(self)
+
+    def _resolve(self, index) -> list:
+        names = []
+        patterns = index.split(",") if isinstance(index, str) else list(index)
+        for pattern in patterns:
+            if pattern.endswith("_all"):
+                pattern = pattern[:-len("all")] + "*"
+            names.extend(n for n in self._indices if fnmatch.fnmatchcase(n, pattern) and n not in names)
+        return names
+
+    def _add(self, index, doc_type, body, doc_id=None):
+        self._id_seq += 1
+        doc_id = doc_id or str(self._id_seq)
+        self._indices[index].append({"_index": index, "_type": doc_type, "_id": doc_id, "_source": body})
+        return doc_id
+
+    def preload(self, index, doc_type, body):
+        """
+            直接写入文档，不计往返也不注入延迟，用于回放前模拟日志入库
+        """
+        with self._lock:
+            return self._add(index, doc_type, body)
+
+    def index(self, index, doc_type, body, id=None, **kwargs):
+        self._round_trip("index")
+        with self._lock:
+            doc_id = self._add(index, doc_type, body, id)
+        return {"_index": index, "_type": doc_type, "_id": doc_id, "result": "created"}
+
+    def bulk(self, body, index=None, doc_type=None, **kwargs):
+        self._round_trip("bulk")
+        lines = body if isinstance(body, list) else [l for l in body.splitlines() if l.strip()]
+        items = []
+        with self._lock:
+            for i in range(0, len(lines), 2):
+                action = lines[i]["index"]
+                doc_id = self._add(action.get("_index", index), action.get("_type", doc_type), lines[i + 1],
+                                   action.get("_id"))
+                items.append({"index": {"_id": doc_id, "status": 201}})
+        return {"errors": False, "items": items}
+
+    def _search(self, index, body) -> dict:
+        body = body or {}
+        hits = [hit for name in self._resolve(index) for hit in self._indices[name]
+                if es_match(hit["_source"], body.get("query"))]
+        _es_sort_hits(hits, body.get("sort"))
+        start = body.get("from", 0)
+        size = body.get("size", 10)
+        page = hits[start:start + size]
+        if body.get("_source") is False:
+            page = [{k: v for k, v in hit.items() if k != "_source"} for hit in page]
+        rsp = {
+            "took": 0,
+            "timed_out": False,
+            "hits": {"total": len(hits), "max_score": None, "hits": page}
+        }
+        aggs = body.get("aggs") or body.get("aggregations")
+        if aggs:
+            rsp["aggregations"] = _es_aggregate(hits, aggs)
+        return rsp
+
+    def search(self, index=None, doc_type=None, body=None, **kwargs):
+        self._round_trip("search")
+        with self._lock:
+            return self._search(index or "*", body)
+
+    def msearch(self, body, index=None, doc_type=None, **kwargs):
+        self._round_trip("msearch")
+        responses = []
+        with self._lock:
+            for i in range(0, len(body), 2):
+                header = body[i]
+                try:
+                    responses.append(self._search(header.get("index", index) or "*", body[i + 1]))
+                except Exception as e:
+                    # 与ES一致，单条检索的错误只体现在对应的响应中
+                    responses.append({"error": {"type": type(e).__name__, "reason": str(e)}, "status": 400})
+        return {"responses": responses}
+
+    def count(self, index=None, doc_type=None, body=None, **kwargs):
+        self._round_trip("count")
+        with self._lock:
+            rsp = self._search(index or "*", dict(body or {}, size=0))
+        return {"count": rsp["hits"]["total"]}
+
+    def ping(self, **kwargs):
+        return True
+
+
+# ---------------------------------------- LDAP ----------------------------------------
+
+
+class MemoryLDAP(object):
+    """
+        基于 ldap3 的 MOCK_SYNC 策略，所有连接共享同一个内存目录
+    """
+    BACKEND = "ldap"
+
+    def __init__(self, base_dn_list: list, stats=None, latency=0.0, json_file=None):
+        """
+            :param base_dn_list: 需要预先创建的域根DN
+            :param json_file: 可选，ldap3 导出的目录数据 (Connection.response_to_json)
+        """
+        self._stats = stats
+        self._latency = latency
+        self.server = Server("memory", get_info=OFFLINE_AD_2012_R2)
+        con = Connection(self.server, client_strategy=MOCK_SYNC)
+        if json_file:
+            con.strategy.entries_from_json(json_file)
+        for dn in base_dn_list:
+            con.strategy.add_entry(dn, {"objectClass": ["top", "domain"]})
+
+    def connection(self, *args, **kwargs):
+        """
+            代替 ldap3.Connection，忽略传入的服务器和账号，使用匿名绑定
+        """
+        con = Connection(self.server, client_strategy=MOCK_SYNC)
+        con.bind()
+        return _MemoryLDAPConnection(con, self)
+
+    def _round_trip(self, op):
+        if self._stats is not None:
+            self._stats.record(self.BACKEND, op)
+        if self._latency > 0:
+            time.sleep(self._latency)
+
+
+class _MemoryLDAPConnection(object):
+    def __init__(self, con, ldap: MemoryLDAP):
+        self._con = con
+        self._ldap = ldap
+
+    def __getattr__(self, name):
+        attr = getattr(self._con, name)
+        if not callable(attr):
+            return attr
+
+        def _call(*args, **kwargs):
+            self._ldap._round_trip(name)
+            return attr(*args, **kwargs)
+        return _call
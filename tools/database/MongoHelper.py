@@ -2,12 +2,15 @@
 # coding: utf-8
 # author: 9ian1i   https://github.com/Qianlitp
 
-from pymongo import MongoClient
+from tools.common.Metrics import instrument_backend
+from tools.database.ClientRegistry import get_mongo_client
 
 
+@instrument_backend("mongo")
 class MongoHelper(object):
     def __init__(self, uri, db=None, collection=None):
-        self.client = MongoClient(uri, connect=False)
+        # 相同 uri 在进程内共用同一个 MongoClient 连接池
+        self.client = get_mongo_client(uri)
         if db:
             self.db = self.client[db]
         if db and collection:
@@ -2,27 +2,28 @@
 # coding: utf-8
 # author: 9ian1i   https://github.com/Qianlitp
 
-import redis
-
-from settings.database_config import RedisConfig
+from tools.common.Metrics import instrument_backend
+from tools.database.ClientRegistry import get_redis_client
 
 
+@instrument_backend("redis")
 class RedisHelper(object):
     def __init__(self):
-        if hasattr(RedisConfig, "password"):
-            pool = redis.ConnectionPool(host=RedisConfig.host, port=RedisConfig.port, password=RedisConfig.password)
-        else:
-            pool = redis.ConnectionPool(host=RedisConfig.host, port=RedisConfig.port)
-        self.db = redis.Redis(connection_pool=pool)
-        self.pipe = self.db.pipeline()
+        # 进程内共用同一个连接池
+        self.db = get_redis_client()
 
     def exists_key(self, key):
         return self.db.exists(key)
 
+    # pipeline 不是线程安全的，每次操作单独创建
     def set_str_value(self, key, value, expire=None):
-        self.pipe.delete(key)
-        self.pipe.set(key, value, expire)
-        self.pipe.execute()
+        pipe = self.db.pipeline()
+        pipe.delete(key)
+        pipe.set(key, value, expire)
+        pipe.execute()
+
+    def set_str_value_nx(self, key, value, expire=None) -> bool:
+        return bool(self.db.set(key, value, ex=expire, nx=True))
 
     def get_str_value(self, key):
         value = self.db.get(key)
@@ -31,18 +32,39 @@ class RedisHelper(object):
         assert isinstance(value, bytes)
         return value.decode("utf-8")
 
+    def get_str_value_with_ttl(self, key) -> (str, int):
+        """
+            :return: (值, 剩余过期时间)，键不存在时值为 None，未设置过期时间时为 -1
+        """
+        pipe = self.db.pipeline()
+        pipe.get(key)
+        pipe.ttl(key)
+        value, ttl = pipe.execute()
+        if not value:
+            return None, ttl
+        return value.decode("utf-8"), ttl
+
     def add_member_set(self, key, value):
         self.db.sadd(key, value)
 
+    def add_member_set_and_count(self, key, value, expire=None) -> int:
+        pipe = self.db.pipeline()
+        pipe.sadd(key, value)
+        pipe.scard(key)
+        if expire:
+            pipe.expire(key, expire)
+        return pipe.execute()[1]
+
     def get_all_member_set(self, key) -> list:
         result = self.db.smembers(key)
         result = list(map(lambda x: x.decode("utf-8"), result))
         return result
 
     def set_list(self, key, *args):
-        self.pipe.delete(key)
-        self.pipe.lpush(key, *args)
-        self.pipe.execute()
+        pipe = self.db.pipeline()
+        pipe.delete(key)
+        pipe.lpush(key, *args)
+        pipe.execute()
 
     def get_all_list(self, key) -> list:
         result = self.db.lrange(key, 0, -1)
@@ -54,3 +76,45 @@ class RedisHelper(object):
 
     def set_expire(self, key, seconds):
         self.db.expire(key, seconds)
+
+    def incr(self, key) -> int:
+        return self.db.incr(key)
+
+    def publish(self, channel, message):
+        self.db.publish(channel, message)
+
+    def pubsub(self):
+        return self.db.pubsub(ignore_subscribe_messages=True)
+
+    def sliding_window_add(self, events_key, counts_key, item, member, score, cutoff, expire) -> (int, int, int):
+        """
+            滑动窗口计数，events_key 为事件有序集合 (分值为时间)，counts_key 为 item 次数有序集合
+
+            过期事件的读取和删除在同一个事务中，多个进程并发时每个过期事件只会被一个进程扣减
+
+            :return: (item 次数, 不同 item 数, 最大次数)
+        """
+        event_member = member + "\x1f" + item
+        pipe = self.db.pipeline()
+        pipe.zadd(events_key, {event_member: score})
+        pipe.zrangebyscore(events_key, "-inf", cutoff)
+        pipe.zremrangebyscore(events_key, "-inf", cutoff)
+        added, expired, _ = pipe.execute()
+
+        pipe = self.db.pipeline()
+        if added:
+            pipe.zincrby(counts_key, 1, item)
+        for each in expired:
+            pipe.zincrby(counts_key, -1, each.decode("utf-8").split("\x1f", 1)[1])
+        pipe.zremrangebyscore(counts_key, "-inf", 0)
+        pipe.expire(events_key, expire)
+        pipe.expire(counts_key, expire)
+        pipe.zscore(counts_key, item)
+        pipe.zcard(counts_key)
+        pipe.zrevrange(counts_key, 0, 0, withscores=True)
+        count, distinct, top = pipe.execute()[-3:]
+        return int(count or 0), distinct, int(top[0][1]) if top else 0
+
+    def get_top_zset(self, key, n) -> list:
+        result = self.db.zrevrange(key, 0, n - 1, withscores=True)
+        return [(member.decode("utf-8"), int(score)) for member, score in result]
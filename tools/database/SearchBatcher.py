@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+# coding: utf-8
+# author: 9ian1i   https://github.com/Qianlitp
+
+"""
+    ES检索请求合并
+
+    各检测线程发起的单条检索先放入进程内的等待队列，由后台线程在 ElasticConfig.search_batch_window 秒内
+    收集到的检索 (最多 search_batch_size 条) 合并为一次 _msearch 请求，再将每条响应分别返回给调用方。
+
+    单条检索的语义不变：检索出错时调用方得到带有 error 的响应，整个请求失败时调用方得到同样的异常。
+"""
+
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from settings.database_config import ElasticConfig
+from tools.common.Metrics import metrics
+from tools.database.ClientRegistry import get_es_client
+
+# 检索请求超时时间，单位秒
+REQUEST_TIMEOUT = 100
+
+
+class SearchBatcher(object):
+    def __init__(self, window=ElasticConfig.search_batch_window, batch_size=ElasticConfig.search_batch_size,
+                 senders=ElasticConfig.search_batch_senders):
+        self.window = window
+        self.batch_size = batch_size
+        self.senders = senders
+        self._cond = threading.Condition()
+        # [(msearch header, 检索语句, Future)]
+        self._pending = []
+        self._first_time = None
+        self._thread = None
+        self._executor = None
+
+    def search(self, body, index, doc_type, **params):
+        """
+            与 Elasticsearch.search 的返回一致，阻塞等待合并后的请求返回
+
+            :param params: 写入 msearch header 的参数，如 ignore_unavailable
+        """
+        header = dict(params, index=index, type=doc_type)
+        future = Future()
+        with self._cond:
+            if self._thread is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.senders, thread_name_prefix="es_msearch")
+                self._thread = threading.Thread(target=self._run, name="search_batcher", daemon=True)
+                self._thread.start()
+            self._pending.append((header, body, future))
+            if self._first_time is None:
+                self._first_time = time.monotonic()
+            self._cond.notify_all()
+        return future.result()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._pending:
+                        remaining = self.window - (time.monotonic() - self._first_time)
+                        if remaining <= 0 or len(self._pending) >= self.batch_size:
+                            break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait()
+                batch = self._pending[:self.batch_size]
+                self._pending = self._pending[self.batch_size:]
+                self._first_time = time.monotonic() if self._pending else None
+            self._executor.submit(self._send, batch)
+
+    @staticmethod
+    def _send(batch: list):
+        body = []
+        for header, query, _ in batch:
+            body.append(header)
+            body.append(query)
+        metrics.inc("watchad_search_batch_total")
+        metrics.inc("watchad_search_batched_total", n=len(batch))
+        try:
+            rsp = get_es_client().msearch(body=body, request_timeout=REQUEST_TIMEOUT)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, _, future), each in zip(batch, rsp["responses"]):
+            future.set_result(each)
+
+
+search_batcher = SearchBatcher()
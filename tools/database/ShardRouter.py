@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+# coding: utf-8
+# author: 9ian1i   https://github.com/Qianlitp
+
+"""
+    分片路由
+
+    消费主队列，按分片键将事件转发到各个引擎进程独占的分片队列：
+
+        WatchAD(fanout) -> watch_ad_analytics -> 路由进程 -> WatchAD_shard(direct) -> watch_ad_analytics_shard_N
+
+    分片键通过一致性哈希映射到进程序号，进程数变化时只有少部分分片键会迁移到其它进程。
+    进程数减少后，序号超出范围的分片队列中的剩余消息会在路由启动时重新分发，然后删除该队列。
+
+    转发使用发布确认，分片队列确认收到后才确认主队列中的消息，转发失败时消息退回主队列重新路由。
+"""
+
+import bisect
+import hashlib
+import logging
+import traceback
+import pika
+import simplejson
+from pika.exceptions import ChannelClosedByBroker
+
+from settings.database_config import MqConfig
+from tools.common.Logger import logger
+
+logging.getLogger("pika").setLevel(logging.ERROR)
+
+
+def get_shard_key(data: dict) -> str:
+    """
+        根据配置的分片键计算单条事件的分片键，事件中不存在该字段时退化为按域控计算机名分片
+    """
+    event_data = data.get("event_data", {})
+    computer_name = data.get("computer_name", "")
+    if MqConfig.shard_key == "source_ip":
+        ip = event_data.get("IpAddress")
+        if ip and ip != "-":
+            return ip.replace("::ffff:", "")
+    elif MqConfig.shard_key == "logon_id":
+        # 登录会话ID只在单台域控上唯一
+        logon_id = event_data.get("TargetLogonId") or event_data.get("SubjectLogonId")
+        if logon_id:
+            return computer_name + "/" + logon_id
+    return computer_name
+
+
+def _hash(key: str) -> int:
+    # 内置 hash 在不同进程间不一致
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+        分片序号的一致性哈希环
+    """
+    def __init__(self, shard_num: int, virtual_nodes: int = MqConfig.shard_virtual_nodes):
+        nodes = []
+        for index in range(shard_num):
+            for v in range(virtual_nodes):
+                nodes.append((_hash("{index}#{v}".format(index=index, v=v)), index))
+        nodes.sort()
+        self._hashes = [node[0] for node in nodes]
+        self._indexes = [node[1] for node in nodes]
+
+    def get_index(self, key: str) -> int:
+        pos = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._indexes[pos]
+
+
+class ShardRouter(object):
+    def __init__(self, shard_num: int):
+        assert shard_num > 0
+        self.auth = pika.PlainCredentials(MqConfig.user, MqConfig.password)
+        self.shard_num = shard_num
+        self.ring = HashRing(shard_num)
+        self.connection = None
+        self.channel = None
+
+    def connect(self):
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(
+            host=MqConfig.host,
+            port=MqConfig.port,
+            credentials=self.auth,
+            heartbeat=0
+        ))
+        self.channel = self.connection.channel()
+        # 发布确认，basic_publish 在消息进入分片队列后才返回，失败时抛出异常
+        self.channel.confirm_delivery()
+        self.channel.basic_qos(prefetch_count=MqConfig.prefetch_count)
+        self.channel.exchange_declare(exchange=MqConfig.exchange, exchange_type=MqConfig.exchange_type, durable=True)
+        self.channel.queue_declare(queue=MqConfig.main_queue, durable=True)
+        self.channel.queue_bind(exchange=MqConfig.exchange, queue=MqConfig.main_queue)
+        self.channel.exchange_declare(exchange=MqConfig.shard_exchange, exchange_type="direct", durable=True)
+        # 提前声明全部分片队列，引擎进程未启动时消息也不会丢失
+        for index in range(self.shard_num):
+            queue = self._queue_name(index)
+            self.channel.queue_declare(queue=queue, durable=True)
+            self.channel.queue_bind(exchange=MqConfig.shard_exchange, queue=queue, routing_key=queue)
+
+    def run(self):
+        self.connect()
+        self.rebalance()
+        logger.info("shard router started, shard key: {key}, shard num: {num}".format(key=MqConfig.shard_key,
+                                                                                       num=self.shard_num))
+        self.channel.basic_consume(queue=MqConfig.main_queue, on_message_callback=self.callback, auto_ack=False)
+        self.channel.start_consuming()
+
+    def rebalance(self):
+        """
+            将序号超出当前进程数的分片队列中的剩余消息重新分发，并删除这些队列
+        """
+        for index in range(self.shard_num, MqConfig.shard_max_queue_num):
+            queue = self._queue_name(index)
+            channel = self.connection.channel()
+            try:
+                channel.queue_declare(queue=queue, durable=True, passive=True)
+            except ChannelClosedByBroker:
+                # 队列不存在
+                continue
+            count = 0
+            while True:
+                method, properties, body = channel.basic_get(queue=queue, auto_ack=False)
+                if method is None:
+                    break
+                self._route(body, properties)
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+                count += 1
+            channel.queue_delete(queue=queue)
+            channel.close()
+            logger.info("rebalance shard queue {queue}, moved {count} messages.".format(queue=queue, count=count))
+
+    def callback(self, ch, method, properties, body):
+        try:
+            self._route(body, properties)
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            # 消息退回主队列，不丢弃
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            return
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    def _route(self, body, properties):
+        try:
+            key = get_shard_key(simplejson.loads(body.decode("utf-8")))
+        except Exception as e:
+            # 无法解析的消息交给任意一个进程处理，由引擎记录异常
+            key = ""
+        queue = self._queue_name(self.ring.get_index(key))
+        # mandatory 使无法投递到分片队列的消息也作为失败返回
+        self.channel.basic_publish(exchange=MqConfig.shard_exchange, routing_key=queue, body=body,
+                                   properties=properties, mandatory=True)
+
+    @staticmethod
+    def _queue_name(index: int) -> str:
+        return MqConfig.shard_queue_prefix + str(index)